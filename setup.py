@@ -104,8 +104,9 @@ setup(
         "chdkcamera": ["pyusb >= 1.0.0b1", "jpegtran-cffi >= 0.4"],
         "autorotate": ["jpegtran-cffi >= 0.4"],
         "gui": ["PySide >= 1.2.1"],
-        "hidtrigger": ["hidapi-cffi >= 0.1"],
-        "scantailor": ["psutil == 2.0.0"],
+        "hidtrigger": [],
+        "udev": ["pyudev >= 0.16"],
+        "scantailor": [],
         "web": [
             "Flask >= 0.10.1",
             "jpegtran-cffi >= 0.4",
@@ -275,11 +275,13 @@ def capture(config):
     trigger_loop()
 
     workflow.finish_capture()
+    return workflow
 
 
-def postprocess(config):
-    path = config['path'].get()
-    workflow = Workflow(config=config, path=path)
+def postprocess(config, workflow=None):
+    if workflow is None:
+        path = config['path'].get()
+        workflow = Workflow(config=config, path=path)
     draw_progress(0.0)
     workflow.on_step_progressed.connect(
         lambda x, **kwargs: draw_progress(kwargs['progress']),
@@ -303,12 +305,14 @@ def wizard(config):
     print("==========================\n",
           "Starting capturing process\n",
           "==========================")
-    capture(config)
+    # Re-use the workflow, so pages that were processed during capture do
+    # not have to be processed again
+    workflow = capture(config)
 
     print("=======================\n"
           "Starting postprocessing\n"
           "=======================")
-    postprocess(config)
+    postprocess(config, workflow)
 
     print("=================\n",
           "Generating output\n"
@@ -388,6 +392,9 @@ def setup_parser(config):
     postprocess_parser.add_argument(
         "--jobs", "-j", dest="jobs", type=int, default=None,
         metavar="<int>", help="Number of concurrent processes")
+    postprocess_parser.add_argument(
+        "--pipeline", dest="postprocess.pipeline", action="store_true",
+        default=None, help="Stream pages through the plugins one by one")
     postprocess_parser.set_defaults(subcommand=postprocess)
     # Add arguments from plugins
     for parser in (postprocess_parser, wizard_parser):
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Johannes Baiter. All rights reserved.
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Streaming per-page postprocessing.
+"""
+
+from __future__ import division, unicode_literals
+
+import logging
+import sys
+import threading
+import Queue
+from contextlib import contextmanager
+
+from spreads.util import scheduler as default_scheduler
+
+logger = logging.getLogger('spreads.pipeline')
+
+# Marks the end of the input of a stage
+_SENTINEL = object()
+
+
+class _Stage(object):
+    def __init__(self, plugin, num_workers, queue_size):
+        self.plugin = plugin
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.num_workers = num_workers
+        self.workers = []
+        self.lock = threading.Lock()
+        self.running = num_workers
+        self.reserved_in_use = False
+
+
+class PagePipeline(object):
+    """ Run pages through a chain of plugins that can process single pages.
+
+    Every plugin gets its own pool of worker threads, the stages are
+    connected by bounded queues. Each page is processed in a slot of the
+    :py:class:`spreads.util.ResourceScheduler`, so the number of pages that
+    are processed at the same time is limited by its budget. A page is
+    handed to the next stage as soon as the previous stage is done with it,
+    so later plugins can work on the first pages while earlier plugins are
+    still busy with the rest.
+
+    One slot of the budget is reserved for every plugin, only the remaining
+    slots are shared between them. This way, a plugin with many pages
+    waiting can not keep the following plugins from running. If the budget
+    has fewer slots than there are plugins, the plugins still take turns,
+    but are no longer guaranteed to make progress at the same time.
+
+    If a plugin fails on a page, the remaining pages are no longer processed,
+    the first exception is re-raised by :py:meth:`join`.
+
+    A page can be submitted again while it is still in the pipeline, e.g.
+    after it was retaken. Work on the outdated version of the page is then
+    discarded and the new version runs through all plugins again.
+
+    :param path:        Project path
+    :type path:         pathlib.Path
+    :param plugins:     Plugins to run, in order
+    :type plugins:      list of :py:class:`spreads.plugin.PageProcessHookMixin`
+    :param num_workers: Number of worker threads per plugin, defaults to the
+                        scheduler's number of slots
+    :type num_workers:  int
+    :param queue_size:  Maximum number of pages waiting in front of a plugin,
+                        defaults to twice the number of workers, 0 means
+                        unlimited
+    :type queue_size:   int
+    :param on_progress: Called with the plugin and the page after a plugin
+                        is done with a page
+    :type on_progress:  callable
+    :param scheduler:   Scheduler to run the pages in, defaults to the shared
+                        scheduler
+    :type scheduler:    :py:class:`spreads.util.ResourceScheduler`
+    """
+    def __init__(self, path, plugins, num_workers=None, queue_size=None,
+                 on_progress=None, scheduler=None):
+        self.scheduler = scheduler or default_scheduler
+        if num_workers is None:
+            num_workers = self.scheduler.num_slots
+        if queue_size is None:
+            queue_size = 2*num_workers
+        self.path = path
+        self.on_progress = on_progress
+        self._stages = [_Stage(plug, num_workers, queue_size)
+                        for plug in plugins]
+        # Slots that are not reserved for a single stage
+        self._shared_slots = max(0, self.scheduler.num_slots -
+                                 len(self._stages))
+        self._slots_cond = threading.Condition()
+        self._error = None
+        self._error_lock = threading.Lock()
+        self._closed = False
+        # Number of times each page was submitted, used to detect outdated
+        # work on resubmitted pages
+        self._generations = {}
+        self._page_locks = {}
+        self._pages_lock = threading.Lock()
+
+    @property
+    def failed(self):
+        return self._error is not None
+
+    def start(self):
+        """ Start the worker threads. """
+        for idx, stage in enumerate(self._stages):
+            for _ in xrange(stage.num_workers):
+                thread = threading.Thread(target=self._worker, args=(idx,))
+                thread.daemon = True
+                thread.start()
+                stage.workers.append(thread)
+
+    def put(self, raw_image):
+        """ Submit a page to the pipeline.
+
+        Blocks while the first stage's queue is full.
+
+        :param raw_image:   Path to the captured image of the page
+        :type raw_image:    pathlib.Path
+        :raises ValueError: If the pipeline was already closed
+        """
+        if self._closed:
+            raise ValueError("Can not submit {0} to a closed pipeline"
+                             .format(raw_image))
+        with self._pages_lock:
+            generation = self._generations.get(raw_image, 0) + 1
+            self._generations[raw_image] = generation
+            if raw_image not in self._page_locks:
+                self._page_locks[raw_image] = threading.Lock()
+        self._stages[0].queue.put((raw_image, generation))
+
+    def discard(self, raw_image):
+        """ Stop working on a page, e.g. before its image is replaced.
+
+        Pending work on the page is dropped and the call blocks until the
+        plugins that are currently working on the page are done, so that
+        none of them writes its results after this returns.
+
+        :param raw_image:   Path to the captured image of the page
+        :type raw_image:    pathlib.Path
+        """
+        with self._pages_lock:
+            if raw_image not in self._generations:
+                return
+            self._generations[raw_image] += 1
+            page_lock = self._page_locks[raw_image]
+        with page_lock:
+            pass
+
+    def close(self):
+        """ Signal that no more pages will be submitted. """
+        if self._closed:
+            return
+        self._closed = True
+        self._close_stage(0)
+
+    def join(self):
+        """ Wait until all submitted pages went through the pipeline.
+
+        Re-raises the first exception that occured in any of the plugins.
+        """
+        for stage in self._stages:
+            for thread in stage.workers:
+                # Joining with a timeout keeps the main thread responsive to
+                # KeyboardInterrupt
+                while thread.is_alive():
+                    thread.join(1)
+        if self._error is not None:
+            exc_type, exc_value, exc_tb = self._error
+            raise exc_type, exc_value, exc_tb
+
+    def run(self, pages):
+        """ Run all pages through the pipeline and wait for it to finish.
+
+        :param pages:   Paths to the captured images
+        :type pages:    iterable of pathlib.Path
+        """
+        self.start()
+        try:
+            for page in pages:
+                if self.failed:
+                    break
+                self.put(page)
+        finally:
+            self.close()
+        self.join()
+
+    def _close_stage(self, idx):
+        if idx >= len(self._stages):
+            return
+        stage = self._stages[idx]
+        for _ in xrange(stage.num_workers):
+            stage.queue.put(_SENTINEL)
+
+    @contextmanager
+    def _stage_slot(self, stage):
+        """ Take the stage's reserved slot or one of the shared slots. """
+        with self._slots_cond:
+            while True:
+                if not stage.reserved_in_use:
+                    stage.reserved_in_use = reserved = True
+                    break
+                if self._shared_slots > 0:
+                    self._shared_slots -= 1
+                    reserved = False
+                    break
+                self._slots_cond.wait()
+        try:
+            yield
+        finally:
+            with self._slots_cond:
+                if reserved:
+                    stage.reserved_in_use = False
+                else:
+                    self._shared_slots += 1
+                self._slots_cond.notify_all()
+
+    def _worker(self, idx):
+        stage = self._stages[idx]
+        while True:
+            item = stage.queue.get()
+            if item is _SENTINEL:
+                break
+            # Keep draining the queue after an error so that producers
+            # do not block forever
+            if self.failed:
+                continue
+            raw_image, generation = item
+            # Only one version of a page may be worked on at a time, since
+            # plugins write their results to the same files
+            with self._page_locks[raw_image]:
+                if self._generations[raw_image] != generation:
+                    logger.debug("Discarding outdated version of {0}"
+                                 .format(raw_image))
+                    continue
+                try:
+                    with self._stage_slot(stage):
+                        with self.scheduler.slot():
+                            stage.plugin.process_page(self.path, raw_image)
+                except Exception:
+                    logger.error("Plugin '{0}' failed to process {1}"
+                                 .format(stage.plugin.__name__, raw_image))
+                    with self._error_lock:
+                        if self._error is None:
+                            self._error = sys.exc_info()
+                    continue
+            if self.on_progress is not None:
+                self.on_progress(stage.plugin, raw_image)
+            if idx+1 < len(self._stages):
+                self._stages[idx+1].queue.put(item)
+        with stage.lock:
+            stage.running -= 1
+            is_last = stage.running == 0
+        if is_last:
+            self._close_stage(idx+1)
@@ -24,6 +24,7 @@ from __future__ import division, unicode_literals
 import abc
 import itertools
 import logging
+import threading
 
 import stevedore
 from blinker import Namespace
@@ -32,10 +33,16 @@ from stevedore.named import NamedExtensionManager
 
 from spreads.util import abstractclassmethod, DeviceException
 
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
 
 logger = logging.getLogger("spreads.plugin")
 pluginmanager = None
 devices = None
+device_monitor = None
 
 
 class PluginOption(object):
@@ -166,8 +173,22 @@ class DevicePlugin(SpreadsPlugin):  # pragma: no cover
                     docstring="Trigger capture on multiple devices at once.",
                     selectable=False),
                 "flip_target_pages": PluginOption(
-                    value=False, docstring="Temporarily switch target pages"
-                                           "(useful for e.g. East-Asian books")
+                    value=False,
+                    docstring="Temporarily switch target pages"
+                              "(useful for e.g. East-Asian books"),
+                "pipelined_capture": PluginOption(
+                    value=False,
+                    docstring="Allow the next capture to be triggered while "
+                              "the previous one is still being completed."),
+                "max_pending_captures": PluginOption(
+                    value=2,
+                    docstring="Maximum number of captures that are still "
+                              "being completed in pipelined mode."),
+                "connection_poll_interval": PluginOption(
+                    value=5.0,
+                    docstring="Seconds between checks if the devices are "
+                              "still connected (when udev is not "
+                              "available)."),
             }
 
     @abstractclassmethod
@@ -233,6 +254,20 @@ class DevicePlugin(SpreadsPlugin):  # pragma: no cover
         """
         raise NotImplementedError
 
+    def complete_capture(self, path):
+        """ Perform the work on a captured image that does not require the
+            device to be blocked, like tagging the image with metadata.
+
+        This is always called after :py:meth:`capture` has returned, but
+        in pipelined mode this happens in a background thread, possibly
+        while the next capture is already running.
+
+        :param path:    Path for the image, as passed to :py:meth:`capture`
+        :type path:     pathlib.Path
+
+        """
+        pass
+
     @abc.abstractmethod
     def finish_capture(self):
         """ Tell device to finish capturing.
@@ -357,6 +392,66 @@ class ProcessHookMixin(object):
         pass
 
 
+class PageProcessHookMixin(ProcessHookMixin):
+    """ Mixin for postprocessing plugins that can also work on single pages.
+
+    When postprocessing runs in pipeline mode, consecutive plugins with this
+    mixin are chained together, so that a page can be processed by one
+    plugin while the next page is still being processed by the previous
+    plugin.
+
+    """
+    #: If True, the plugin is only started once all previous plugins have
+    #: processed every page, e.g. because :py:meth:`prepare_process` needs
+    #: to look at the whole project.
+    page_barrier = False
+
+    def can_process_pages(self):
+        """ Check if the plugin can process single pages with its current
+            configuration.
+
+        :rtype:     bool
+
+        """
+        return True
+
+    def prepare_process(self, path):
+        """ Prepare processing single pages.
+
+        Called once before the first call to :py:meth:`process_page`.
+
+        :param path:        Project path
+        :type path:         pathlib.Path
+
+        """
+        pass
+
+    @abc.abstractmethod
+    def process_page(self, path, raw_image):
+        """ Perform the plugin's actions for a single page.
+
+        Must be thread-safe, since multiple pages are processed at once.
+
+        :param path:        Project path
+        :type path:         pathlib.Path
+        :param raw_image:   Path to the captured image of the page
+        :type raw_image:    pathlib.Path
+
+        """
+        pass
+
+    def finish_process(self, path):
+        """ Finish processing single pages.
+
+        Called once after the last call to :py:meth:`process_page`.
+
+        :param path:        Project path
+        :type path:         pathlib.Path
+
+        """
+        pass
+
+
 class OutputHookMixin(object):
     __metaclass__ = abc.ABCMeta
 
@@ -376,6 +471,98 @@ class OutputHookMixin(object):
         pass
 
 
+class DeviceMonitor(object):
+    """ Keeps track of whether a list of devices is still connected.
+
+    The connection state is only re-checked when udev reports a change on
+    the USB bus or, if pyudev is not available, periodically in the
+    background. Reading :py:attr:`connected` is therefore cheap and never
+    touches the devices themselves.
+
+    :param devices:         Devices to monitor
+    :type devices:          list(:py:class:`DevicePlugin`)
+    :param poll_interval:   Seconds between checks when udev is not
+                            available
+    :type poll_interval:    float
+    """
+    def __init__(self, devices, poll_interval=5.0):
+        self.devices = devices
+        self.poll_interval = poll_interval
+        self._connected = True
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._observer = None
+        self._thread = None
+
+    @property
+    def connected(self):
+        """ Whether all devices were connected during the last check. """
+        return self._connected
+
+    def start(self):
+        """ Start monitoring in the background. """
+        self._observer = self._get_udev_observer()
+        if self._observer is not None:
+            self._observer.start()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop monitoring. """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def refresh(self):
+        """ Check the connection state of all devices now.
+
+        :return:    Whether all devices are connected
+        :rtype:     bool
+        """
+        connected = all(dev.connected() for dev in self.devices)
+        if connected != self._connected:
+            logger.info("Devices are {0}connected"
+                        .format("" if connected else "no longer "))
+        self._connected = connected
+        return connected
+
+    def _get_udev_observer(self):
+        if pyudev is None:
+            return None
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by(subsystem='usb')
+            observer = pyudev.MonitorObserver(
+                monitor, callback=lambda device: self._wakeup.set())
+            observer.daemon = True
+        except Exception as e:
+            logger.debug("Could not set up udev monitoring, falling back to "
+                         "polling: {0}".format(e))
+            return None
+        return observer
+
+    def _watch(self):
+        # With udev, we only need to wake up for hotplug events
+        timeout = None if self._observer is not None else self.poll_interval
+        while not self._stopped.is_set():
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning("Could not check device connection: {0}"
+                               .format(e))
+                self._connected = False
+
+
 def get_pluginmanager(config):
     global pluginmanager
     if pluginmanager is None:
@@ -397,18 +584,28 @@ def get_driver(driver_name):
 def get_devices(config, force_reload=False):
     """ Initialize configured devices.
     """
-    global devices
+    global devices, device_monitor
     if not 'driver' in config.keys():
         raise DeviceException(
             "No driver has been configured\n"
             "Please run `spread configure` to select a driver.")
     if force_reload or not devices:
+        if device_monitor is not None:
+            device_monitor.stop()
+            device_monitor = None
         driver_manager = get_driver(config["driver"].get())
         driver_class = driver_manager.driver
         logger.debug("Finding devices for driver \"{0}\"".format(driver_manager))
         devices = list(driver_class.yield_devices(config['device']))
         if not devices:
             raise DeviceException("Could not find any compatible devices!")
+        if 'connection_poll_interval' in config['device'].keys():
+            poll_interval = config['device']['connection_poll_interval'].get(
+                float)
+        else:
+            poll_interval = 5.0
+        device_monitor = DeviceMonitor(devices, poll_interval)
+        device_monitor.start()
     return devices
 
 
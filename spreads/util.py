@@ -25,12 +25,23 @@
 from __future__ import division, unicode_literals
 
 import abc
+import ctypes
+import ctypes.util
+import errno
 import itertools
 import logging
+import mmap
+import multiprocessing
 import os
+import select
+import struct
+import threading
+import time
+from contextlib import contextmanager
 
 import blinker
 from colorama import Fore, Back, Style
+from concurrent.futures import ThreadPoolExecutor
 
 
 class SpreadsException(Exception):
@@ -64,6 +75,403 @@ def check_futures_exceptions(futures):
         raise exc
 
 
+def _get_monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+#: Clock that is not affected by changes of the system time, falls back to
+#: :py:func:`time.time` on platforms where no such clock is available.
+monotonic = _get_monotonic_clock()
+
+
+def _get_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        funcs = (libc.inotify_init1, libc.inotify_add_watch)
+    except (OSError, AttributeError):
+        return None
+    funcs[1].argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return funcs
+
+_inotify = _get_inotify()
+
+
+class DirectoryWatcher(object):
+    """ Waits for files in a directory to be written or opened.
+
+    Uses inotify where available, otherwise falls back to periodically
+    scanning the directory. Files being opened can only be detected with
+    inotify, in that case the polling fallback only ever returns an empty
+    list.
+
+    :param path:            Directory to watch
+    :type path:             pathlib.Path
+    :param opened:          Report files that were opened instead of files
+                            that were written
+    :type opened:           bool
+    :param poll_interval:   Seconds between scans if inotify is not
+                            available
+    :type poll_interval:    float
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_OPEN = 0x20
+    IN_MOVED_TO = 0x80
+    _event_struct = struct.Struct(str('iIII'))
+
+    def __init__(self, path, opened=False, poll_interval=1.0):
+        self.path = path
+        self.opened = opened
+        self.poll_interval = poll_interval
+        self._wakeup_pipe = os.pipe()
+        self._inotify_fd = self._add_watch()
+        self._snapshot = self._scan() if self.polling else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def polling(self):
+        return self._inotify_fd is None
+
+    def wait(self, timeout=None):
+        """ Block until files were written/opened, :py:meth:`wake` was
+            called or the timeout expired.
+
+        :param timeout: Maximum number of seconds to wait
+        :type timeout:  float
+        :return:        Names of the files, in the order of the events
+        :rtype:         list of unicode
+        """
+        if self.polling:
+            timeout = (self.poll_interval if timeout is None
+                       else min(timeout, self.poll_interval))
+            fds = [self._wakeup_pipe[0]]
+        else:
+            fds = [self._inotify_fd, self._wakeup_pipe[0]]
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if self._wakeup_pipe[0] in readable:
+            os.read(self._wakeup_pipe[0], 4096)
+        if self.polling:
+            return self._poll()
+        if self._inotify_fd in readable:
+            return self._read_events()
+        return []
+
+    def wake(self):
+        """ Make a pending or the next call to :py:meth:`wait` return. """
+        os.write(self._wakeup_pipe[1], b'x')
+
+    def close(self):
+        for fd in self._wakeup_pipe:
+            os.close(fd)
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def _add_watch(self):
+        if _inotify is None:
+            return None
+        inotify_init1, inotify_add_watch = _inotify
+        fd = inotify_init1(os.O_NONBLOCK)
+        if fd < 0:
+            return None
+        mask = (self.IN_OPEN if self.opened
+                else self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if inotify_add_watch(fd, unicode(self.path).encode('utf-8'),
+                             mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _read_events(self):
+        names = []
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return names
+                raise
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self._event_struct.unpack_from(data, offset)
+                offset += self._event_struct.size
+                name = data[offset:offset+length].rstrip(b'\0')
+                offset += length
+                if name:
+                    names.append(name.decode('utf-8'))
+
+    def _scan(self):
+        try:
+            return dict((name, os.stat(os.path.join(unicode(self.path), name))
+                         .st_mtime)
+                        for name in os.listdir(unicode(self.path)))
+        except OSError:
+            return {}
+
+    def _poll(self):
+        if self.opened:
+            return []
+        snapshot = self._scan()
+        changed = sorted(name for name, mtime in snapshot.iteritems()
+                         if self._snapshot.get(name) != mtime)
+        self._snapshot = snapshot
+        return changed
+
+
+class ResourceScheduler(object):
+    """ Hands out slots from a global budget of concurrently running jobs.
+
+    Plugins run every CPU-bound job (e.g. a subprocess or an image
+    transformation) in a slot, so that the total number of jobs does not
+    exceed the budget, no matter how many plugins are running at the same
+    time.
+
+    A job must not request another slot while it holds one, since this can
+    deadlock once the budget is used up.
+
+    :param num_slots:   Number of jobs that may run at the same time,
+                        defaults to the number of CPUs
+    :type num_slots:    int
+    """
+    def __init__(self, num_slots=None):
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._num_slots = None
+        self.resize(num_slots)
+
+    @property
+    def num_slots(self):
+        return self._num_slots
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    def resize(self, num_slots=None):
+        """ Change the budget.
+
+        Jobs that are already running are not affected, if the budget
+        shrinks, new jobs have to wait until enough of them are done.
+
+        :param num_slots:   New number of slots, defaults to the number of
+                            CPUs
+        :type num_slots:    int
+        """
+        if num_slots is None:
+            num_slots = multiprocessing.cpu_count()
+        if num_slots < 1:
+            raise ValueError("Need at least one slot, got {0}"
+                             .format(num_slots))
+        with self._cond:
+            self._num_slots = num_slots
+            self._cond.notify_all()
+
+    def acquire(self):
+        """ Block until a slot is available and take it. """
+        with self._cond:
+            while self._in_use >= self._num_slots:
+                self._cond.wait()
+            self._in_use += 1
+
+    def release(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        """ Context manager that holds a slot while its block runs. """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def executor(self, max_workers=None):
+        """ Get an executor whose jobs each run in a slot.
+
+        :param max_workers: Number of worker threads, defaults to the number
+                            of slots
+        :type max_workers:  int
+        :rtype:             :py:class:`concurrent.futures.Executor`
+        """
+        return _ScheduledExecutor(self, max_workers or self._num_slots)
+
+
+class _ScheduledExecutor(ThreadPoolExecutor):
+    def __init__(self, scheduler, max_workers):
+        super(_ScheduledExecutor, self).__init__(max_workers)
+        self._scheduler = scheduler
+
+    def submit(self, fn, *args, **kwargs):
+        def run_in_slot():
+            with self._scheduler.slot():
+                return fn(*args, **kwargs)
+        return super(_ScheduledExecutor, self).submit(run_in_slot)
+
+
+#: Scheduler shared by the whole application, its budget is set by the
+#: workflow from the `jobs` setting
+scheduler = ResourceScheduler()
+
+
+#: EXIF tag that holds the orientation of an image
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def _find_tiff_orientation(buf, offset):
+    """ Find the orientation entry in the first IFD of a TIFF structure.
+
+    :param buf:     Buffer that contains the TIFF structure
+    :type buf:      str or mmap.mmap
+    :param offset:  Offset of the TIFF header in `buf`
+    :type offset:   int
+    :return:        Offset of the entry's value and the byte order of the
+                    structure, None if there is no orientation entry
+    :rtype:         (int, str)
+    """
+    byte_order = {b'II': '<', b'MM': '>'}.get(buf[offset:offset+2])
+    if byte_order is None:
+        return None
+    magic, ifd_offset = struct.unpack(byte_order + 'HI',
+                                      buf[offset+2:offset+8])
+    if magic != 42:
+        return None
+    ifd_start = offset + ifd_offset
+    if ifd_start + 2 > len(buf):
+        return None
+    num_entries, = struct.unpack(byte_order + 'H',
+                                 buf[ifd_start:ifd_start+2])
+    for idx in xrange(num_entries):
+        entry = ifd_start + 2 + idx*12
+        if entry + 12 > len(buf):
+            return None
+        tag, tag_type, count = struct.unpack(byte_order + 'HHI',
+                                             buf[entry:entry+8])
+        # The orientation is a single SHORT, which is stored right in the
+        # entry's value field
+        if tag == EXIF_ORIENTATION_TAG and tag_type == 3 and count == 1:
+            return entry + 8, byte_order
+    return None
+
+
+def _find_exif_orientation(buf):
+    """ Find the EXIF orientation in a JPEG or TIFF/DNG file.
+
+    Only the headers are looked at, so the image data of a memory-mapped
+    file is never read.
+
+    :param buf:     Contents of the file
+    :type buf:      str or mmap.mmap
+    :return:        Offset of the orientation value and the byte order it is
+                    stored in, None if the file has no orientation tag
+    :rtype:         (int, str)
+    """
+    if buf[:2] in (b'II', b'MM'):
+        return _find_tiff_orientation(buf, 0)
+    if buf[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(buf):
+        marker, length = struct.unpack('>BH', buf[pos+1:pos+4])
+        if buf[pos] != b'\xff':
+            return None
+        # APP1 segment with EXIF data
+        if marker == 0xe1 and buf[pos+4:pos+10] == b'Exif\x00\x00':
+            return _find_tiff_orientation(buf, pos+10)
+        # Image data follows the start of scan, no more metadata after that
+        if marker == 0xda:
+            return None
+        pos += 2 + length
+    return None
+
+
+def get_exif_orientation(path):
+    """ Read the EXIF orientation of an image without decoding it.
+
+    :param path:    Path to a JPEG or TIFF/DNG file
+    :type path:     unicode
+    :return:        EXIF orientation (1-8), None if the image has none
+    :rtype:         int
+    """
+    with open(path, 'rb') as fp:
+        try:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return None
+        try:
+            location = _find_exif_orientation(buf)
+            if location is None:
+                return None
+            offset, byte_order = location
+            return struct.unpack(byte_order + 'H', buf[offset:offset+2])[0]
+        finally:
+            buf.close()
+
+
+def set_exif_orientation(path, orientation):
+    """ Overwrite the EXIF orientation of an image in place.
+
+    Only the two bytes that hold the orientation are written, the rest of the
+    file is left untouched. This only works if the file already has an
+    orientation tag.
+
+    :param path:        Path to a JPEG or TIFF/DNG file
+    :type path:         unicode
+    :param orientation: New EXIF orientation (1-8)
+    :type orientation:  int
+    :return:            Whether the orientation could be written
+    :rtype:             bool
+    """
+    with open(path, 'r+b') as fp:
+        try:
+            buf = mmap.mmap(fp.fileno(), 0)
+        except ValueError:
+            # Empty file
+            return False
+        try:
+            location = _find_exif_orientation(buf)
+            if location is None:
+                return False
+            offset, byte_order = location
+            buf[offset:offset+2] = struct.pack(byte_order + 'H', orientation)
+            buf.flush()
+        finally:
+            buf.close()
+    return True
+
+
 def get_free_space(path):
     # TODO: Add path for windows
     st = os.statvfs(unicode(path))
@@ -25,8 +25,11 @@ spreads workflow object.
 
 from __future__ import division, unicode_literals
 
+import bisect
 import logging
+import os
 import threading
+import time
 
 import spreads.vendor.confit as confit
 from blinker import Namespace
@@ -34,8 +37,195 @@ from concurrent.futures import ThreadPoolExecutor
 from spreads.vendor.pathlib import Path
 
 import spreads.plugin as plugin
+from spreads.pipeline import PagePipeline
 from spreads.util import (check_futures_exceptions, get_free_space,
-                          DeviceException)
+                          scheduler, DeviceException)
+
+
+class ImageIndex(object):
+    """ Sorted index of the images in a workflow's *raw* directory.
+
+    The index is updated incrementally by the workflow whenever it adds or
+    removes images itself, these updates are trusted without rescanning the
+    directory as long as nobody else changed it in the meantime. Changes made
+    by other processes are picked up by comparing the directory's
+    modification time, which costs a single `stat` call instead of a full
+    directory scan.
+
+    :param path:    Directory that holds the images
+    :type path:     pathlib.Path
+    """
+    #: Extensions that devices store their captures with, in order of
+    #: likelihood
+    capture_suffixes = ('.jpg', '.dng', '.jpeg', '.JPG')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._images = []
+        self._pages = {}
+        self._mtime = None
+        # Last mtime that was caused by our own changes
+        self._own_mtime = None
+        # Time until which the last external change is too recent to be
+        # reliably detected by its mtime alone
+        self._racy_until = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    @property
+    def mtime(self):
+        """ Current modification time of the directory, to tell the index
+            about changes that are made outside of it (see :py:meth:`add`).
+        """
+        return self._get_mtime()
+
+    @property
+    def images(self):
+        """ A sorted list of all images in the directory. """
+        with self._lock:
+            self._check_fresh()
+            return list(self._images)
+
+    def last(self, num=1):
+        """ Get the last `num` images.
+
+        :param num: Number of images to return
+        :type num:  int
+        :rtype:     list(pathlib.Path)
+        """
+        with self._lock:
+            self._check_fresh()
+            return self._images[-num:] if num else []
+
+    def get(self, page_num):
+        """ Get the image that was stored for a given page number.
+
+        :param page_num:    Page number, as encoded in the image's file name
+        :type page_num:     int
+        :return:            Path to the image or None if it does not exist
+        :rtype:             pathlib.Path
+        """
+        with self._lock:
+            self._check_fresh()
+            return self._pages.get(page_num)
+
+    def add(self, *paths, **kwargs):
+        """ Add images to the index.
+
+        :param paths:   Paths to the new images
+        :type paths:    pathlib.Path
+        :param change:  Modification times of the directory from right before
+                        and right after the images were written. Without
+                        them, the directory is rescanned on the next access.
+        :type change:   (float, float)
+        """
+        before, after = kwargs.get('change') or (None, None)
+        with self._lock:
+            if self._mtime is None:
+                # Not loaded yet, the scan will pick up the new images
+                self._check_fresh()
+            for path in paths:
+                if path in self._images:
+                    continue
+                bisect.insort(self._images, path)
+                page_num = self._get_page_number(path)
+                if page_num is not None:
+                    self._pages[page_num] = path
+            self._apply_change(before, after)
+
+    def add_capture(self, base_path, change=None):
+        """ Add the image a device stored for `base_path`.
+
+        Devices receive the path for a capture without an extension and pick
+        the suffix themselves, so we probe for the likely candidates.
+
+        :param base_path:   Path that was passed to the device
+        :type base_path:    pathlib.Path
+        :param change:      Modification times of the directory from right
+                            before and after the device stored the image
+        :type change:       (float, float)
+        :return:            Path to the captured image or None if no image
+                            could be found
+        :rtype:             pathlib.Path
+        """
+        for suffix in self.capture_suffixes:
+            candidate = base_path.parent / (base_path.name + suffix)
+            if candidate.exists():
+                self.add(candidate, change=change)
+                return candidate
+        # Something unexpected was stored, fall back to a full scan
+        self.invalidate()
+
+    def remove(self, *paths):
+        """ Delete images from disk and remove them from the index.
+
+        :param paths:   Paths to the images to be removed
+        :type paths:    pathlib.Path
+        """
+        with self._lock:
+            before = self._get_mtime()
+            for path in paths:
+                if path.exists():
+                    path.unlink()
+                if path in self._images:
+                    self._images.remove(path)
+                page_num = self._get_page_number(path)
+                if self._pages.get(page_num) == path:
+                    del self._pages[page_num]
+            self._apply_change(before, self._get_mtime())
+
+    def invalidate(self):
+        """ Force a full rescan on the next access. """
+        with self._lock:
+            self._mtime = None
+
+    def _get_page_number(self, path):
+        try:
+            return int(path.stem)
+        except ValueError:
+            return None
+
+    def _get_mtime(self):
+        try:
+            return os.stat(unicode(self.path)).st_mtime
+        except OSError:
+            return None
+
+    def _apply_change(self, before, after):
+        # Our own changes are already reflected in the index, so the mtime
+        # after them can be trusted without rescanning the directory, but
+        # only if the directory was in the state we last saw before. If
+        # anybody else changed it in the meantime, we have to rescan.
+        if self._mtime is None or self._mtime == after:
+            return
+        if before is not None and self._mtime == before:
+            self._mtime = self._own_mtime = after
+        else:
+            self._mtime = None
+
+    def _check_fresh(self):
+        mtime = self._get_mtime()
+        if mtime is None:
+            self._images, self._pages, self._mtime = [], {}, None
+            return
+        if mtime == self._mtime and time.time() >= self._racy_until:
+            return
+        self._images = sorted(self.path.iterdir())
+        self._pages = {}
+        for path in self._images:
+            page_num = self._get_page_number(path)
+            if page_num is not None:
+                self._pages[page_num] = path
+        self._mtime = mtime
+        # NOTE: Some filesystems (e.g. FAT on SD cards) only have a mtime
+        #       resolution of up to two seconds, so modifications that
+        #       happen right after a scan might not change the mtime. We
+        #       keep rescanning until the scan is safely past the last
+        #       modification, unless that modification was our own.
+        if mtime != self._own_mtime:
+            self._racy_until = mtime + 2
 
 
 class Workflow(object):
@@ -52,16 +242,27 @@ class Workflow(object):
         if not self.path.exists():
             self.path.mkdir()
         self.id = id
-        if self.images:
-            self.pages_shot = len(self.images)
-        else:
-            self.pages_shot = 0
+        self._image_index = ImageIndex(self.path / 'raw')
+        # Determined on first access, so that creating a workflow does not
+        # have to scan its images
+        self._pages_shot = None
         # See if supplied `config` is already a valid Configuration object
         if isinstance(config, confit.Configuration):
             self.config = config
         else:
             self.config = self._load_config(config)
         self._capture_lock = threading.RLock()
+        # Paths of captures whose images have not been stored yet
+        self._pending_captures = []
+        self._pending_lock = threading.Lock()
+        self._completion_executor = None
+        self._completion_slots = None
+        self._completion_error = None
+        # Pipeline that processes pages while they are being captured
+        self._live_pipeline = None
+        self._live_plugins = []
+        # Plugins that already processed all pages during capture
+        self._processed_live = []
         self.active = False
         self._devices = None
         self._pluginmanager = None
@@ -76,7 +277,7 @@ class Workflow(object):
     def devices(self):
         if self._devices is None:
             self._devices = plugin.get_devices(self.config, force_reload=True)
-        if any(not dev.connected() for dev in self._devices):
+        if not self._devices_connected():
             self._logger.warning(
                 "At least one of the devices has been disconnected."
                 "Please make sure it has been re-enabled before taking another"
@@ -88,11 +289,54 @@ class Workflow(object):
 
     @property
     def images(self):
-        # Get fresh image list if number of pages has changed
-        raw_path = self.path / 'raw'
-        if not raw_path.exists():
-            return []
-        return sorted(raw_path.iterdir())
+        return self._image_index.images
+
+    @property
+    def pages_shot(self):
+        if self._pages_shot is None:
+            self._pages_shot = len(self._image_index)
+        return self._pages_shot
+
+    @pages_shot.setter
+    def pages_shot(self, value):
+        self._pages_shot = value
+
+    @property
+    def busy(self):
+        """ Whether the workflow is capturing or running a step, or still
+        completing captures or processing pages in the background.
+        """
+        with self._pending_lock:
+            pending = bool(self._pending_captures)
+        return (self.active or pending or self._live_pipeline is not None
+                or (self.step is not None and self.step_done is False))
+
+    def _devices_connected(self):
+        # The monitor keeps the connection state up to date in the
+        # background, so we don't have to query the devices on every access
+        monitor = plugin.device_monitor
+        if monitor is not None and monitor.devices is self._devices:
+            return monitor.connected
+        return all(dev.connected() for dev in self._devices)
+
+    def get_image(self, page_num):
+        """ Get the image for a given page number.
+
+        :param page_num:    Number of the page
+        :type page_num:     int
+        :return:            Path to the image or None if there is no such page
+        :rtype:             pathlib.Path
+        """
+        return self._image_index.get(page_num)
+
+    def add_images(self, *paths):
+        """ Notify the workflow of images that were added to its *raw*
+            directory from outside of :py:meth:`capture` (e.g. uploads).
+
+        :param paths:   Paths to the new images
+        :type paths:    pathlib.Path
+        """
+        self._image_index.add(*paths)
 
     @property
     def out_files(self):
@@ -167,6 +411,85 @@ class Workflow(object):
             self.on_step_progressed.send(self, plugin_name=plug.__name__,
                                          progress=float(idx+1)/len(plugins))
 
+    def _get_process_segments(self):
+        """ Group the postprocessing plugins into segments.
+
+        Consecutive plugins that can process single pages are grouped into
+        a single segment that is run as a :py:class:`PagePipeline`, all other
+        plugins form a segment of their own and are run over the whole
+        project.
+
+        :return:    Segments as tuples of a flag that indicates if the
+                    segment can be pipelined and the segment's plugins
+        :rtype:     list of (bool, list)
+        """
+        segments = []
+        for plug in (x for x in self.plugins if hasattr(x, 'process')):
+            is_page_plugin = (isinstance(plug, plugin.PageProcessHookMixin)
+                              and plug.can_process_pages())
+            if (is_page_plugin and segments and segments[-1][0]
+                    and not plug.page_barrier):
+                segments[-1][1].append(plug)
+            else:
+                segments.append((is_page_plugin, [plug]))
+        return segments
+
+    def _update_job_budget(self):
+        """ Apply the `jobs` setting to the shared resource scheduler. """
+        num_jobs = None
+        if 'jobs' in self.config.keys() and self.config['jobs'].get():
+            num_jobs = self.config['jobs'].get(int)
+        scheduler.resize(num_jobs)
+
+    def _run_process_pipeline(self):
+        segments = self._get_process_segments()
+        num_plugins = sum(len(plugins) for _, plugins in segments)
+        self._finish_live_processing()
+        live_plugins, self._processed_live = self._processed_live, []
+        if live_plugins and segments[0][1] == live_plugins:
+            # Already processed during capture
+            segments = segments[1:]
+        images = self.images
+        num_images = len(images)
+        done = {}
+        progress_lock = threading.Lock()
+
+        def send_progress(plug, progress):
+            with progress_lock:
+                done[plug] = progress
+                total = sum(done.values())/num_plugins
+            self.on_step_progressed.send(self, plugin_name=plug.__name__,
+                                         progress=total)
+
+        def page_done(plug, raw_image):
+            with progress_lock:
+                progress = done.get(plug, 0) + 1/num_images
+            send_progress(plug, min(progress, 1.0))
+
+        for plug in live_plugins:
+            send_progress(plug, 1.0)
+        for is_pipeline, plugins in segments:
+            if not is_pipeline:
+                plug = plugins[0]
+                plug.on_progressed.connect(
+                    lambda sender, **kwargs: send_progress(
+                        sender, kwargs['progress']),
+                    sender=plug, weak=False)
+                plug.process(self.path)
+                send_progress(plug, 1.0)
+                continue
+            self._logger.debug("Running {0} as a page pipeline"
+                               .format(", ".join(x.__name__
+                                                 for x in plugins)))
+            for plug in plugins:
+                plug.prepare_process(self.path)
+            pipeline = PagePipeline(self.path, plugins,
+                                    on_progress=page_done)
+            pipeline.run(images)
+            for plug in plugins:
+                plug.finish_process(self.path)
+                send_progress(plug, 1.0)
+
     def _get_next_filename(self, target_page=None):
         """ Get next filename that a capture should be stored as.
 
@@ -184,14 +507,19 @@ class Workflow(object):
             base_path.mkdir()
 
         try:
-            last_num = int(self.images[-1].stem)
+            last_num = int(self._image_index.last()[0].stem)
         except IndexError:
             last_num = -1
+        # Take captures into account whose images have not arrived yet
+        with self._pending_lock:
+            if self._pending_captures:
+                last_num = max(last_num, max(int(x.stem) for x
+                                             in self._pending_captures))
 
         if target_page is None:
-            return base_path / "{03:0}".format(self.pages_shot)
-
-        next_num = (last_num+2 if target_page == 'odd' else last_num+1)
+            next_num = last_num+1
+        else:
+            next_num = (last_num+2 if target_page == 'odd' else last_num+1)
         return base_path / "{0:03}".format(next_num)
 
     def prepare_capture(self):
@@ -216,6 +544,13 @@ class Workflow(object):
              self.devices[1].target_page) = (self.devices[1].target_page,
                                              self.devices[0].target_page)
         self._run_hook('prepare_capture', self.devices, self.path)
+        # Pages of this session have to be processed again
+        self._processed_live = []
+        live_processing = ('postprocess' in self.config.keys()
+                           and 'live' in self.config['postprocess'].keys()
+                           and self.config['postprocess']['live'].get(bool))
+        if live_processing and self._live_pipeline is None:
+            self._start_live_processing()
         self._run_hook('start_trigger_loop', self.capture)
         self.prepared = True
         self.active = True
@@ -227,33 +562,189 @@ class Workflow(object):
                 'parallel_capture' in self.config['device'].keys()
                 and self.config['device']['parallel_capture'].get()
             )
+            pipelined_capture = (
+                'pipelined_capture' in self.config['device'].keys()
+                and self.config['device']['pipelined_capture'].get()
+            )
             num_devices = len(self.devices)
+            self._raise_completion_error()
+            # Count the images from earlier sessions before adding new ones
+            if self._pages_shot is None:
+                self._pages_shot = len(self._image_index)
 
             # Abort when there is little free space
             if get_free_space(self.path) < 50*(1024**2):
                 raise IOError("Insufficient disk space to take a capture.")
 
             if retake:
+                # The images to be retaken have to be on disk first
+                self._wait_for_completion()
+                self._raise_completion_error()
                 # Remove last n images, where n == len(self.devices)
-                map(lambda x: x.unlink(), self.images[-num_devices:])
-
+                retaken = self._image_index.last(num_devices)
+                if self._live_pipeline is not None:
+                    # Plugins must not write results for the old images
+                    # after they have been removed
+                    for image in retaken:
+                        self._live_pipeline.discard(image)
+                self._image_index.remove(*retaken)
+
+            if pipelined_capture:
+                self._acquire_completion_slot()
+
+            # NOTE: All filenames have to be determined before the first
+            #       device starts writing, otherwise the next filename for
+            #       the other device could be derived from its freshly
+            #       written image.
+            img_paths = [self._get_next_filename(dev.target_page)
+                         for dev in self.devices]
+            with self._pending_lock:
+                self._pending_captures.extend(img_paths)
             futures = []
-            with ThreadPoolExecutor(num_devices
-                                    if parallel_capture else 1) as executor:
-                self._logger.debug("Sending capture command to devices")
-                for dev in self.devices:
-                    img_path = self._get_next_filename(dev.target_page)
-                    futures.append(executor.submit(dev.capture, img_path))
+            mtime_before = self._image_index.mtime
+            try:
+                with ThreadPoolExecutor(num_devices if parallel_capture
+                                        else 1) as executor:
+                    self._logger.debug("Sending capture command to devices")
+                    for dev, img_path in zip(self.devices, img_paths):
+                        futures.append(executor.submit(dev.capture,
+                                                       img_path))
+                check_futures_exceptions(futures)
+            except:
+                self._release_pending(img_paths, pipelined_capture)
+                raise
+            # Lets the index trust the images without rescanning
+            change = (mtime_before, self._image_index.mtime)
+
+            if pipelined_capture:
+                self._logger.debug("Completing capture in the background")
+                self._completion_executor.submit(
+                    self._complete_capture_pipelined, img_paths, retake,
+                    change)
+            else:
+                self._complete_capture(img_paths, retake, change)
+
+    def _complete_capture(self, img_paths, retake, change, pipelined=False):
+        try:
+            with ThreadPoolExecutor(len(img_paths)) as executor:
+                futures = [executor.submit(dev.complete_capture, img_path)
+                           for dev, img_path in zip(self.devices, img_paths)]
             check_futures_exceptions(futures)
+            images = sorted(
+                filter(None, (self._image_index.add_capture(img_path, change)
+                              for img_path in img_paths)))
 
             self._run_hook('capture', self.devices, self.path)
             if not retake:
                 self.pages_shot += len(self.devices)
+        finally:
+            self._release_pending(img_paths, pipelined)
+        self.on_capture_executed.send(self, images=images)
 
-            self.on_capture_executed.send(self,
-                                          images=self.images[-num_devices:])
+    def _complete_capture_pipelined(self, img_paths, retake, change):
+        try:
+            self._complete_capture(img_paths, retake, change, pipelined=True)
+        except Exception as e:
+            self._logger.error("Could not complete capture of {0}"
+                               .format(", ".join(x.name for x in img_paths)),
+                               exc_info=True)
+            # Will be raised on the next call to `capture` or
+            # `finish_capture`
+            self._completion_error = e
+
+    def _start_live_processing(self):
+        """ Start processing pages as soon as they were captured.
+
+        Only the plugins that can process single pages and that come before
+        any other postprocessing plugin are run during capture, the remaining
+        plugins have to wait for :py:meth:`process`.
+        """
+        segments = self._get_process_segments()
+        if (not segments or not segments[0][0]
+                or segments[0][1][0].page_barrier):
+            self._logger.info("None of the postprocessing plugins can run "
+                              "during capture.")
+            return
+        self._live_plugins = segments[0][1]
+        self._logger.info("Processing pages with {0} during capture"
+                          .format(", ".join(x.__name__
+                                            for x in self._live_plugins)))
+        for plug in self._live_plugins:
+            plug.prepare_process(self.path)
+        # NOTE: The queues are unbounded, so that the completion of a
+        #       capture never has to wait for postprocessing.
+        self._update_job_budget()
+        self._live_pipeline = PagePipeline(self.path, self._live_plugins,
+                                           queue_size=0)
+        self._live_pipeline.start()
+        # Pick up images from earlier capture sessions
+        for image in self.images:
+            self._live_pipeline.put(image)
+        self.on_capture_executed.connect(self._feed_live_pipeline,
+                                         sender=self)
+
+    def _feed_live_pipeline(self, sender, images):
+        pipeline = self._live_pipeline
+        if pipeline is None:
+            return
+        # Retaken images are submitted again, which invalidates the work
+        # that is still in progress for the previous image.
+        for image in images:
+            pipeline.put(image)
+
+    def _finish_live_processing(self):
+        """ Wait for the pages that were submitted during capture and let
+            the plugins that processed them finish.
+        """
+        if self._live_pipeline is None:
+            return
+        self.on_capture_executed.disconnect(self._feed_live_pipeline,
+                                            sender=self)
+        pipeline, self._live_pipeline = self._live_pipeline, None
+        plugins, self._live_plugins = self._live_plugins, []
+        pipeline.close()
+        self._logger.debug("Waiting for pages that were submitted during "
+                           "capture")
+        pipeline.join()
+        for plug in plugins:
+            plug.finish_process(self.path)
+        self._processed_live = plugins
+
+    def _acquire_completion_slot(self):
+        if self._completion_executor is None:
+            max_pending = (
+                self.config['device']['max_pending_captures'].get(int)
+                if 'max_pending_captures' in self.config['device'].keys()
+                else 2)
+            self._completion_slots = threading.BoundedSemaphore(max_pending)
+            # A single worker ensures that captures are completed in order
+            self._completion_executor = ThreadPoolExecutor(1)
+        self._completion_slots.acquire()
+
+    def _release_pending(self, img_paths, pipelined):
+        with self._pending_lock:
+            for img_path in img_paths:
+                self._pending_captures.remove(img_path)
+        if pipelined:
+            self._completion_slots.release()
+
+    def _wait_for_completion(self):
+        """ Block until all captures that are completed in the background
+            are done.
+        """
+        if self._completion_executor is not None:
+            self._completion_executor.shutdown(wait=True)
+            self._completion_executor = None
+            self._completion_slots = None
+
+    def _raise_completion_error(self):
+        if self._completion_error is not None:
+            exc, self._completion_error = self._completion_error, None
+            raise exc
 
     def finish_capture(self):
+        with self._capture_lock:
+            self._wait_for_completion()
         self.step_done = True
         with ThreadPoolExecutor(len(self.devices)) as executor:
             futures = []
@@ -263,14 +754,26 @@ class Workflow(object):
         check_futures_exceptions(futures)
         self._run_hook('finish_capture', self.devices, self.path)
         self._run_hook('stop_trigger_loop')
+        # Plugins may still be rewriting images, so the remaining pages
+        # have to be processed before capturing can resume or we can exit
+        self._finish_live_processing()
         self.prepared = False
         self.active = False
+        self._raise_completion_error()
 
     def process(self):
         self.step = 'process'
         self.step_done = False
         self._logger.info("Starting postprocessing...")
-        self._run_hook('process', self.path)
+        self._update_job_budget()
+        use_pipeline = ('postprocess' in self.config.keys()
+                        and 'pipeline' in self.config['postprocess'].keys()
+                        and self.config['postprocess']['pipeline'].get(bool))
+        if (use_pipeline or self._live_pipeline is not None
+                or self._processed_live):
+            self._run_process_pipeline()
+        else:
+            self._run_hook('process', self.path)
         self._logger.info("Done with postprocessing!")
         self.step_done = True
 
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import threading
 
-from concurrent import futures
 from jpegtran import JPEGImage
 
-from spreads.plugin import HookPlugin, ProcessHookMixin
+from spreads.plugin import HookPlugin, PageProcessHookMixin
+from spreads.util import (check_futures_exceptions, get_exif_orientation,
+                          scheduler)
 
 logger = logging.getLogger('spreadsplug.autorotate')
 
@@ -23,24 +26,104 @@ def autorotate_image(path):
     rotated.save(path)
 
 
-class AutoRotatePlugin(HookPlugin, ProcessHookMixin):
+class AutoRotatePlugin(HookPlugin, PageProcessHookMixin):
     __name__ = 'autorotate'
 
-    def _get_progress_callback(self, idx, num_total):
-        return lambda x: self.on_progressed.send(
-            self,
-            progress=float(idx)/num_total)
+    def __init__(self, config):
+        super(AutoRotatePlugin, self).__init__(config)
+        # Size and modification time of images that are known to be upright,
+        # by file name
+        self._manifest = {}
+        self._manifest_lock = threading.Lock()
+
+    def _get_manifest_path(self, path):
+        return path / '.cache' / 'autorotate.json'
+
+    def _load_manifest(self, path):
+        manifest_path = self._get_manifest_path(path)
+        self._manifest = {}
+        if not manifest_path.exists():
+            return
+        try:
+            with manifest_path.open('r') as fp:
+                self._manifest = json.load(fp)
+        except ValueError:
+            logger.warning("Could not read autorotate manifest, checking all "
+                           "images.")
+
+    def _save_manifest(self, path):
+        manifest_path = self._get_manifest_path(path)
+        if not manifest_path.parent.exists():
+            manifest_path.parent.mkdir()
+        with self._manifest_lock:
+            with manifest_path.open('wb') as fp:
+                json.dump(self._manifest, fp)
+
+    def _get_signature(self, imgpath):
+        stat = imgpath.stat()
+        return [stat.st_mtime, stat.st_size]
+
+    def _needs_rotation(self, imgpath):
+        """ Check if an image has to be rotated, by looking at the manifest
+            and the EXIF header only.
+        """
+        if imgpath.suffix.lower() not in ('.jpg', '.jpeg'):
+            return False
+        signature = self._get_signature(imgpath)
+        with self._manifest_lock:
+            if self._manifest.get(imgpath.name) == signature:
+                return False
+        orientation = get_exif_orientation(unicode(imgpath))
+        if orientation is None:
+            logger.warn("Image {0} did not have any EXIF rotation, did not "
+                        "rotate.".format(imgpath))
+        elif orientation != 1:
+            return True
+        self._mark_upright(imgpath, signature)
+        return False
+
+    def _mark_upright(self, imgpath, signature=None):
+        if signature is None:
+            signature = self._get_signature(imgpath)
+        with self._manifest_lock:
+            self._manifest[imgpath.name] = signature
+
+    def _rotate(self, imgpath):
+        autorotate_image(unicode(imgpath))
+        self._mark_upright(imgpath)
 
     def process(self, path):
         img_dir = path / 'raw'
         logger.info("Rotating images in {0}".format(img_dir))
-        with futures.ProcessPoolExecutor() as executor:
-            files = sorted(img_dir.iterdir())
-            num_total = len(files)
-            for (idx, imgpath) in enumerate(files):
-                if imgpath.suffix.lower() not in ('.jpg', '.jpeg'):
-                    continue
-                future = executor.submit(autorotate_image, unicode(imgpath))
-                future.add_done_callback(
-                    self._get_progress_callback(idx, num_total)
-                )
+        self._load_manifest(path)
+        todo = [x for x in sorted(img_dir.iterdir())
+                if self._needs_rotation(x)]
+        logger.debug("{0} images have to be rotated".format(len(todo)))
+        progress_lock = threading.Lock()
+        num_done = [0]
+
+        def _progress(future):
+            with progress_lock:
+                num_done[0] += 1
+                self.on_progressed.send(
+                    self, progress=float(num_done[0])/len(todo))
+
+        try:
+            with scheduler.executor() as executor:
+                futures = [executor.submit(self._rotate, imgpath)
+                           for imgpath in todo]
+                for future in futures:
+                    future.add_done_callback(_progress)
+            check_futures_exceptions(futures)
+        finally:
+            self._save_manifest(path)
+
+    def prepare_process(self, path):
+        self._load_manifest(path)
+
+    def process_page(self, path, raw_image):
+        if self._needs_rotation(raw_image):
+            self._rotate(raw_image)
+
+    def finish_process(self, path):
+        self._save_manifest(path)
@@ -1,25 +1,282 @@
 # -*- coding: utf-8 -*-
+import Queue
 import logging
 import os
 import re
 import subprocess
 import tempfile
+import threading
 import time
 from fractions import Fraction
-from itertools import chain
+from itertools import chain, count
 
 import usb
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from jpegtran import JPEGImage
 from spreads.vendor.pathlib import Path
 
 from spreads.plugin import DevicePlugin, PluginOption, DeviceFeatures
-from spreads.util import DeviceException
+from spreads.util import DeviceException, set_exif_orientation
+
+logger = logging.getLogger('spreadsplug.dev.chdkcamera')
+
+#: Seconds to wait for commands that can take a long time on the camera,
+#: like Lua scripts or remote shooting
+LONG_COMMAND_TIMEOUT = 256
 
 
 class CHDKPTPException(Exception):
     pass
 
 
+def flatten_lua(script):
+    """ Join the lines of a Lua script into a single line.
+
+    Comments are removed, since a line comment would otherwise extend over
+    all of the code that follows it.
+
+    :param script:  Lua script
+    :type script:   unicode
+    :rtype:         unicode
+    """
+    output = []
+    quote = None
+    idx = 0
+    while idx < len(script):
+        char = script[idx]
+        if quote is not None:
+            if char == "\\":
+                output.append(script[idx:idx+2])
+                idx += 2
+                continue
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif script.startswith("--", idx):
+            if script.startswith("--[[", idx):
+                end = script.find("]]", idx)
+                idx = len(script) if end == -1 else end+2
+                output.append(" ")
+            else:
+                end = script.find("\n", idx)
+                idx = len(script) if end == -1 else end
+            continue
+        output.append(" " if char == "\n" else char)
+        idx += 1
+    return "".join(output)
+
+
+class LuaBatch(object):
+    """ A sequence of Lua statements that is executed on the camera in a
+        single round trip.
+
+    Statements are compiled into a single chunk that collects the results
+    of all named calls in a table, which is returned to the host once the
+    whole chunk has run.
+
+    """
+    # NOTE: Booleans are converted to integers, since our parser for Lua
+    #       tables only understands integers and strings.
+    _prelude = ("local _r = {} "
+                "local function _v(x) "
+                "if type(x) == \"boolean\" then return x and 1 or 0 end "
+                "return x end")
+
+    def __init__(self):
+        self._statements = []
+        self._result_names = []
+
+    def __len__(self):
+        return len(self._statements)
+
+    @property
+    def has_results(self):
+        return bool(self._result_names)
+
+    def add(self, statement):
+        """ Add a statement whose result is not of interest.
+
+        :param statement:   Lua statement(s)
+        :type statement:    unicode
+        :return:            The batch itself, for chaining
+        """
+        self._statements.append(flatten_lua(statement))
+        return self
+
+    def call(self, expression, name):
+        """ Add an expression whose result will be returned under `name`.
+
+        :param expression:  Lua expression
+        :type expression:   unicode
+        :param name:        Key of the result in the returned dictionary,
+                            must be a valid Lua identifier
+        :type name:         unicode
+        :return:            The batch itself, for chaining
+        """
+        if name in self._result_names:
+            raise ValueError("Duplicate result name: {0}".format(name))
+        self._result_names.append(name)
+        self._statements.append("_r.{0} = _v({1})".format(name, expression))
+        return self
+
+    def sleep(self, seconds):
+        """ Add a pause to the batch.
+
+        :param seconds:     Duration of the pause
+        :type seconds:      float
+        :return:            The batch itself, for chaining
+        """
+        self._statements.append("sleep({0:.0f})".format(seconds*1000))
+        return self
+
+    def compile(self):
+        """ Compile the batch into a single Lua chunk.
+
+        :rtype: unicode
+        """
+        return "; ".join(chain((self._prelude,), self._statements,
+                               ("return _r",)))
+
+
+class CHDKPTPSession(object):
+    """ A long-running chdkptp process that receives its commands through
+        the interactive command line.
+
+    Every batch of commands is followed by a marker that is printed by the
+    chdkptp process once it has worked through the batch, which allows us
+    to tell apart the output of consecutive calls. If the process dies, it
+    is restarted on the next call.
+
+    :param cmd_args:    Arguments to start chdkptp with, including the
+                        path to the binary
+    :type cmd_args:     list(unicode)
+    :param env:         Environment for the chdkptp process
+    :type env:          dict
+    :param timeout:     Default number of seconds to wait for a batch of
+                        commands to finish
+    :type timeout:      float
+    """
+    _prompt_re = re.compile(r'^(?:(?:con|___)[^>]*> ?)+')
+
+    def __init__(self, cmd_args, env=None, timeout=30):
+        self.logger = logging.getLogger('CHDKPTPSession')
+        self.timeout = timeout
+        self._cmd_args = list(cmd_args) + ['-i']
+        self._env = env
+        self._lock = threading.Lock()
+        self._process = None
+        self._output = None
+        self._marker_counter = count()
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """ Start the chdkptp process. """
+        self.logger.debug("Starting chdkptp session with arguments: {0}"
+                          .format(self._cmd_args))
+        self._process = subprocess.Popen(
+            self._cmd_args, env=self._env, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        self._output = Queue.Queue()
+        reader = threading.Thread(target=self._read_output,
+                                  args=(self._process.stdout, self._output))
+        reader.daemon = True
+        reader.start()
+
+    def close(self):
+        """ Shut down the chdkptp process.
+
+        Waits for commands that are currently running to finish.
+        """
+        with self._lock:
+            process, self._process = self._process, None
+        if process is None or process.poll() is not None:
+            return
+        self.logger.debug("Closing chdkptp session")
+        try:
+            process.stdin.write(b"quit\n")
+            process.stdin.flush()
+        except IOError:
+            pass
+        for _ in xrange(10):
+            if process.poll() is not None:
+                return
+            time.sleep(0.1)
+        process.kill()
+
+    def execute(self, *commands, **kwargs):
+        """ Run one or more commands and return their output.
+
+        :param commands:    chdkptp CLI commands
+        :type commands:     unicode
+        :param timeout:     Seconds to wait for the commands to finish,
+                            defaults to the session timeout
+        :type timeout:      float
+        :return:            The lines that were output by the commands
+        :rtype:             list(unicode)
+        """
+        timeout = kwargs.get('timeout', self.timeout)
+        with self._lock:
+            if not self.running:
+                if self._process is not None:
+                    self.logger.warning("chdkptp session has died, "
+                                        "restarting.")
+                self.start()
+            marker = "--spreads-{0}--".format(next(self._marker_counter))
+            # NOTE: The interactive command line works line by line, so
+            #       commands that span multiple lines (e.g. Lua scripts)
+            #       have to be flattened.
+            lines = [flatten_lua(cmd) if "\n" in cmd else cmd
+                     for cmd in commands]
+            lines.append("!print('{0}')".format(marker))
+            try:
+                self._process.stdin.write(
+                    "".join(x + "\n" for x in lines).encode('utf-8'))
+                self._process.stdin.flush()
+            except IOError:
+                self._kill()
+                raise CHDKPTPException("Lost connection to chdkptp session.")
+            return self._read_until(marker, timeout)
+
+    def _read_until(self, marker, timeout):
+        output = []
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self._output.get(
+                    timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                self._kill()
+                raise CHDKPTPException(
+                    "chdkptp did not respond within {0} seconds."
+                    .format(timeout))
+            if line is None:
+                self._kill()
+                raise CHDKPTPException(
+                    "chdkptp exited unexpectedly:\n{0}"
+                    .format("\n".join(output)))
+            line = self._prompt_re.sub('', line)
+            if line == marker:
+                return output
+            output.append(line)
+
+    def _kill(self):
+        process, self._process = self._process, None
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def _read_output(self, stream, queue):
+        for line in iter(stream.readline, b''):
+            queue.put(line.decode('utf-8', 'replace').rstrip("\r\n"))
+        queue.put(None)
+
+
 class CHDKCameraDevice(DevicePlugin):
     """ Plugin for digital cameras running the CHDK firmware.
 
@@ -48,6 +305,11 @@ class CHDKCameraDevice(DevicePlugin):
              'chdkptp_path': PluginOption(
                  u"/usr/local/lib/chdkptp",
                  "Path to CHDKPTP binary/libraries"),
+             'persistent_session': PluginOption(
+                 True, "Keep a chdkptp session open instead of starting "
+                       "chdkptp for every command"),
+             'init_timeout': PluginOption(
+                 30.0, "Seconds to wait for a camera to initialize"),
              })
         return conf
 
@@ -55,6 +317,11 @@ class CHDKCameraDevice(DevicePlugin):
     def yield_devices(cls, config):
         """ Search for usable devices, yield one at a time
 
+        All detected cameras are initialized concurrently. Cameras that
+        fail to initialize or take longer than `init_timeout` seconds are
+        skipped with a warning, if none of them can be initialized, a
+        :py:class:`spreads.util.DeviceException` is raised.
+
         :param config:  spreads configuration
         :type config:   spreads.confit.ConfigView
         """
@@ -62,6 +329,7 @@ class CHDKCameraDevice(DevicePlugin):
             # (idVendor, idProduct): SpecialClass
             (0x4a9, 0x322a): CanonA2200CameraDevice,
         }
+        candidates = []
         for dev in usb.core.find(find_all=True):
             cfg = dev.get_active_configuration()[(0, 0)]
             ids = (dev.idVendor, dev.idProduct)
@@ -69,10 +337,39 @@ class CHDKCameraDevice(DevicePlugin):
                       and hex(cfg.bInterfaceSubClass) == "0x1")
             if not is_ptp:
                 continue
-            if ids in SPECIAL_CASES:
-                yield SPECIAL_CASES[ids](config, dev)
-            else:
-                yield cls(config, dev)
+            candidates.append((SPECIAL_CASES.get(ids, cls), dev))
+        if not candidates:
+            return
+
+        timeout = config['init_timeout'].get(float)
+        executor = ThreadPoolExecutor(len(candidates))
+        futures = [executor.submit(dev_cls, config, dev)
+                   for dev_cls, dev in candidates]
+        # Don't block on cameras that are still hanging, they will be
+        # cleaned up once their initialization returns
+        executor.shutdown(wait=False)
+        deadline = time.time() + timeout
+        errors = []
+        for (dev_cls, dev), future in zip(candidates, futures):
+            port = "{0:03}:{1:03}".format(dev.bus, dev.address)
+            try:
+                yield future.result(timeout=max(deadline - time.time(), 0))
+            except TimeoutError:
+                future.add_done_callback(cls._discard_device)
+                errors.append("Camera at {0} did not initialize within {1} "
+                              "seconds".format(port, timeout))
+                logger.warning(errors[-1])
+            except Exception as e:
+                errors.append("Camera at {0} could not be initialized: {1}"
+                              .format(port, e))
+                logger.warning(errors[-1])
+        if len(errors) == len(candidates):
+            raise DeviceException("\n".join(errors))
+
+    @staticmethod
+    def _discard_device(future):
+        if future.exception() is None:
+            future.result()._close_session()
 
     def __init__(self, config, device):
         """ Set connection information and try to obtain target page.
@@ -99,6 +396,10 @@ class CHDKCameraDevice(DevicePlugin):
         self._shoot_raw = config['shoot_raw'].get(bool)
         self._focus_distance = config['focus_distance'].get()
         self._shoot_monochrome = config['monochrome'].get()
+        self._persistent_session = config['persistent_session'].get(bool)
+        self._session = None
+        self._new_usbport = None
+        self._port_lock = threading.Lock()
 
         self._cli_flags = []
         self._cli_flags.append("-c-d={1:03} -b={0:03}".format(*self._usbport))
@@ -138,8 +439,10 @@ class CHDKCameraDevice(DevicePlugin):
         if new_device is None:
             return False
 
-        self._usbport = (new_device.bus, new_device.address)
-        self._cli_flags[0] = ("-c-d={1:03} -b={0:03}".format(*self._usbport))
+        # NOTE: This might be called from a background thread while a
+        #       command is running, so we only remember the new port and
+        #       switch to it before the next command.
+        self._new_usbport = (new_device.bus, new_device.address)
         return True
 
     def set_target_page(self, target_page):
@@ -156,29 +459,21 @@ class CHDKCameraDevice(DevicePlugin):
         os.remove(tmp_handle[1])
 
     def prepare_capture(self, path):
-        # Try to go into alt mode to prevent weird behaviour
-        self._execute_lua("enter_alt()")
-        # Try to put into record mode
-        try:
-            self._run("rec")
-        except CHDKPTPException as e:
-            self.logger.debug(e)
-            self.logger.info("Camera already seems to be in recording mode")
-        self._set_zoom(self._zoom_level)
+        self._enter_rec_mode()
+        batch = LuaBatch()
+        batch.add(self._zoom_script(self._zoom_level))
         # Disable flash
-        self._execute_lua("while(get_flash_mode()<2) do click(\"right\") end")
+        batch.add("while(get_flash_mode()<2) do click(\"right\") end")
         # Disable ND filter
-        self._execute_lua("set_nd_filter(2)")
-        self._set_focus()
+        batch.add("set_nd_filter(2)")
+        self._add_focus_steps(batch)
         if self._shoot_monochrome:
-            rv = self._execute_lua(
-                "capmode = require(\"capmode\")\n"
-                "return capmode.set(\"SCN_MONOCHROME\")",
-                get_result=True
-            )
-            if not rv:
-                logger.warn("Monochrome mode not supported on this device, "
-                            "will be disabled.")
+            batch.add("capmode = require(\"capmode\")")
+            batch.call("capmode.set(\"SCN_MONOCHROME\")", 'monochrome')
+        results = self._execute_batch(batch)
+        if self._shoot_monochrome and not results.get('monochrome'):
+            self.logger.warn("Monochrome mode not supported on this device, "
+                             "will be disabled.")
 
     def finish_capture(self):
         # Switch camera back to play mode.
@@ -207,7 +502,7 @@ class CHDKCameraDevice(DevicePlugin):
                    .format(self._shutter_speed, self._sensitivity*0.65,
                            int(self._shoot_raw), path))
         try:
-            self._run(cmd)
+            self._run(cmd, timeout=LONG_COMMAND_TIMEOUT)
         except CHDKPTPException as e:
             if 'not in rec mode' in e.message:
                 self.prepare_capture(None)
@@ -216,15 +511,26 @@ class CHDKCameraDevice(DevicePlugin):
                 self.logger.warn("Capture command failed.")
                 raise e
 
+    def complete_capture(self, path):
         extension = 'dng' if self._shoot_raw else 'jpg'
         local_path = "{0}.{1}".format(path, extension)
+        if self.target_page == 'odd':
+            orientation = 6  # -90°
+        else:
+            orientation = 8  # 90°
         # Set EXIF orientation
         self.logger.debug("Setting EXIF orientation on captured image")
+        # NOTE: Patching the tag in place avoids rewriting the whole image,
+        #       which is slow on SD cards.
+        if set_exif_orientation(local_path, orientation):
+            return
+        if self._shoot_raw:
+            self.logger.warn("Image {0} has no EXIF orientation, could not "
+                             "set it.".format(local_path))
+            return
+        self.logger.debug("Image has no EXIF orientation, re-saving it.")
         img = JPEGImage(local_path)
-        if self.target_page == 'odd':
-            img.exif_orientation = 6  # -90°
-        else:
-            img.exif_orientation = 8  # 90°
+        img.exif_orientation = orientation
         img.save(local_path)
 
     def show_textbox(self, message):
@@ -240,16 +546,35 @@ class CHDKCameraDevice(DevicePlugin):
         )
         self._execute_lua("\n".join(script), wait=False, get_result=False)
 
-    def _run(self, *commands):
-        cmd_args = list(chain((unicode(self._chdkptp_path / "chdkptp"),),
-                              self._cli_flags,
-                              ("-e{0}".format(cmd) for cmd in commands)))
+    def _run(self, *commands, **kwargs):
+        """ Run chdkptp commands on the device.
+
+        :param commands:    chdkptp CLI commands
+        :type commands:     unicode
+        :param timeout:     Seconds to wait for the commands to finish when
+                            using a persistent session, defaults to the
+                            session's timeout
+        :type timeout:      float
+        :return:            Output of the commands
+        :rtype:             list(unicode)
+        """
+        self._switch_usbport()
+        base_args = list(chain((unicode(self._chdkptp_path / "chdkptp"),),
+                               self._cli_flags))
         env = {'LUA_PATH': unicode(self._chdkptp_path / "lua/?.lua")}
-        self.logger.debug("Calling chdkptp with arguments: {0}"
-                          .format(cmd_args))
-        output = (subprocess.check_output(cmd_args, env=env,
-                                          stderr=subprocess.STDOUT)
-                  .splitlines())
+        if self._persistent_session:
+            if self._session is None:
+                self._session = CHDKPTPSession(base_args, env=env)
+            self.logger.debug("Sending commands to chdkptp session: {0}"
+                              .format(commands))
+            output = self._session.execute(*commands, **kwargs)
+        else:
+            cmd_args = base_args + ["-e{0}".format(cmd) for cmd in commands]
+            self.logger.debug("Calling chdkptp with arguments: {0}"
+                              .format(cmd_args))
+            output = (subprocess.check_output(cmd_args, env=env,
+                                              stderr=subprocess.STDOUT)
+                      .splitlines())
         self.logger.debug("Call returned:\n{0}".format(output))
         # Filter out connected message
         output = [x for x in output if not x.startswith('connected:')]
@@ -258,18 +583,53 @@ class CHDKCameraDevice(DevicePlugin):
             raise CHDKPTPException("\n".join(output))
         return output
 
-    def _execute_lua(self, script, wait=True, get_result=False, timeout=256):
+    def _switch_usbport(self):
+        with self._port_lock:
+            new_port, self._new_usbport = self._new_usbport, None
+            if new_port is None or new_port == self._usbport:
+                return
+            self.logger.debug("Device moved to USB port {0}, reconnecting"
+                              .format(new_port))
+            self._usbport = new_port
+            self._cli_flags[0] = ("-c-d={1:03} -b={0:03}"
+                                  .format(*self._usbport))
+            # The session is still connected to the old port
+            self._close_session()
+
+    def _close_session(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _execute_batch(self, batch):
+        """ Execute a :py:class:`LuaBatch` in a single round trip.
+
+        :param batch:   The batch to execute
+        :type batch:    :py:class:`LuaBatch`
+        :return:        The results of the named calls in the batch
+        :rtype:         dict
+        """
+        if not batch:
+            return {}
+        script = batch.compile()
+        if not batch.has_results:
+            self._execute_lua(script, wait=True)
+            return {}
+        return self._execute_lua(script, get_result=True) or {}
+
+    def _execute_lua(self, script, wait=True, get_result=False,
+                     timeout=LONG_COMMAND_TIMEOUT):
         if get_result and not "return" in script:
             script = "return({0})".format(script)
         cmd = "luar" if wait else "lua"
-        output = self._run("{0} {1}".format(cmd, script))
+        output = self._run("{0} {1}".format(cmd, script), timeout=timeout)
         if not get_result:
             return
         output = [x for x in output if x.find(":return:")][0]
         return self._parse_lua_output(output)
 
     def _parse_table(self, data):
-        values = dict(re.findall(r'([\w_]+?)=(\d+|".*?"),*', data[6:]))
+        values = dict(re.findall(r'([\w_]+?)=(-?\d+|".*?"),*', data[6:]))
         for k, v in values.iteritems():
             if v.startswith('"') and v.endswith('"'):
                 values[k] = v.strip('"')  # String
@@ -302,14 +662,8 @@ class CHDKCameraDevice(DevicePlugin):
             raise ValueError("Could not read OWN.TXT")
         return target_page
 
-    def _set_zoom(self, level):
-        if level >= self._zoom_steps:
-            raise ValueError("Zoom level {0} exceeds the camera's range!"
-                             " (max: {1})".format(level, self._zoom_steps-1))
-        self._execute_lua("set_zoom({0})".format(level), wait=True)
-
-    def _acquire_focus(self):
-        """ Acquire auto focus and lock it. """
+    def _enter_rec_mode(self):
+        # Try to go into alt mode to prevent weird behaviour
         self._execute_lua("enter_alt()")
         # Try to put into record mode
         try:
@@ -317,25 +671,52 @@ class CHDKCameraDevice(DevicePlugin):
         except CHDKPTPException as e:
             self.logger.debug(e)
             self.logger.info("Camera already seems to be in recording mode")
-        self._set_zoom(self._zoom_level)
-        self._execute_lua("set_aflock(0)")
-        self._execute_lua("press('shoot_half')")
-        time.sleep(0.8)
-        self._execute_lua("release('shoot_half')")
-        time.sleep(0.5)
-        return self._execute_lua("get_focus()", get_result=True)
 
-    def _set_focus(self):
-        self._execute_lua("set_aflock(0)")
+    def _zoom_script(self, level):
+        """ Get the Lua code to set the zoom level.
+
+        :param level: The zoom level to be used
+        :type level:  int
+        :rtype:       unicode
+
+        """
+        if level >= self._zoom_steps:
+            raise ValueError("Zoom level {0} exceeds the camera's range!"
+                             " (max: {1})".format(level, self._zoom_steps-1))
+        return "set_zoom({0})".format(level)
+
+    def _set_zoom(self, level):
+        self._execute_lua(self._zoom_script(level), wait=True)
+
+    def _acquire_focus(self):
+        """ Acquire auto focus and lock it. """
+        self._enter_rec_mode()
+        batch = (LuaBatch()
+                 .add(self._zoom_script(self._zoom_level))
+                 .add("set_aflock(0)")
+                 .add("press('shoot_half')")
+                 .sleep(0.8)
+                 .add("release('shoot_half')")
+                 .sleep(0.5)
+                 .call("get_focus()", 'focus'))
+        return self._execute_batch(batch).get('focus')
+
+    def _add_focus_steps(self, batch):
+        batch.add("set_aflock(0)")
         if self._focus_distance == 0:
             return
-        self._execute_lua("set_focus({0:.0f})".format(self._focus_distance))
-        time.sleep(0.5)
-        self._execute_lua("press('shoot_half')")
-        time.sleep(0.25)
-        self._execute_lua("release('shoot_half')")
-        time.sleep(0.25)
-        self._execute_lua("set_aflock(1)")
+        (batch.add("set_focus({0:.0f})".format(self._focus_distance))
+              .sleep(0.5)
+              .add("press('shoot_half')")
+              .sleep(0.25)
+              .add("release('shoot_half')")
+              .sleep(0.25)
+              .add("set_aflock(1)"))
+
+    def _set_focus(self):
+        batch = LuaBatch()
+        self._add_focus_steps(batch)
+        self._execute_batch(batch)
 
 
 class CanonA2200CameraDevice(CHDKCameraDevice):
@@ -357,8 +738,8 @@ class CanonA2200CameraDevice(CHDKCameraDevice):
         # chdk 1.3, this is why we stub it out here.
         pass
 
-    def _set_zoom(self, level):
-        """ Set zoom level.
+    def _zoom_script(self, level):
+        """ Get the Lua code to set the zoom level.
 
             The A2200 currently has a bug, where setting the zoom level
             directly via set_zoom crashes the camera quite frequently, so
@@ -366,18 +747,16 @@ class CanonA2200CameraDevice(CHDKCameraDevice):
 
         :param level: The zoom level to be used
         :type level:  int
+        :rtype:       unicode
 
         """
         if level >= self._zoom_steps:
             raise ValueError(
                 "Zoom level {0} exceeds the camera's range!"
                 " (max: {1})".format(level, self._zoom_steps-1))
-        zoom = self._execute_lua("get_zoom()", get_result=True)
-        if zoom < level:
-            self._execute_lua("while(get_zoom()<{0}) do click(\"zoom_in\") end"
-                              .format(level+1),
-                              wait=True)
-        elif zoom > level:
-            self._execute_lua("while(get_zoom()>{0}) "
-                              "do click(\"zoom_out\") end".format(level+1),
-                              wait=True)
+        return ("local zoom = get_zoom() "
+                "if zoom < {0} then "
+                "while(get_zoom()<{1}) do click(\"zoom_in\") end "
+                "elseif zoom > {0} then "
+                "while(get_zoom()>{1}) do click(\"zoom_out\") end "
+                "end".format(level, level+1))
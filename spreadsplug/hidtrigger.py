@@ -1,64 +1,178 @@
-import hidapi
+import errno
 import logging
+import os
+import re
+import select
 import threading
 import time
+from glob import glob
+from itertools import chain
 
-from spreads.plugin import HookPlugin, TriggerHooksMixin
+from spreads.plugin import HookPlugin, PluginOption, TriggerHooksMixin
 from spreads.util import DeviceException
 
 
+class _ButtonState(object):
+    """ Debouncing state machine for a single HID device.
+
+    A capture is triggered once the device has reported a press (a report
+    with at least one non-zero byte) followed by a release (a report with
+    only zero bytes). Presses that follow less than `debounce_time` seconds
+    after the last release are ignored.
+
+    """
+    RELEASED, PRESSED = 0, 1
+
+    def __init__(self, debounce_time):
+        self.debounce_time = debounce_time
+        self.state = self.RELEASED
+        self._last_release = None
+
+    def feed(self, report, now):
+        """ Process a report from the device.
+
+        :param report:  Raw HID report
+        :type report:   str
+        :param now:     Time the report was received
+        :type now:      float
+        :return:        Whether a full press->release cycle was completed
+        :rtype:         bool
+        """
+        pressed = any(ord(c) for c in report)
+        if self.state == self.RELEASED and pressed:
+            bouncing = (self._last_release is not None and
+                        now - self._last_release < self.debounce_time)
+            if not bouncing:
+                self.state = self.PRESSED
+        elif self.state == self.PRESSED and not pressed:
+            self.state = self.RELEASED
+            self._last_release = now
+            return True
+        return False
+
+
 class HidTrigger(HookPlugin, TriggerHooksMixin):
     __name__ = 'hidtrigger'
 
     _loop_thread = None
-    _exit_event = None
+    _wakeup_pipe = None
+
+    @classmethod
+    def configuration_template(cls):
+        return {
+            'devices': PluginOption(
+                "", "Comma-separated list of vendor:product IDs (in hex, "
+                    "e.g. 05f3:00ff) of devices to use, all devices are "
+                    "used if empty"),
+            'debounce_time': PluginOption(
+                0.05, "Time (in seconds) to ignore presses after a "
+                      "button was released"),
+        }
 
     def __init__(self, config):
+        super(HidTrigger, self).__init__(config)
         self._logger = logging.getLogger('spreadsplug.hidtrigger')
         self._logger.debug("Initializing HidTrigger plugin")
+        self._hid_devs = {}
 
     def start_trigger_loop(self, capture_callback):
-        self._hid_devs = []
-        for dev in self._find_devices():
-            self._logger.debug("Found HID device: {0}".format(dev))
-            self._hid_devs.append(dev)
+        self._hid_devs = {}
+        try:
+            for path, fd in self._find_devices():
+                self._logger.debug("Found HID device: {0}".format(path))
+                self._hid_devs[fd] = path
+        except DeviceException:
+            # Do not leak the devices that could already be opened
+            for fd in self._hid_devs:
+                os.close(fd)
+            self._hid_devs = {}
+            raise
         if not self._hid_devs:
             self._logger.warning("Could not find any HID devices.")
             return
-        self._exit_event = threading.Event()
+        self._wakeup_pipe = os.pipe()
         self._loop_thread = threading.Thread(target=self._trigger_loop,
                                              args=(capture_callback, ))
         self._logger.debug("Starting trigger loop")
         self._loop_thread.start()
 
     def stop_trigger_loop(self):
-        if self._exit_event is None:
+        if self._wakeup_pipe is None:
             # Return if no loop thread is running
             return
         self._logger.debug("Stopping trigger loop")
-        self._exit_event.set()
+        os.write(self._wakeup_pipe[1], b'x')
         self._loop_thread.join()
+        for fd in chain(self._hid_devs, self._wakeup_pipe):
+            os.close(fd)
+        self._hid_devs = {}
+        self._wakeup_pipe = None
 
     def _trigger_loop(self, capture_func):
-        # Polls all attached HID devices for a press->release event and
-        # trigger a capture.
-        while not self._exit_event.is_set():
-            for dev in self._hid_devs:
-                # See if there's input
-                if dev.read(8):
-                    # Wait for key release
-                    while not dev.read(8):
-                        time.sleep(0.01)
+        # Waits for reports from all attached HID devices and triggers a
+        # capture for every press->release cycle.
+        debounce_time = self.config['debounce_time'].get(float)
+        states = dict((fd, _ButtonState(debounce_time))
+                      for fd in self._hid_devs)
+        wakeup_fd = self._wakeup_pipe[0]
+        while True:
+            readable, _, _ = select.select(list(states) + [wakeup_fd], [], [])
+            if wakeup_fd in readable:
+                return
+            now = time.time()
+            for fd in readable:
+                try:
+                    report = os.read(fd, 64)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
                         continue
+                    report = None
+                if not report:
+                    self._logger.warning("HID device {0} is no longer "
+                                         "available."
+                                         .format(self._hid_devs[fd]))
+                    del states[fd]
+                    continue
+                if states[fd].feed(report, now):
                     capture_func()
-                else:
-                    time.sleep(0.01)
+
+    def _get_id_filter(self):
+        ids = set()
+        for entry in self.config['devices'].get(unicode).split(','):
+            if not entry.strip():
+                continue
+            vendor, product = entry.strip().split(':')
+            ids.add((int(vendor, 16), int(product, 16)))
+        return ids
+
+    def _get_device_ids(self, sys_path):
+        """ Get the vendor and product ID of a hidraw device.
+
+        :param sys_path:    Path to the device in `/sys/class/hidraw`
+        :type sys_path:     unicode
+        :return:            Vendor and product ID, None if they could not be
+                            determined
+        :rtype:             tuple(int, int)
+        """
+        try:
+            with open(os.path.join(sys_path, 'device', 'uevent')) as fp:
+                match = re.search(r'^HID_ID=\w+:(\w+):(\w+)$', fp.read(),
+                                  re.MULTILINE)
+        except IOError:
+            return None
+        if match is None:
+            return None
+        return tuple(int(x, 16) for x in match.groups())
 
     def _find_devices(self):
-        for candidate in hidapi.enumerate():
+        id_filter = self._get_id_filter()
+        for sys_path in sorted(glob('/sys/class/hidraw/hidraw*')):
+            if id_filter and self._get_device_ids(sys_path) not in id_filter:
+                continue
+            path = os.path.join('/dev', os.path.basename(sys_path))
             try:
-                dev = hidapi.Device(candidate, blocking=False)
-            except IOError:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
                 raise DeviceException("Could not open HID device, please check"
-                                      " your permissions on /dev/bus/usb.")
-            yield dev
+                                      " your permissions on /dev/hidraw*.")
+            yield path, fd
@@ -1,8 +1,8 @@
 import logging
 import threading
-import time
 
 from spreads.plugin import HookPlugin, PluginOption, TriggerHooksMixin
+from spreads.util import monotonic
 
 logger = logging.getLogger('spreadsplug.intervaltrigger')
 
@@ -12,14 +12,35 @@ class IntervalTrigger(HookPlugin, TriggerHooksMixin):
 
     _loop_thread = None
     _exit_event = None
+    _start_time = None
+    _num_captures = 0
 
     @classmethod
     def configuration_template(cls):
         return {'interval': PluginOption(5.0, "Interval between captures"
-                                              " (in seconds)")}
+                                              " (in seconds)"),
+                'missed_ticks': PluginOption(
+                    ['skip', 'queue'],
+                    "What to do with captures that were missed because the "
+                    "previous capture took longer than the interval",
+                    selectable=True)}
+
+    @property
+    def pages_per_hour(self):
+        """ Actual capture rate since the trigger loop was started. """
+        if self._start_time is None:
+            return None
+        elapsed = monotonic() - self._start_time
+        if not elapsed:
+            return 0.
+        return self._num_captures * 3600 / elapsed
 
     def start_trigger_loop(self, capture_callback):
         logger.debug("Starting event loop")
+        # Reset before the thread is started, so the rate of a previous loop
+        # is never reported for this one
+        self._num_captures = 0
+        self._start_time = monotonic()
         self._exit_event = threading.Event()
         self._loop_thread = threading.Thread(target=self._trigger_loop,
                                              args=(capture_callback, ))
@@ -29,14 +50,38 @@ class IntervalTrigger(HookPlugin, TriggerHooksMixin):
         logger.debug("Stopping event loop")
         self._exit_event.set()
         self._loop_thread.join()
+        interval = self.config['interval'].get(float)
+        logger.info("Captured {0} pages at {1:.1f} pages/hour (target: "
+                    "{2:.1f} pages/hour)".format(self._num_captures,
+                                                 self.pages_per_hour or 0.,
+                                                 3600 / interval))
 
     def _trigger_loop(self, capture_func):
         interval = self.config['interval'].get(float)
+        if 'missed_ticks' in self.config.keys():
+            missed_policy = self.config['missed_ticks'].get()
+        else:
+            missed_policy = 'skip'
+        # NOTE: Deadlines are calculated from the start time instead of the
+        #       time of the last capture, so that neither the duration of
+        #       the capture nor late wakeups make the interval drift.
+        next_tick = self._start_time + interval
         while True:
-            sleep_time = 0
-            while sleep_time < interval:
-                if self._exit_event.is_set():
+            remaining = next_tick - monotonic()
+            if remaining > 0:
+                if self._exit_event.wait(remaining):
                     return
-                time.sleep(0.01)
-                sleep_time += 0.01
+                # We might have woken up early
+                continue
+            if self._exit_event.is_set():
+                return
             capture_func()
+            self._num_captures += 1
+            next_tick += interval
+            missed = int((monotonic() - next_tick) // interval) + 1
+            if missed > 0 and missed_policy == 'skip':
+                logger.warning("Capture took too long, skipping {0} "
+                               "capture(s)".format(missed))
+                next_tick += missed*interval
+            logger.debug("Capturing at {0:.1f} pages/hour"
+                         .format(self.pages_per_hour))
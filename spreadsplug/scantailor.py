@@ -2,21 +2,22 @@
 
 from __future__ import division, unicode_literals
 
+import hashlib
+import json
 import logging
-import math
-import multiprocessing
+import os
 import re
 import shutil
 import subprocess
 import tempfile
-import time
-from xml.etree.cElementTree import ElementTree as ET
+from collections import defaultdict
+from xml.etree.cElementTree import ElementTree as ET, iterparse
 
-import psutil
 from spreads.vendor.pathlib import Path
 
-from spreads.plugin import HookPlugin, ProcessHookMixin, PluginOption
-from spreads.util import find_in_path, MissingDependencyException
+from spreads.plugin import HookPlugin, PageProcessHookMixin, PluginOption
+from spreads.util import (find_in_path, scheduler, DirectoryWatcher,
+                          MissingDependencyException)
 
 if not find_in_path('scantailor-cli'):
     raise MissingDependencyException("Could not find executable"
@@ -25,9 +26,21 @@ if not find_in_path('scantailor-cli'):
 
 logger = logging.getLogger('spreadsplug.scantailor')
 
+#: Relative cost of the different despeckling levels
+DESPECKLE_COST = {'off': 1.0, 'cautious': 1.2, 'normal': 1.4,
+                  'aggressive': 1.7}
+#: Relative cost of dewarping a page
+DEWARP_COST = 2.0
+#: Number of shards per job slot, more shards allow for a better
+#: balancing of the load towards the end of the run
+SHARDS_PER_WORKER = 3
 
-class ScanTailorPlugin(HookPlugin, ProcessHookMixin):
+
+class ScanTailorPlugin(HookPlugin, PageProcessHookMixin):
     __name__ = 'scantailor'
+    # The project is generated from and adjusted for all pages at once
+    page_barrier = True
+    _page_state = None
 
     @classmethod
     def configuration_template(cls):
@@ -91,81 +104,371 @@ class ScanTailorPlugin(HookPlugin, ProcessHookMixin):
                                    for x in sorted(img_dir.iterdir())])
         generation_cmd.append(unicode(out_dir))
         logger.debug(" ".join(generation_cmd))
-        proc = psutil.Process(subprocess.Popen(generation_cmd).pid)
 
         num_images = sum(1 for x in img_dir.iterdir())
         num_steps = end_filter - start_filter
         last_filenum = 0
-        recent_filenum = 0
         finished_steps = 0
-        while proc.is_running():
+        # NOTE: ScanTailor reads all images once for every filter step, so
+        #       we can derive the progress from the images it opens.
+        with DirectoryWatcher(img_dir, opened=True) as watcher:
+            with scheduler.executor(1) as executor:
+                future = executor.submit(
+                    lambda: subprocess.Popen(generation_cmd).wait())
+                future.add_done_callback(lambda f: watcher.wake())
+                while not future.done():
+                    for fname in watcher.wait():
+                        try:
+                            recent_filenum = int(fname.split('.')[0])
+                        except ValueError:
+                            continue
+                        if recent_filenum == last_filenum:
+                            continue
+                        if recent_filenum < last_filenum:
+                            finished_steps += 1
+                        last_filenum = recent_filenum
+                        progress = 0.5*((finished_steps*num_images +
+                                         last_filenum) /
+                                        float(num_steps*num_images))
+                        self.on_progressed.send(self, progress=progress)
+            future.result()
+
+    def _estimate_costs(self, root):
+        """ Estimate the relative cost of generating the output for every
+            input file in a project.
+
+        :param root:    Root element of the project
+        :type root:     xml.etree.ElementTree.Element
+        :return:        Estimated cost for every file id, in project order
+        :rtype:         list of (unicode, float) tuples
+        """
+        output_params = dict(
+            (page.get('id'), page.find('./params'))
+            for page in root.findall('./filters/output/page'))
+        pages_by_image = defaultdict(list)
+        for page in root.findall('./pages/page'):
+            pages_by_image[page.get('imageId')].append(page.get('id'))
+        costs = defaultdict(float)
+        for image in root.findall('./images/image'):
+            size = image.find('./size')
+            if size is not None:
+                num_pixels = (int(size.get('width')) *
+                              int(size.get('height')))
+            else:
+                num_pixels = 1
+            for page_id in pages_by_image[image.get('id')] or [None]:
+                params = output_params.get(page_id)
+                factor = 1.0
+                if params is not None:
+                    factor *= DESPECKLE_COST.get(params.get('despeckleLevel'),
+                                                 1.0)
+                    if params.get('dewarpingMode', 'off') != 'off':
+                        factor *= DEWARP_COST
+                costs[image.get('fileId')] += num_pixels*factor
+        return [(fileelem.get('id'), costs[fileelem.get('id')] or 1.0)
+                for fileelem in root.findall('./files/file')]
+
+    def _hash_element(self, sha1, elem):
+        # NOTE: The output parameters only describe the last generated
+        #       output and are no input to the output filter
+        if elem.tag == 'output-params':
+            return
+        sha1.update(elem.tag.encode('utf-8'))
+        sha1.update(repr(sorted(elem.attrib.items())))
+        sha1.update((elem.text or '').strip().encode('utf-8'))
+        for child in elem:
+            self._hash_element(sha1, child)
+
+    def _get_page_signatures(self, root, old_signatures):
+        """ Get the signature of the inputs for every file in a project.
+
+        A signature consists of the hash of the input image and the hash
+        of all filter settings for the file's images and pages. Image
+        hashes from `old_signatures` are reused if the image's size and
+        modification time did not change.
+
+        :param root:            Root element of the project
+        :type root:             xml.etree.ElementTree.Element
+        :param old_signatures:  Signatures from a previous run, by file name
+        :type old_signatures:   dict
+        :return:                File ids and signatures, by file name
+        :rtype:                 dict of unicode: (unicode, dict)
+        """
+        directories = dict((x.get('id'), x.get('path'))
+                           for x in root.findall('./directories/directory'))
+        ids_by_file = defaultdict(list)
+        file_by_image = {}
+        for image in root.findall('./images/image'):
+            ids_by_file[image.get('fileId')].append(image.get('id'))
+            file_by_image[image.get('id')] = image.get('fileId')
+        for page in root.findall('./pages/page'):
+            file_id = file_by_image.get(page.get('imageId'))
+            ids_by_file[file_id].append(page.get('id'))
+        settings_by_id = defaultdict(list)
+        for filter_elem in root.findall('./filters/*'):
+            for elem in filter_elem:
+                if elem.get('id') is not None:
+                    settings_by_id[elem.get('id')].append(
+                        (filter_elem, elem))
+
+        signatures = {}
+        for file_elem in root.findall('./files/file'):
+            name = file_elem.get('name')
+            sha1 = hashlib.sha1()
+            for elem_id in ids_by_file[file_elem.get('id')]:
+                for filter_elem, elem in settings_by_id[elem_id]:
+                    sha1.update(filter_elem.tag.encode('utf-8'))
+                    sha1.update(repr(sorted(filter_elem.attrib.items())))
+                    self._hash_element(sha1, elem)
+            signature = {'settings': sha1.hexdigest(), 'hash': None}
+            img_path = os.path.join(
+                directories.get(file_elem.get('dirId'), ''), name)
             try:
-                recent_filenum = next(int(Path(x.path).name.split('.')[0])
-                                      for x in proc.open_files()
-                                      if unicode(img_dir) in x.path)
-            except StopIteration:
-                pass
-            except psutil.AccessDenied:
-                # This means the process is no longer running
-                break
-            if recent_filenum == last_filenum:
-                time.sleep(.1)
+                stat = os.stat(img_path)
+            except OSError:
+                signatures[name] = (file_elem.get('id'), signature)
                 continue
-            if recent_filenum < last_filenum:
-                finished_steps += 1
-            last_filenum = recent_filenum
-            progress = 0.5*((finished_steps*num_images+last_filenum) /
-                            float(num_steps*num_images))
-            self.on_progressed.send(self, progress=progress)
-
-    def _split_configuration(self, projectfile, temp_dir):
-        num_pieces = multiprocessing.cpu_count()
+            signature['size'] = stat.st_size
+            signature['mtime'] = stat.st_mtime
+            old = old_signatures.get(name, {})
+            if (old.get('hash') and old.get('size') == stat.st_size
+                    and old.get('mtime') == stat.st_mtime):
+                signature['hash'] = old['hash']
+            else:
+                img_hash = hashlib.sha1()
+                with open(img_path, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(1024*1024), b''):
+                        img_hash.update(chunk)
+                signature['hash'] = img_hash.hexdigest()
+            signatures[name] = (file_elem.get('id'), signature)
+        return signatures
+
+    def _get_changed_files(self, projectfile, out_dir, manifest_path):
+        """ Find the files in a project whose output has to be
+            (re-)generated.
+
+        :return:    Ids of files that changed and the new signatures of all
+                    files, by file name
+        :rtype:     (set of unicode, dict)
+        """
+        old_signatures = {}
+        if manifest_path.exists():
+            try:
+                with manifest_path.open('r') as fp:
+                    old_signatures = json.load(fp)
+            except ValueError:
+                logger.warning("Could not read ScanTailor manifest, "
+                               "regenerating all pages.")
+        root = ET(file=unicode(projectfile)).getroot()
+        signatures = self._get_page_signatures(root, old_signatures)
+        # Split pages are written as e.g. '001_1L.tif'
+        done_stems = set(x.name.split('.')[0].split('_')[0]
+                         for x in out_dir.glob('*.tif'))
+        changed = set(
+            file_id for name, (file_id, signature) in signatures.iteritems()
+            if signature['hash'] is None
+            or old_signatures.get(name) != signature
+            or Path(name).stem not in done_stems)
+        return changed, dict((name, signature) for name, (_, signature)
+                             in signatures.iteritems())
+
+    def _split_configuration(self, projectfile, temp_dir, num_pieces=None,
+                             file_ids=None):
+        """ Split a project into several projects of about the same
+            estimated cost.
+
+        Each piece consists of consecutive input files.
+
+        :param projectfile: Path to the project
+        :type projectfile:  pathlib.Path
+        :param temp_dir:    Directory to write the pieces to
+        :type temp_dir:     pathlib.Path
+        :param num_pieces:  Number of pieces to split into, defaults to the
+                            number of jobs that may run at the same time
+        :type num_pieces:   int
+        :param file_ids:    Only include the files with these ids, defaults
+                            to all files
+        :type file_ids:     set of unicode
+        :return:            Paths to the pieces, most expensive first
+        :rtype:             list of pathlib.Path
+        """
+        if num_pieces is None:
+            num_pieces = scheduler.num_slots
         tree = ET(file=unicode(projectfile))
-        num_files = len(tree.findall('./files/file'))
+        root = tree.getroot()
+        file_costs = self._estimate_costs(root)
+        if file_ids is not None:
+            file_costs = [(file_id, cost) for file_id, cost in file_costs
+                          if file_id in file_ids]
+        total_cost = sum(cost for _, cost in file_costs)
+
+        # Assign each file to the piece its cost midpoint falls into
+        shard_files = defaultdict(set)
+        shard_costs = defaultdict(float)
+        cost_before = 0
+        for file_id, cost in file_costs:
+            shard = min(int((cost_before + cost/2) / total_cost * num_pieces),
+                        num_pieces-1)
+            shard_files[shard].add(file_id)
+            shard_costs[shard] += cost
+            cost_before += cost
+
+        shards = sorted(shard_files, key=lambda x: -shard_costs[x])
+        return self._write_pieces(
+            tree, temp_dir, [("{0}-{1}".format(projectfile.stem, shard),
+                              shard_files[shard]) for shard in shards])
+
+    def _write_pieces(self, tree, temp_dir, pieces):
+        """ Write projects that only contain a subset of the files of a
+            project.
+
+        :param tree:        Parsed project, is modified in place
+        :type tree:         xml.etree.ElementTree.ElementTree
+        :param temp_dir:    Directory to write the pieces to
+        :type temp_dir:     pathlib.Path
+        :param pieces:      Names of the pieces and the ids of the files
+                            they contain
+        :type pieces:       list of (unicode, set of unicode)
+        :return:            Paths to the pieces
+        :rtype:             list of pathlib.Path
+        """
+        root = tree.getroot()
+        # Map every element we have to split to the file it belongs to
+        image_files = dict((x.get('id'), x.get('fileId'))
+                           for x in root.findall('./images/image'))
+        get_file = {
+            'files': lambda x: x.get('id'),
+            'images': lambda x: x.get('fileId'),
+            'pages': lambda x: image_files.get(x.get('imageId')),
+            'file-name-disambiguation': lambda x: x.get('file'),
+        }
+        containers = dict((name, root.find(name)) for name in get_file)
+        all_children = dict((name, list(elem))
+                            for name, elem in containers.iteritems()
+                            if elem is not None)
+
         splitfiles = []
-        files_per_job = int(math.ceil(float(num_files)/num_pieces))
-        for idx in xrange(num_pieces):
-            tree = ET(file=unicode(projectfile))
-            root = tree.getroot()
-            start = idx*files_per_job
-            end = start + files_per_job
-            if end > num_files:
-                end = None
-            for elem in ('files', 'images', 'pages',
-                         'file-name-disambiguation'):
-                elem_root = root.find(elem)
-                to_keep = elem_root.getchildren()[start:end]
-                to_remove = [x for x in elem_root.getchildren()
-                             if not x in to_keep]
-                for node in to_remove:
-                    elem_root.remove(node)
-            out_file = temp_dir / "{0}-{1}.ScanTailor".format(projectfile.stem,
-                                                              idx)
+        for piece_name, file_ids in pieces:
+            for name, children in all_children.iteritems():
+                containers[name][:] = [x for x in children
+                                       if get_file[name](x) in file_ids]
+            out_file = temp_dir / "{0}.ScanTailor".format(piece_name)
             tree.write(unicode(out_file))
             splitfiles.append(out_file)
         return splitfiles
 
-    def _generate_output(self, projectfile, out_dir, num_pages):
+    def _get_shard_stems(self, cfgfile):
+        """ Get the stems of the input files in a project, without parsing
+            all of its filter settings.
+        """
+        stems = set()
+        for _, elem in iterparse(unicode(cfgfile)):
+            if elem.tag == 'file':
+                stems.add(Path(elem.get('name')).stem)
+            elif elem.tag == 'files':
+                break
+        return stems
+
+    def _run_cli(self, cfgfile, out_dir):
+        """ Generate the output images for a project with `scantailor-cli`.
+
+        :param cfgfile:     Path to the project
+        :type cfgfile:      pathlib.Path
+        :param out_dir:     Directory to write the images to
+        :type out_dir:      pathlib.Path
+        :raises subprocess.CalledProcessError:  If `scantailor-cli` failed
+        """
+        args = ['scantailor-cli', '--start-filter=6', unicode(cfgfile),
+                unicode(out_dir)]
+        returncode = subprocess.Popen(args).wait()
+        if returncode != 0:
+            logger.error("scantailor-cli failed on {0} with exit code {1}"
+                         .format(cfgfile.name, returncode))
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def _generate_output(self, projectfile, out_dir):
         logger.debug("Generating output...")
+        if not out_dir.exists():
+            out_dir.mkdir()
+        manifest_path = projectfile.parent / '.cache' / 'scantailor.json'
+        changed_files, signatures = self._get_changed_files(
+            projectfile, out_dir, manifest_path)
+        if not changed_files:
+            logger.info("Output is up to date for all pages.")
+            return
+        logger.info("Generating output for {0} of {1} pages"
+                    .format(len(changed_files), len(signatures)))
+        num_pages = len(changed_files)
         temp_dir = Path(tempfile.mkdtemp(prefix="spreads."))
-        split_config = self._split_configuration(projectfile, temp_dir)
+        num_workers = scheduler.num_slots
+        split_config = self._split_configuration(
+            projectfile, temp_dir, num_pieces=num_workers*SHARDS_PER_WORKER,
+            file_ids=changed_files)
+        shard_stems = [self._get_shard_stems(cfgfile)
+                       for cfgfile in split_config]
+        stem_shards = dict((stem, idx) for idx, stems in enumerate(shard_stems)
+                           for stem in stems)
+        shard_done = [set() for _ in split_config]
         logger.debug("Launching those subprocesses!")
-        processes = [subprocess.Popen(['scantailor-cli', '--start-filter=6',
-                                       unicode(cfgfile), unicode(out_dir)])
-                     for cfgfile in split_config]
-
-        last_count = 0
-        while processes:
-            recent_count = sum(1 for x in out_dir.glob('*.tif'))
-            if recent_count > last_count:
+
+        def _track_progress(fnames):
+            for fname in fnames:
+                # Split pages are written as e.g. '001_1L.tif'
+                stem = fname.split('.')[0].split('_')[0]
+                shard = stem_shards.get(stem)
+                if shard is None or stem in shard_done[shard]:
+                    continue
+                shard_done[shard].add(stem)
+                logger.debug("Piece {0}: {1}/{2} pages done".format(
+                    shard, len(shard_done[shard]), len(shard_stems[shard])))
+                num_done = sum(len(x) for x in shard_done)
                 self.on_progressed.send(
-                    self, progress=0.5+(float(recent_count)/num_pages)/2)
-            for p in processes[:]:
-                if p.poll() is not None:
-                    processes.remove(p)
+                    self, progress=0.5+(float(num_done)/num_pages)/2)
+
+        # NOTE: The pieces are sorted by decreasing cost, so the pool hands
+        #       out the most expensive ones first and the cheap ones fill
+        #       the gaps towards the end.
+        with DirectoryWatcher(out_dir) as watcher:
+            with scheduler.executor(num_workers) as executor:
+                futures = [executor.submit(self._run_cli, cfgfile, out_dir)
+                           for cfgfile in split_config]
+                for future in futures:
+                    future.add_done_callback(lambda f: watcher.wake())
+                while not all(f.done() for f in futures):
+                    _track_progress(watcher.wait())
+            # Pick up files written right before the last process exited
+            _track_progress(watcher.wait(timeout=0))
         shutil.rmtree(unicode(temp_dir))
+        failed_stems = set()
+        for stems, future in zip(shard_stems, futures):
+            if future.exception() is not None:
+                failed_stems |= stems
+        # The output of failed pieces may be missing or outdated, so their
+        # pages have to be generated again on the next run
+        self._write_manifest(manifest_path, signatures, failed_stems)
+        for future in futures:
+            future.result()
 
-    def process(self, path):
+    def _write_manifest(self, manifest_path, signatures, outdated_stems):
+        """ Store the signatures of all pages whose output is up to date.
+
+        :param manifest_path:   Path to the manifest
+        :type manifest_path:    pathlib.Path
+        :param signatures:      Signatures of all pages, by file name
+        :type signatures:       dict
+        :param outdated_stems:  Stems of the files whose output could not be
+                                generated
+        :type outdated_stems:   set of unicode
+        """
+        signatures = dict((name, signature)
+                          for name, signature in signatures.iteritems()
+                          if Path(name).stem not in outdated_stems)
+        if not manifest_path.parent.exists():
+            manifest_path.parent.mkdir()
+        with manifest_path.open('wb') as fp:
+            json.dump(signatures, fp)
+
+    def _prepare_project(self, path):
         autopilot = self.config['autopilot'].get(bool)
         if not autopilot and not find_in_path('scantailor'):
             raise MissingDependencyException(
@@ -182,8 +485,55 @@ class ScanTailorPlugin(HookPlugin, ProcessHookMixin):
         if not autopilot:
             logger.info("Opening ScanTailor GUI for manual adjustment")
             subprocess.call(['scantailor', unicode(projectfile)])
+        return projectfile, out_dir
+
+    def process(self, path):
+        projectfile, out_dir = self._prepare_project(path)
         logger.info("Generating output images from ScanTailor configuration.")
+        self._generate_output(projectfile, out_dir)
+
+    def prepare_process(self, path):
+        # The configuration is generated from all images and might be
+        # adjusted manually, so this has to run before the first page
+        projectfile, out_dir = self._prepare_project(path)
+        if not out_dir.exists():
+            out_dir.mkdir()
+        manifest_path = path / '.cache' / 'scantailor.json'
+        changed_files, signatures = self._get_changed_files(
+            projectfile, out_dir, manifest_path)
+        logger.info("Generating output for {0} of {1} pages"
+                    .format(len(changed_files), len(signatures)))
+        temp_dir = Path(tempfile.mkdtemp(prefix="spreads."))
+        tree = ET(file=unicode(projectfile))
+        page_files = dict((x.get('name'), x.get('id'))
+                          for x in tree.getroot().findall('./files/file')
+                          if x.get('id') in changed_files)
+        pieces = self._write_pieces(
+            tree, temp_dir, [(Path(name).stem, set([file_id]))
+                             for name, file_id in page_files.iteritems()])
+        self._page_state = {
+            'out_dir': out_dir,
+            'temp_dir': temp_dir,
+            'manifest_path': manifest_path,
+            'signatures': signatures,
+            'pieces': dict((x.stem, x) for x in pieces),
+            # Stems of the pages whose output was generated
+            'done': set(),
+        }
+
+    def process_page(self, path, raw_image):
+        cfgfile = self._page_state['pieces'].get(raw_image.stem)
+        if cfgfile is None:
+            # Output for this page is up to date
+            return
+        self._run_cli(cfgfile, self._page_state['out_dir'])
+        self._page_state['done'].add(raw_image.stem)
 
-        num_pages = sum(1 for x in img_dir.iterdir()
-                        if x.suffix.lower() in ('.jpeg', '.jpg'))
-        self._generate_output(projectfile, out_dir, num_pages)
+    def finish_process(self, path):
+        state = self._page_state
+        shutil.rmtree(unicode(state['temp_dir']))
+        # Pages that failed or were never submitted are generated again on
+        # the next run
+        self._write_manifest(state['manifest_path'], state['signatures'],
+                             set(state['pieces']) - state['done'])
+        self._page_state = None
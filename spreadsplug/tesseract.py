@@ -1,13 +1,17 @@
+import errno
+import filecmp
+import hashlib
+import json
 import logging
-import multiprocessing
 import os
 import re
+import shutil
 import subprocess
-import time
+import threading
 import xml.etree.cElementTree as ET
 
-from spreads.plugin import HookPlugin, ProcessHookMixin, PluginOption
-from spreads.util import find_in_path, MissingDependencyException
+from spreads.plugin import HookPlugin, PageProcessHookMixin, PluginOption
+from spreads.util import find_in_path, scheduler, MissingDependencyException
 from spreads.vendor.pathlib import Path
 
 if not find_in_path('tesseract'):
@@ -24,11 +28,154 @@ except subprocess.CalledProcessError:
     AVAILABLE_LANGS = [x.stem for x in
                        Path('/usr/share/tesseract-ocr/tessdata')
                        .glob('*.traineddata')]
+try:
+    TESSERACT_VERSION = (subprocess.check_output(["tesseract", "--version"],
+                                                 stderr=subprocess.STDOUT)
+                         .split("\n")[0].strip())
+except (subprocess.CalledProcessError, OSError):
+    TESSERACT_VERSION = "unknown"
+
+
+class HocrAssembler(object):
+    """ Combines single-page hOCR files into one document.
+
+    Pages are parsed and written one at a time, so memory usage does not
+    depend on the number of pages. A manifest next to the output file
+    records the size and modification time of each input page together
+    with the offset of its output. On subsequent runs, the output is only
+    rewritten from the first page that changed.
+
+    :param outfile:     Path to the combined hOCR file
+    :type outfile:      pathlib.Path
+    """
+    header = b"<html><head /><body>\n"
+    footer = b"</body></html>\n"
+    _xhtml_ns = "{http://www.w3.org/1999/xhtml}"
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.manifest_path = outfile.parent / ".{0}.json".format(outfile.name)
+
+    def assemble(self, pages):
+        """ Write the combined document.
+
+        :param pages:   Paths to the hOCR files of the pages, in order
+        :type pages:    list(pathlib.Path)
+        :return:        Number of pages that had to be (re-)written
+        :rtype:         int
+        """
+        pages = [(page, page.stat()) for page in pages]
+        manifest = self._load_manifest()
+        old_entries = manifest['pages'] if manifest else []
+        num_unchanged = 0
+        for (page, stat), entry in zip(pages, old_entries):
+            if (entry['name'] != page.name or entry['size'] != stat.st_size
+                    or entry['mtime'] != stat.st_mtime):
+                break
+            num_unchanged += 1
+        if manifest and num_unchanged == len(pages) == len(old_entries):
+            logger.debug("hOCR output is up to date")
+            return 0
+        entries = old_entries[:num_unchanged]
+
+        with self.outfile.open('r+b' if manifest else 'wb') as fp:
+            if manifest:
+                if num_unchanged < len(old_entries):
+                    fp.seek(old_entries[num_unchanged]['offset'])
+                else:
+                    fp.seek(manifest['body_end'])
+                fp.truncate()
+            else:
+                fp.write(self.header)
+            for idx, (page, stat) in enumerate(pages[num_unchanged:],
+                                               start=num_unchanged):
+                entries.append({'name': page.name, 'size': stat.st_size,
+                                'mtime': stat.st_mtime, 'offset': fp.tell()})
+                fp.write(self._render_page(page, idx))
+            body_end = fp.tell()
+            fp.write(self.footer)
+            size = fp.tell()
+        self._save_manifest({'pages': entries, 'body_end': body_end,
+                             'size': size})
+        return len(pages) - num_unchanged
 
+    def _load_manifest(self):
+        if not self.outfile.exists() or not self.manifest_path.exists():
+            return None
+        try:
+            with self.manifest_path.open('r') as fp:
+                manifest = json.load(fp)
+        except ValueError:
+            return None
+        # Only trust the manifest if the output is the one it was written for
+        if manifest.get('size') != self.outfile.stat().st_size:
+            return None
+        return manifest
 
-class TesseractPlugin(HookPlugin, ProcessHookMixin):
+    def _save_manifest(self, manifest):
+        tmp_path = self.manifest_path.parent / (self.manifest_path.name +
+                                                '.tmp')
+        with tmp_path.open('wb') as fp:
+            json.dump(manifest, fp)
+        tmp_path.rename(self.manifest_path)
+
+    def _render_page(self, page, idx):
+        """ Get the serialized `ocr_page` element of a single hOCR file.
+
+        :param page:    Path to the hOCR file
+        :type page:     pathlib.Path
+        :param idx:     Index of the page in the combined document
+        :type idx:      int
+        :rtype:         str
+        """
+        page_elem = None
+        with page.open('rb') as fp:
+            for _, elem in ET.iterparse(fp):
+                if (elem.tag == self._xhtml_ns + 'div'
+                        and elem.get('class') == 'ocr_page'):
+                    page_elem = elem
+                    break
+        if page_elem is None:
+            logger.warning("Could not find OCR results in {0}"
+                           .format(page))
+            return b""
+        for elem in page_elem.iter():
+            # Strip those annoying namespace tags...
+            if elem.tag.startswith(self._xhtml_ns):
+                elem.tag = elem.tag[len(self._xhtml_ns):]
+        self._remove_empty_formatting(page_elem)
+        # Correct page_number
+        page_elem.set('id', 'page_{0}'.format(idx))
+        page_elem.tail = None
+        return ET.tostring(page_elem, encoding='utf-8') + b"\n"
+
+    def _remove_empty_formatting(self, page_elem):
+        # NOTE: Tesseract emits empty <em> and <strong> tags, drop them
+        #       while keeping the text that follows them
+        for parent in list(page_elem.iter()):
+            previous = None
+            for child in list(parent):
+                if (child.tag not in ('em', 'strong') or len(child)
+                        or child.text):
+                    previous = child
+                    continue
+                if child.tail:
+                    if previous is not None:
+                        previous.tail = (previous.tail or '') + child.tail
+                    else:
+                        parent.text = (parent.text or '') + child.tail
+                parent.remove(child)
+
+
+class TesseractPlugin(HookPlugin, PageProcessHookMixin):
     __name__ = 'tesseract'
 
+    def __init__(self, config):
+        super(TesseractPlugin, self).__init__(config)
+        # Maps image names to the key of their cached result
+        self._cache_index = {}
+        self._cache_lock = threading.Lock()
+
     @classmethod
     def configuration_template(cls):
         conf = {'language': PluginOption(value=AVAILABLE_LANGS,
@@ -43,40 +190,149 @@ class TesseractPlugin(HookPlugin, ProcessHookMixin):
         logger.info("Performing OCR")
         img_dir = path / 'done'
         self._perform_ocr(img_dir, self.config["language"].get())
-        for fname in img_dir.glob('*.html'):
-            self._fix_hocr(fname)
 
     def _perform_ocr(self, img_dir, language):
+        """ Run OCR on all images in a directory.
+
+        Results are cached by the content of the image, the language and
+        the version of Tesseract, only images without a cached result are
+        passed to Tesseract.
+
+        :param img_dir:     Directory with `.tif` images
+        :type img_dir:      pathlib.Path
+        :param language:    Language to recognize
+        :type language:     unicode
+        """
         images = tuple(img_dir.glob('*.tif'))
-        processes = []
-
-        def _clean_processes():
-            for p in processes[:]:
-                if p.poll() is not None:
-                    processes.remove(p)
-                    _clean_processes.num_cleaned += 1
-                    self.on_progressed.send(
-                        self, progress=float(_clean_processes
-                                             .num_cleaned)/len(images))
-        _clean_processes.num_cleaned = 0
-
-        language = self.config['language'].get()
+        if not images:
+            return
+        cache_dir = self._get_cache_dir(img_dir)
+        self._load_cache_index(cache_dir)
         logger.info("Language is \"{0}\"".format(language))
-        max_procs = multiprocessing.cpu_count()
-        FNULL = open(os.devnull, 'w')
-        for img in images:
-            # Wait until another process has finished
-            while len(processes) >= max_procs:
-                _clean_processes()
-                time.sleep(0.01)
+        progress_lock = threading.Lock()
+        num_done = [0]
+
+        def _progress():
+            with progress_lock:
+                num_done[0] += 1
+                self.on_progressed.send(
+                    self, progress=float(num_done[0])/len(images))
+
+        def _process_image(img):
+            self._process_image(img, cache_dir, language)
+            _progress()
+
+        with scheduler.executor() as executor:
+            futures = [executor.submit(_process_image, img)
+                       for img in images]
+        for future in futures:
+            # Re-raise exceptions from the workers
+            future.result()
+        self._prune_cache(img_dir, cache_dir)
+
+    def prepare_process(self, path):
+        self._load_cache_index(self._get_cache_dir(path / 'done'))
+
+    def process_page(self, path, raw_image):
+        img_dir = path / 'done'
+        cache_dir = self._get_cache_dir(img_dir)
+        language = self.config["language"].get()
+        # Split pages are written as e.g. '001_1L.tif'
+        for img in img_dir.glob('{0}*.tif'.format(raw_image.stem)):
+            if img.stem.split('_')[0] == raw_image.stem:
+                self._process_image(img, cache_dir, language)
+
+    def finish_process(self, path):
+        img_dir = path / 'done'
+        self._prune_cache(img_dir, self._get_cache_dir(img_dir))
+
+    def _get_cache_dir(self, img_dir):
+        cache_dir = img_dir.parent / '.cache' / 'tesseract'
+        try:
+            cache_dir.mkdir(parents=True)
+        except OSError as e:
+            # Pages are processed concurrently, so another thread might have
+            # created the directory in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+        return cache_dir
+
+    def _load_cache_index(self, cache_dir):
+        index_path = cache_dir / 'index.json'
+        with self._cache_lock:
+            if index_path.exists():
+                with index_path.open('r') as fp:
+                    self._cache_index = json.load(fp)
+            else:
+                self._cache_index = {}
+
+    def _prune_cache(self, img_dir, cache_dir):
+        """ Remove cached results that no longer belong to any image, e.g.
+        because the image was removed or retaken.
+        """
+        with self._cache_lock:
+            names = set(x.name for x in img_dir.glob('*.tif'))
+            self._cache_index = dict(
+                (name, key) for name, key in self._cache_index.iteritems()
+                if name in names)
+            keys = set(self._cache_index.itervalues())
+            for entry in cache_dir.glob('*.html'):
+                if entry.stem not in keys:
+                    entry.unlink()
+            with (cache_dir / 'index.json').open('wb') as fp:
+                json.dump(self._cache_index, fp)
+
+    def _process_image(self, img, cache_dir, language):
+        """ Run OCR on a single image, unless a cached result exists. """
+        key = self._get_cache_key(img, language)
+        cache_path = cache_dir / "{0}.html".format(key)
+        out_path = img.parent / "{0}.html".format(img.stem)
+        if cache_path.exists():
+            # Leave outputs that are already up to date alone, so
+            # their modification times stay the same
+            if not (out_path.exists() and
+                    filecmp.cmp(unicode(cache_path), unicode(out_path),
+                                shallow=False)):
+                shutil.copyfile(unicode(cache_path), unicode(out_path))
+        else:
+            if not self._run_tesseract(img, language):
+                # Do not keep the result for a previous version of the image
+                if out_path.exists():
+                    out_path.unlink()
+                return
+            if not out_path.exists():
+                return
+            self._fix_hocr(out_path)
+            shutil.copyfile(unicode(out_path), unicode(cache_path))
+        with self._cache_lock:
+            self._cache_index[img.name] = key
+
+    def _run_tesseract(self, img, language):
+        """ Run Tesseract on an image.
+
+        :return:    Whether Tesseract succeeded
+        :rtype:     bool
+        """
+        with open(os.devnull, 'w') as devnull:
             proc = subprocess.Popen(["tesseract", unicode(img),
-                                    unicode(img_dir / img.stem), "-l",
-                                    language, "hocr"], stderr=FNULL,
-                                    stdout=FNULL)
-            processes.append(proc)
-        # Wait for remaining processes to finish
-        while processes:
-            _clean_processes()
+                                    unicode(img.parent / img.stem), "-l",
+                                    language, "hocr"], stderr=subprocess.PIPE,
+                                    stdout=devnull)
+            _, error = proc.communicate()
+        if proc.returncode != 0:
+            logger.error("Tesseract failed on {0} with exit code {1}:\n{2}"
+                         .format(img, proc.returncode, error))
+            return False
+        return True
+
+    def _get_cache_key(self, img, language):
+        sha1 = hashlib.sha1()
+        with img.open('rb') as fp:
+            for chunk in iter(lambda: fp.read(1024*1024), b''):
+                sha1.update(chunk)
+        sha1.update(language.encode('utf-8'))
+        sha1.update(TESSERACT_VERSION)
+        return sha1.hexdigest()
 
     def _fix_hocr(self, fpath):
         # NOTE: This modifies the hOCR files to make them compatible with
@@ -94,26 +350,6 @@ class TesseractPlugin(HookPlugin, ProcessHookMixin):
     def output(self, path):
         outfile = path / 'out' / "{0}.hocr".format(path.name)
         inpath = path / 'done'
-        out_root = ET.Element('html')
-        ET.SubElement(out_root, 'head')
-        body = ET.SubElement(out_root, 'body')
-
-        for idx, page in enumerate(sorted(inpath.glob('*.html'))):
-            # NOTE: Fixe some things from hOCR output so we can parse it...
-            with page.open('r+') as fp:
-                content = re.sub(r'<em><\/em>', '', fp.read())
-                content = re.sub(r'<strong><\/strong>', '', content)
-            page = ET.fromstring(content.encode('utf-8'))
-            page_elem = page.find("xhtml:body/xhtml:div[@class='ocr_page']",
-                                  dict(xhtml="http://www.w3.org/1999/xhtml"))
-            # Correct page_number
-            page_elem.set('id', 'page_{0}'.format(idx))
-
-            # And tack it onto the output file
-            if page_elem:
-                body.append(page_elem)
-        with outfile.open('w') as fp:
-            # Strip those annoying namespace tags...
-            out_string = re.sub(r"(<\/*)html:", "\g<1>",
-                                ET.tostring(out_root))
-            fp.write(unicode(out_string))
+        num_written = HocrAssembler(outfile).assemble(
+            sorted(inpath.glob('*.html')))
+        logger.debug("Wrote {0} pages to {1}".format(num_written, outfile))
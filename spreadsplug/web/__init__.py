@@ -16,6 +16,7 @@ from spreads.workflow import Workflow
 app = Flask('spreadsplug.web', static_url_path='', static_folder='./client',
             template_folder='./client')
 task_queue = None
+event_coalescer = None
 import web
 import persistence
 import util
@@ -93,7 +94,22 @@ class WebCommands(HookPlugin, SubcommandHookMixin):
                 value=False,
                 docstring="Server runs on a standalone device dedicated to "
                           "scanning (e.g. 'spreadpi').",
-                selectable=False)
+                selectable=False),
+            'image_cache_size': PluginOption(
+                value=100,
+                docstring="Maximum size of the thumbnail and scaled image "
+                          "cache in MiB",
+                selectable=False),
+            'preview_width': PluginOption(
+                value=800,
+                docstring="Width of the preview images that are generated "
+                          "for new captures, 0 to disable",
+                selectable=False),
+            'progress_interval': PluginOption(
+                value=0.25,
+                docstring="Minimum time (in seconds) between two progress "
+                          "updates that are sent to clients",
+                selectable=False),
         }
 
 
@@ -112,12 +128,38 @@ def setup_app(config):
     app.config['base_path'] = project_dir
     app.config['default_config'] = config
     app.config['standalone'] = config['web']['standalone_device'].get()
+    persistence.initialize_database()
+    # Derivatives are stored next to the database, since the project
+    # directory might be on slow or removable storage
+    web.image_cache = util.DerivativeCache(
+        db_path.parent / 'imagecache',
+        config['web']['image_cache_size'].get(int)*1024**2)
+    setup_derivative_generator(config)
 
     if mode == 'scanner':
         app.config['postproc_server'] = (
             config['web']['postprocessing_server'].get())
 
 
+def setup_derivative_generator(config):
+    """ Generate thumbnails and previews for new images in the background. """
+    variants = {'thumb': util.get_thumbnail}
+    preview_width = config['web']['preview_width'].get(int)
+    if preview_width:
+        variant, generate = util.get_scaled_variant(preview_width)
+        variants[variant] = generate
+    if web.derivative_generator is not None:
+        web.derivative_generator.shutdown(wait=False)
+    web.derivative_generator = util.DerivativeGenerator(web.image_cache,
+                                                        variants)
+    Workflow.on_capture_executed.connect(_generate_derivatives, weak=False)
+
+
+def _generate_derivatives(sender, images, **kwargs):
+    if web.derivative_generator is not None:
+        web.derivative_generator.submit(images)
+
+
 def setup_logging(config):
     # Add in-memory log handler
     memoryhandler = logging.handlers.BufferingHandler(1024*10)
@@ -129,15 +171,29 @@ def setup_logging(config):
             .setLevel(logging.INFO))
 
 
-def setup_signals(ws_server=None):
-    def get_signal_callback_http(signal):
-        def signal_callback(sender, **kwargs):
-            web.event_queue.append(util.Event(signal, sender, kwargs))
-        return signal_callback
+def setup_signals(ws_server=None, progress_interval=0):
+    """ Pass emitted signals on to the clients.
 
-    def get_signal_callback_websockets(signal):
+    :param ws_server:           Websocket server to send the events to
+    :type ws_server:            :py:class:`WebSocketServer`
+    :param progress_interval:   Window in which only the most recent progress
+                                events are passed on, see
+                                :py:class:`util.EventCoalescer`
+    :type progress_interval:    float
+    """
+    def dispatch_event(event):
+        web.event_broker.publish(event)
+        if ws_server:
+            ws_server.send_event(event)
+
+    global event_coalescer
+    if event_coalescer is not None:
+        event_coalescer.flush()
+    event_coalescer = util.EventCoalescer(dispatch_event, progress_interval)
+
+    def get_signal_callback(signal, coalescer):
         def signal_callback(sender, **kwargs):
-            ws_server.send_event(util.Event(signal, sender, kwargs))
+            coalescer.push(util.Event(signal, sender, kwargs))
         return signal_callback
 
     # Register event handlers
@@ -145,16 +201,15 @@ def setup_signals(ws_server=None):
                       for x in (Workflow, EventHandler, web)))
 
     for signal in signals:
-        signal.connect(get_signal_callback_http(signal), weak=False)
-        if ws_server:
-            signal.connect(get_signal_callback_websockets(signal), weak=False)
+        signal.connect(get_signal_callback(signal, event_coalescer),
+                       weak=False)
 
 
 def run_server(config):
     ws_server = WebSocketServer(port=5001)
     setup_app(config)
     setup_logging(config)
-    setup_signals(ws_server)
+    setup_signals(ws_server, config['web']['progress_interval'].get(float))
 
     # Initialize huey task queue
     global task_queue
@@ -187,4 +242,6 @@ def run_server(config):
         waitress.serve(app, port=5000, threads=16)
     finally:
         consumer.shutdown()
+        event_coalescer.flush()
         ws_server.stop()
+        web.derivative_generator.shutdown(wait=False)
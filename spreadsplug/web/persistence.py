@@ -1,7 +1,8 @@
 import json
 import logging
 import sqlite3
-from collections import namedtuple
+import threading
+from collections import OrderedDict, namedtuple
 
 from spreads.workflow import Workflow
 from spreads.vendor.pathlib import Path
@@ -9,7 +10,7 @@ from spreads.vendor.pathlib import Path
 from spreadsplug.web import app
 
 SCHEMA = """
-CREATE TABLE workflow (
+CREATE TABLE IF NOT EXISTS workflow (
     id              INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
     name            TEXT,
     step            TEXT,
@@ -17,40 +18,155 @@ CREATE TABLE workflow (
     config          TEXT
 );
 
-CREATE TABLE queue (
+CREATE TABLE IF NOT EXISTS queue (
     id              INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
     workflow_id     INTEGER,
     FOREIGN KEY (workflow_id) REFERENCES workflow(id)
 );
 """
 
-# NOTE: This is a global dictionary that caches workflow instances, so we
-#       do not have to hit the database each time we want to get a workflow
-#       object.
-WorkflowCache = {}
-
 DbWorkflow = namedtuple('DbWorkflow', ['id', 'name', 'step', 'step_done',
                                        'config'])
 logger = logging.getLogger('spreadsplug.web.database')
 
+# Number of prepared statements that are kept around by each connection
+STATEMENT_CACHE_SIZE = 64
+
+# Maximum number of inactive workflows that are kept in memory
+WORKFLOW_CACHE_SIZE = 64
+
+# NOTE: Every thread keeps its own connection open, since sqlite3 connections
+#       must not be shared between threads.
+_local = threading.local()
+
 
 class ValidationError(Exception):
     def __init__(self, **kwargs):
         self.errors = kwargs
 
 
+class LRUWorkflowCache(object):
+    """ Keeps workflow instances around, so we do not have to hit the
+    database each time we want to get a workflow object.
+
+    Only the most recently used inactive workflows are kept. Workflows that
+    are busy (see :py:attr:`spreads.workflow.Workflow.busy`) are never
+    evicted, since the same instance has to be used for as long as they are
+    running.
+
+    :param max_size:    Maximum number of inactive workflows to keep
+    :type max_size:     int
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._workflows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, workflow_id):
+        return workflow_id in self._workflows
+
+    def __len__(self):
+        return len(self._workflows)
+
+    def get(self, workflow_id):
+        """ Get a cached workflow and mark it as recently used.
+
+        :param workflow_id: ID of the workflow
+        :type workflow_id:  int
+        :return:            The workflow or None if it is not cached
+        :rtype:             :py:class:`spreads.workflow.Workflow`
+        """
+        with self._lock:
+            workflow = self._workflows.pop(workflow_id, None)
+            if workflow is not None:
+                self._workflows[workflow_id] = workflow
+            return workflow
+
+    def add(self, workflow):
+        """ Add a workflow to the cache.
+
+        If a workflow with the same ID is already cached, that instance is
+        kept, so that all callers share the same instance.
+
+        :param workflow:    The workflow
+        :type workflow:     :py:class:`spreads.workflow.Workflow`
+        :return:            The cached instance
+        :rtype:             :py:class:`spreads.workflow.Workflow`
+        """
+        with self._lock:
+            workflow = self._workflows.pop(workflow.id, workflow)
+            self._workflows[workflow.id] = workflow
+            self._evict()
+            return workflow
+
+    def invalidate(self, workflow_id):
+        """ Remove a workflow from the cache, if it is cached.
+
+        :param workflow_id: ID of the workflow
+        :type workflow_id:  int
+        """
+        with self._lock:
+            self._workflows.pop(workflow_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._workflows.clear()
+
+    def _evict(self):
+        if len(self._workflows) <= self.max_size:
+            return
+        evictable = [wfid for wfid, workflow in self._workflows.iteritems()
+                     if not self._is_active(workflow)]
+        # Active workflows do not count towards the limit
+        num_excess = len(evictable) - self.max_size
+        for workflow_id in evictable[:max(num_excess, 0)]:
+            del self._workflows[workflow_id]
+
+    def _is_active(self, workflow):
+        return workflow.busy
+
+
+WorkflowCache = LRUWorkflowCache(WORKFLOW_CACHE_SIZE)
+
+
 def initialize_database():
+    """ Create the database tables if they do not exist yet.
+
+    Must be called once on startup, before any connections are opened.
+    """
     logger.info("Initializing database.")
     db_path = app.config['database']
-    with sqlite3.connect(unicode(db_path)) as con:
+    con = sqlite3.connect(unicode(db_path))
+    try:
+        # The journal mode is stored in the database file, so this only has
+        # to be done once. In WAL mode, readers no longer block writers.
+        con.execute("PRAGMA journal_mode=WAL")
         con.executescript(SCHEMA)
+    finally:
+        con.close()
 
 
 def open_connection():
-    db_path = Path(app.config['database'])
-    if not db_path.exists():
-        initialize_database()
-    return sqlite3.connect(unicode(db_path))
+    """ Get the database connection for the current thread.
+
+    The connection is opened on the first call in each thread and re-used
+    for all subsequent calls, as long as the database path does not change.
+
+    :rtype:     sqlite3.Connection
+    """
+    db_path = unicode(app.config['database'])
+    con = getattr(_local, 'connection', None)
+    if con is not None and _local.db_path == db_path:
+        return con
+    if con is not None:
+        con.close()
+    con = sqlite3.connect(db_path, cached_statements=STATEMENT_CACHE_SIZE)
+    # Writes are still safe with WAL, only the last transactions might be
+    # lost on a power failure
+    con.execute("PRAGMA synchronous=NORMAL")
+    _local.connection = con
+    _local.db_path = db_path
+    return con
 
 
 def save_workflow(workflow):
@@ -69,7 +185,8 @@ def save_workflow(workflow):
                                   data).lastrowid
     logger.debug("Workflow written to database with id {0}"
                  .format(workflow_id))
-    WorkflowCache[workflow_id] = workflow
+    workflow.id = workflow_id
+    WorkflowCache.add(workflow)
     return workflow_id
 
 
@@ -79,51 +196,61 @@ def update_workflow_config(id, config):
     with open_connection() as con:
         con.execute("UPDATE WORKFLOW SET config=:config WHERE id=:id",
                     dict(config=config_data, id=id))
+    cached = WorkflowCache.get(id)
+    if cached is not None and cached.config is not config:
+        # The cached instance does not have the new configuration
+        WorkflowCache.invalidate(id)
 
 
-def get_workflow(workflow_id):
-    # See if the workflow is among our cached instances
-    if workflow_id in WorkflowCache:
-        return WorkflowCache[workflow_id]
-    logger.debug("Loading workflow {0} from database".format(workflow_id))
-    with open_connection() as con:
-        db_data = con.execute("SELECT * FROM workflow WHERE workflow.id=?",
-                              (workflow_id,)).fetchone()
-    if db_data is None:
-        logger.warn("Workflow {0} was not found.".format(workflow_id))
-        return None
-
+def _workflow_from_row(db_data):
     db_workflow = DbWorkflow(*db_data)
-
     # Try to load configuration from database
     if db_workflow.config is not None:
         config = json.loads(db_workflow.config)
     else:
         config = None
-    workflow = Workflow(
+    return Workflow(
         path=Path(app.config['base_path'])/db_workflow.name,
         config=config,
         step=db_workflow.step,
         step_done=bool(db_workflow.step_done),
-        id=workflow_id)
-    WorkflowCache[workflow_id] = workflow
-    return workflow
+        id=db_workflow.id)
+
+
+def get_workflow(workflow_id):
+    # See if the workflow is among our cached instances
+    workflow = WorkflowCache.get(workflow_id)
+    if workflow is not None:
+        return workflow
+    logger.debug("Loading workflow {0} from database".format(workflow_id))
+    with open_connection() as con:
+        db_data = con.execute("SELECT * FROM workflow WHERE workflow.id=?",
+                              (workflow_id,)).fetchone()
+    if db_data is None:
+        logger.warn("Workflow {0} was not found.".format(workflow_id))
+        return None
+    return WorkflowCache.add(_workflow_from_row(db_data))
 
 
 def get_all_workflows():
-    if WorkflowCache:
-        return WorkflowCache
     logger.debug("Obtaining all workflows from database.")
     with open_connection() as con:
-        result = con.execute(
-            "SELECT id FROM workflow").fetchall()
-    workflows = {x[0]: get_workflow(x[0]) for x in result}
+        result = con.execute("SELECT * FROM workflow").fetchall()
+    workflows = {}
+    for db_data in result:
+        # NOTE: Workflows that are not cached are not added to the cache, a
+        #       listing of more workflows than fit into it would otherwise
+        #       evict all of them on every call.
+        workflow = WorkflowCache.get(db_data[0])
+        if workflow is None:
+            workflow = _workflow_from_row(db_data)
+        workflows[workflow.id] = workflow
     return workflows
 
 
 def delete_workflow(workflow_id):
     logger.debug("Deleting workflow {0} from database.".format(workflow_id))
-    del(WorkflowCache[workflow_id])
+    WorkflowCache.invalidate(workflow_id)
     with open_connection() as con:
         con.execute("DELETE FROM workflow WHERE id = ?", (workflow_id,))
 
@@ -1,10 +1,18 @@
 from __future__ import division
 
+import hashlib
+import heapq
+import itertools
 import logging
+import os
+import tempfile
+import threading
 import time
 import traceback
+from collections import OrderedDict, deque
 from datetime import datetime
 
+from concurrent.futures import ThreadPoolExecutor
 from flask import abort
 from flask.json import JSONEncoder
 from jpegtran import JPEGImage
@@ -29,8 +37,9 @@ class Event(object):
     :param :class:`blinker.NamedSignal` signal: The emitted signal
     :param sender:      The object that emitted the signal or None
     :param dict data:   Parameters the signal was emitted with
+    :param int seq:     Sequence number, assigned by :py:class:`EventBroker`
     """
-    __slots__ = ['signal', 'sender', 'data', 'emitted']
+    __slots__ = ['signal', 'sender', 'data', 'emitted', 'seq']
 
     def __init__(self, signal, sender, data, emitted=None):
         self.signal = signal
@@ -39,6 +48,202 @@ class Event(object):
         if emitted is None:
             emitted = time.time()
         self.emitted = emitted
+        self.seq = None
+
+
+class EventBroker(object):
+    """ Keeps the most recent events and lets clients wait for new ones.
+
+    Every event gets a sequence number that is one higher than that of the
+    previous event. Clients remember the number of the last event they have
+    seen and only get the events that were published after it.
+
+    Waiting clients block without a timeout, since on Python 2 waiting on a
+    condition with a timeout polls in intervals of up to 50ms. Instead, a
+    single timer thread wakes them up when their timeout has expired.
+
+    :param maxlen:  Maximum number of events to keep
+    :type maxlen:   int
+    """
+    #: Maximum number of seconds a client may be woken up after its timeout
+    #: has expired
+    timer_resolution = 1.0
+
+    def __init__(self, maxlen=2048):
+        self._events = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self._last_seq = 0
+        # Heap of the deadlines of all waiting clients
+        self._deadlines = []
+        self._timer = None
+
+    @property
+    def last_seq(self):
+        """ Sequence number of the most recent event, 0 if there is none. """
+        return self._last_seq
+
+    def publish(self, event):
+        """ Add an event and wake up all waiting clients.
+
+        :param event:   The event
+        :type event:    :py:class:`Event`
+        """
+        with self._cond:
+            self._last_seq += 1
+            event.seq = self._last_seq
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def clear(self):
+        with self._cond:
+            self._events.clear()
+
+    def get_latest(self, count=None):
+        """ Get the most recent events.
+
+        :param count:   Number of events, defaults to all available events
+        :type count:    int
+        :rtype:         tuple of :py:class:`Event`
+        """
+        with self._cond:
+            if count is None:
+                return tuple(self._events)
+            return tuple(itertools.islice(reversed(self._events),
+                                          count))[::-1]
+
+    def get_since(self, seq):
+        """ Get all available events that were published after another event.
+
+        Only the new events are looked at, so this is cheap no matter how
+        many events are kept.
+
+        :param seq:     Sequence number of the last known event
+        :type seq:      int
+        :rtype:         tuple of :py:class:`Event`
+        """
+        with self._cond:
+            return self._get_since(seq)
+
+    def wait(self, seq, timeout):
+        """ Wait for events that are published after another event.
+
+        :param seq:     Sequence number of the last known event
+        :type seq:      int
+        :param timeout: Maximum number of seconds to wait
+        :type timeout:  float
+        :return:        The new events, empty if none were published in time
+        :rtype:         tuple of :py:class:`Event`
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            if seq > self._last_seq:
+                # Client knows events from before a restart of the server
+                seq = self._last_seq
+            if self._last_seq == seq:
+                heapq.heappush(self._deadlines, deadline)
+                if self._timer is None:
+                    self._timer = threading.Thread(target=self._run_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+            try:
+                while self._last_seq <= seq:
+                    if time.time() >= deadline:
+                        return ()
+                    self._cond.wait()
+            finally:
+                if deadline in self._deadlines:
+                    self._deadlines.remove(deadline)
+                    heapq.heapify(self._deadlines)
+            return self._get_since(seq)
+
+    def _run_timer(self):
+        """ Wake up the waiting clients whose timeout has expired, until no
+            more clients are waiting.
+        """
+        while True:
+            with self._cond:
+                now = time.time()
+                expired = False
+                while self._deadlines and self._deadlines[0] <= now:
+                    heapq.heappop(self._deadlines)
+                    expired = True
+                if expired:
+                    self._cond.notify_all()
+                if not self._deadlines:
+                    self._timer = None
+                    return
+                delay = self._deadlines[0] - now
+            # NOTE: Clients that start waiting in the meantime with an
+            #       earlier deadline are only woken up on the next round, so
+            #       we never sleep longer than the timer's resolution.
+            time.sleep(min(delay, self.timer_resolution))
+
+    def _get_since(self, seq):
+        num_new = min(self._last_seq - seq, len(self._events))
+        if num_new <= 0:
+            return ()
+        return tuple(itertools.islice(reversed(self._events),
+                                      num_new))[::-1]
+
+
+class EventCoalescer(object):
+    """ Rate-limit progress events before they are passed on.
+
+    Within each window of `interval` seconds, only the newest progress event
+    for every combination of workflow, step and plugin is delivered. All other
+    events are delivered right away, after the progress events that are
+    still pending, so the order in which the events were emitted is kept.
+
+    :param callback:    Called with every event that is to be delivered
+    :type callback:     callable
+    :param interval:    Length of the window in seconds, progress events are
+                        not coalesced if it is 0
+    :type interval:     float
+    """
+    def __init__(self, callback, interval=0.25):
+        self.callback = callback
+        self.interval = interval
+        self._pending = OrderedDict()
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def push(self, event):
+        """ Deliver an event or hold it back until the window has passed.
+
+        :param event:   The event
+        :type event:    :py:class:`Event`
+        """
+        with self._lock:
+            if self.interval <= 0 or not self._is_progress(event):
+                self._flush()
+                self.callback(event)
+                return
+            # The step is not part of the event, but the workflow is still
+            # in it when the event is emitted
+            key = (getattr(event.sender, 'id', None),
+                   getattr(event.sender, 'step', None),
+                   event.data.get('plugin_name'))
+            self._pending[key] = event
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """ Deliver all pending progress events. """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            _, event = self._pending.popitem(last=False)
+            self.callback(event)
+
+    def _is_progress(self, event):
+        return event.signal is Workflow.on_step_progressed
 
 
 class CustomJSONEncoder(JSONEncoder):
@@ -86,7 +291,7 @@ class CustomJSONEncoder(JSONEncoder):
                                   for imgpath in data['images']]
         elif event.signal is EventHandler.on_log_emit:
             data = data['record']
-        return {'name': name, 'data': data}
+        return {'name': name, 'data': data, 'seq': event.seq}
 
 
 class WorkflowConverter(BaseConverter):
@@ -137,6 +342,203 @@ def get_thumbnail(img_path):
         return scale_image(unicode(img_path), width=160)
 
 
+class DerivativeCache(object):
+    """ Persistent cache for images derived from captured images, e.g.
+        thumbnails or downscaled versions.
+
+    Derivatives are stored as files in a directory, keyed on the path,
+    modification time and size of the source image and the kind of
+    derivative, so they are invalidated automatically when an image is
+    retaken. The least recently used derivatives are removed once the total
+    size of the cache exceeds its limit.
+
+    :param path:        Directory to store the derivatives in
+    :type path:         pathlib.Path
+    :param max_size:    Maximum total size of all derivatives in bytes
+    :type max_size:     int
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        self._lock = threading.Lock()
+        # Size of each cached derivative by key, least recently used first
+        self._entries = OrderedDict()
+        self._total_size = 0
+        entries = []
+        for fpath in self.path.glob('*.jpg'):
+            stat = fpath.stat()
+            entries.append((stat.st_mtime, fpath.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_size += size
+
+    @property
+    def total_size(self):
+        return self._total_size
+
+    def get_key(self, img_path, variant):
+        """ Get the key of a derivative, which also serves as its ETag.
+
+        :param img_path:    Path to the source image
+        :type img_path:     pathlib.Path
+        :param variant:     Kind of derivative, e.g. 'thumb' or 'width-800'
+        :type variant:      unicode
+        :rtype:             unicode
+        """
+        stat = img_path.stat()
+        sha1 = hashlib.sha1()
+        sha1.update(unicode(img_path).encode('utf-8'))
+        sha1.update("{0}:{1}:{2}".format(stat.st_mtime, stat.st_size,
+                                         variant))
+        return sha1.hexdigest()
+
+    def get(self, img_path, variant, generate):
+        """ Get a derivative, generating it if it is not in the cache.
+
+        :param img_path:    Path to the source image
+        :type img_path:     pathlib.Path
+        :param variant:     Kind of derivative, e.g. 'thumb' or 'width-800'
+        :type variant:      unicode
+        :param generate:    Called with the image's path to generate the
+                            derivative
+        :type generate:     callable
+        :return:            Key of the derivative and its data
+        :rtype:             (unicode, bytestring)
+        """
+        key = self.get_key(img_path, variant)
+        data = self._read(key)
+        if data is None:
+            logger.debug("Generating '{0}' derivative for {1}"
+                         .format(variant, img_path))
+            data = generate(img_path)
+            self._write(key, data)
+        return key, data
+
+    def _read(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries[key] = self._entries.pop(key)
+        fpath = self.path / "{0}.jpg".format(key)
+        try:
+            # Keep track of the last access on disk, so the order of the
+            # entries survives a restart
+            os.utime(unicode(fpath), None)
+            with fpath.open('rb') as fp:
+                return fp.read()
+        except (IOError, OSError):
+            with self._lock:
+                self._remove(key)
+            return None
+
+    def _write(self, key, data):
+        fd, tmp_path = tempfile.mkstemp(dir=unicode(self.path),
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, unicode(self.path / "{0}.jpg".format(key)))
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = len(data)
+            self._total_size += len(data)
+            while self._total_size > self.max_size and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)), delete=True)
+
+    def _remove(self, key, delete=False):
+        size = self._entries.pop(key, None)
+        if size is None:
+            return
+        self._total_size -= size
+        if delete:
+            try:
+                (self.path / "{0}.jpg".format(key)).unlink()
+            except OSError:
+                pass
+
+
+class DerivativeGenerator(object):
+    """ Generates derivatives of new images in the background, so they are
+        already cached when a client first requests them.
+
+    :param cache:           Cache to store the derivatives in
+    :type cache:            :py:class:`DerivativeCache`
+    :param variants:        Functions that generate a derivative from an
+                            image's path, by variant
+    :type variants:         dict
+    :param max_workers:     Number of images that are processed at the same
+                            time
+    :type max_workers:      int
+    :param max_pending:     Maximum number of images waiting to be processed,
+                            further images are skipped and their derivatives
+                            are generated on their first request
+    :type max_pending:      int
+    """
+    def __init__(self, cache, variants, max_workers=1, max_pending=64):
+        self.cache = cache
+        self.variants = variants
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._shutdown = False
+        self._stopped = False
+
+    def submit(self, img_paths):
+        """ Schedule the generation of all derivatives for some images.
+
+        :param img_paths:   Paths to the images
+        :type img_paths:    list of pathlib.Path
+        """
+        if self._shutdown:
+            return
+        for img_path in img_paths:
+            if not self._slots.acquire(False):
+                logger.debug("Too many pending images, not generating "
+                             "derivatives for {0}".format(img_path))
+                continue
+            self._executor.submit(self._generate, img_path)
+
+    def shutdown(self, wait=True):
+        """ Stop the generator.
+
+        :param wait:    Wait for all pending images to be processed, if
+                        False, pending images are skipped
+        :type wait:     bool
+        """
+        self._shutdown = True
+        if not wait:
+            self._stopped = True
+        self._executor.shutdown(wait=wait)
+
+    def _generate(self, img_path):
+        try:
+            for variant, generate in self.variants.iteritems():
+                if self._stopped:
+                    return
+                if not img_path.exists():
+                    # Workflow was deleted or image was removed in the
+                    # meantime
+                    return
+                self.cache.get(img_path, variant, generate)
+        except Exception:
+            logger.warning("Could not generate derivatives for {0}"
+                           .format(img_path), exc_info=True)
+        finally:
+            self._slots.release()
+
+
+def get_scaled_variant(width):
+    """ Get the name and generating function of a downscaled derivative.
+
+    :param width:   Width of the derivative
+    :type width:    int
+    :return:        Name of the variant and the generating function
+    :rtype:         (unicode, callable)
+    """
+    return ('width-{0}'.format(width),
+            lambda img_path: scale_image(unicode(img_path), width=width))
+
+
 def find_stick():
     import dbus
     bus = dbus.SystemBus()
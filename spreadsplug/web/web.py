@@ -1,11 +1,8 @@
-import copy
-import itertools
 import logging
 import logging.handlers
 import shutil
 import subprocess
 import time
-from collections import deque
 
 import blinker
 import requests
@@ -13,7 +10,6 @@ import zipstream
 from flask import (abort, json, jsonify, request, send_file, render_template,
                    url_for, redirect, make_response, Response)
 from werkzeug import secure_filename
-from werkzeug.contrib.cache import SimpleCache
 
 import spreads.plugin as plugin
 from spreads.vendor.pathlib import Path
@@ -21,8 +17,8 @@ from spreads.workflow import Workflow
 
 import persistence
 from spreadsplug.web import app
-from util import (get_image_url, WorkflowConverter,
-                  get_thumbnail, find_stick, scale_image)
+from util import (get_image_url, EventBroker, WorkflowConverter,
+                  get_thumbnail, find_stick, get_scaled_variant)
 
 logger = logging.getLogger('spreadsplug.web')
 
@@ -31,11 +27,13 @@ on_transfer_started = signals.signal('transfer:started')
 on_transfer_progressed = signals.signal('transfer:progressed')
 on_transfer_completed = signals.signal('transfer:completed')
 
-# Event Queue for polling endpoints
-event_queue = deque(maxlen=2048)
+# Recent events for polling endpoints
+event_broker = EventBroker()
 
-# Simple dictionary-based cache for expensive calculations
-cache = SimpleCache()
+# Persistent cache for thumbnails and scaled images and the generator that
+# fills it for new images, set up by `setup_app`
+image_cache = None
+derivative_generator = None
 
 # Register custom workflow converter for URL routes
 app.url_map.converters['workflow'] = WorkflowConverter
@@ -207,19 +205,18 @@ def get_events():
     """ Get a list of all events that were emitted on the server.
 
     :param int count:   Number of events to return, default is all in the queue
-    :param float since: Only return events that were emitted after the
-                        (epoch) timestamp
+    :param int since:   Only return events that were emitted after the event
+                        with this sequence number
     """
     count = request.args.get('count', None, int)
-    since = request.args.get('since', None, float)
+    since = request.args.get('since', None, int)
     events = None
     if count:
-        events = tuple(itertools.islice(reversed(event_queue), count))[::-1]
+        events = event_broker.get_latest(count)
     elif since is not None:
-        events = tuple([event for event in event_queue
-                        if event.emitted > since])
+        events = event_broker.get_since(since)
     else:
-        events = tuple(event_queue)
+        events = event_broker.get_latest()
     return make_response(
         json.dumps(events),
         200, {'Content-Type': 'application/json'})
@@ -229,13 +226,12 @@ def get_events():
 def poll_for_events():
     """ Wait for events to be emitted on the server.
 
-    If there is a `last_polled` field in the request cookie, it will return
-    all events that were emitted since that timestamp. This ensures that no
-    events will be missed in a long-polling scenario.
+    If there is a `last_event` field in the request cookie, it will return
+    all events that were emitted after the event with that sequence number.
+    This ensures that no events will be missed in a long-polling scenario.
     """
-    events = None
     start_time = time.time()
-    last_polled = request.cookies.get('last_polled', start_time, float)
+    last_seq = request.cookies.get('last_event', event_broker.last_seq, int)
     # Only record debug logging events when the app is running in
     # debug mode
     if app.config['DEBUG']:
@@ -244,20 +240,21 @@ def poll_for_events():
             and event.data['record'].levelno == logging.DEBUG)
     else:
         skip = lambda event: False
-    while time.time() - start_time < 35:
-        # NOTE: We need to iterate over a copy of the event queue, since
-        #       it might change its content while we iterate
-        events = tuple(event for event in copy.copy(event_queue)
-                       if event.emitted > last_polled and not skip(event))
+    while True:
+        remaining = 35 - (time.time() - start_time)
+        if remaining <= 0:
+            abort(408)  # Request Timeout
+        events = event_broker.wait(last_seq, timeout=remaining)
+        if not events:
+            continue
+        last_seq = events[-1].seq
+        events = tuple(event for event in events if not skip(event))
         if events:
             resp = make_response(
                 json.dumps(events),
                 200, {'Content-Type': 'application/json'})
-            resp.set_cookie('last_polled', str(events[-1].emitted))
+            resp.set_cookie('last_event', unicode(last_seq))
             return resp
-        else:
-            time.sleep(.1)
-    abort(408)  # Request Timeout
 
 
 @app.route('/workflow/<workflow:workflow>/download', methods=['GET'],
@@ -404,6 +401,9 @@ def upload_workflow_image(workflow):
     if file and allowed(file.filename):
         filename = secure_filename(file.filename)
         file.save(unicode(save_path/filename))
+        workflow.add_images(save_path/filename)
+        if derivative_generator is not None:
+            derivative_generator.submit([save_path/filename])
         return "OK"
 
 
@@ -413,32 +413,37 @@ def get_workflow_image(workflow, img_num):
     """ Return image from requested workflow. """
     # Scale image if requested
     width = request.args.get('width', None)
-    try:
-        img_path = workflow.images[img_num]
-    except IndexError:
+    img_path = workflow.get_image(img_num)
+    if img_path is None:
         abort(404)
     if width:
-        return scale_image(unicode(img_path), width=int(width))
+        variant, generate = get_scaled_variant(int(width))
+        return _get_derivative_response(img_path, variant, generate)
     else:
-        return send_file(unicode(img_path))
+        return send_file(unicode(img_path), conditional=True)
 
 
 @app.route('/workflow/<workflow:workflow>/image/<int:img_num>/thumb',
            methods=['GET'])
 def get_workflow_image_thumb(workflow, img_num):
     """ Return thumbnail for image from requested workflow. """
-    try:
-        img_path = workflow.images[img_num]
-    except IndexError:
+    img_path = workflow.get_image(img_num)
+    if img_path is None:
         abort(404)
-    cache_key = "{0}.{1}".format(workflow, img_num)
-    thumbnail = None
-    if not request.args:
-        thumbnail = cache.get(cache_key)
-    if thumbnail is None:
-        thumbnail = get_thumbnail(img_path)
-        cache.set(cache_key, thumbnail)
-    return Response(thumbnail, mimetype='image/jpeg')
+    return _get_derivative_response(img_path, 'thumb', get_thumbnail)
+
+
+def _get_derivative_response(img_path, variant, generate):
+    """ Respond with a cached derivative of an image, or with
+        '304 Not Modified' if the client already has the current version.
+    """
+    etag = image_cache.get_key(img_path, variant)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': '"{0}"'.format(etag)})
+    etag, data = image_cache.get(img_path, variant, generate)
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(etag)
+    return response
 
 
 # ================= #
@@ -1,17 +1,31 @@
 import json
+import logging
 import threading
+from collections import OrderedDict
+from itertools import count
 
 from tornado import websocket, web, ioloop
 
 from util import CustomJSONEncoder
 
+logger = logging.getLogger('spreadsplug.web.websockets')
+
 
 class SocketHandler(websocket.WebSocketHandler):
     # This is a class attribute valid for all SocketHandler objects, used
     # to store a reference to all open websockets.
     clients = []
 
+    #: Maximum number of messages that are kept for a client that can not
+    #: keep up, the oldest ones are dropped first
+    max_pending = 256
+
+    _message_ids = count()
+
     def open(self):
+        # Messages that could not be written yet, since the client is still
+        # busy receiving earlier ones
+        self.pending = OrderedDict()
         if self not in self.clients:
             self.clients.append(self)
 
@@ -19,8 +33,42 @@ class SocketHandler(websocket.WebSocketHandler):
         if self in self.clients:
             self.clients.remove(self)
 
+    def send(self, message, coalesce_key=None):
+        """ Send a message or queue it if the client is busy.
+
+        Must only be called from the IOLoop thread.
+
+        :param message:         Encoded message
+        :type message:          unicode
+        :param coalesce_key:    Queued messages with the same key are
+                                replaced by this message
+        """
+        if coalesce_key is None:
+            coalesce_key = next(self._message_ids)
+        self.pending.pop(coalesce_key, None)
+        self.pending[coalesce_key] = message
+        if len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+            logger.debug("Client is too slow, dropped a message.")
+        self.flush()
+
+    def flush(self):
+        """ Write queued messages until the client stops keeping up. """
+        while self.pending and not self.stream.writing():
+            _, message = self.pending.popitem(last=False)
+            try:
+                self.write_message(message)
+            except (IOError, AttributeError):
+                # Connection was closed in the meantime
+                self.pending.clear()
+                return
+
 
 class WebSocketServer(threading.Thread):
+    #: Interval (in milliseconds) in which messages that were queued for slow
+    #: clients are sent
+    flush_interval = 100
+
     def __init__(self, port=5001):
         super(WebSocketServer, self).__init__()
         app = web.Application([
@@ -28,15 +76,44 @@ class WebSocketServer(threading.Thread):
         ])
         app.listen(port)
         self._loop = ioloop.IOLoop.instance()
+        self._flusher = ioloop.PeriodicCallback(self._flush_pending,
+                                                self.flush_interval,
+                                                io_loop=self._loop)
 
     def stop(self):
-        self._loop.stop()
+        self._loop.add_callback(self._flusher.stop)
+        self._loop.add_callback(self._loop.stop)
         self.join()
 
     def run(self):
+        self._flusher.start()
         self._loop.start()
 
     def send_event(self, event):
+        """ Send an event to all connected clients.
+
+        Can be called from any thread, the event is encoded once and the
+        sending itself happens in the IOLoop thread, so this never blocks
+        on slow clients.
+
+        :param event:   The event
+        :type event:    :py:class:`spreadsplug.web.util.Event`
+        """
         data = json.dumps(event, cls=CustomJSONEncoder)
-        for sock in SocketHandler.clients:
-            sock.write_message(data)
+        self._loop.add_callback(self._broadcast, data,
+                                self._get_coalesce_key(event))
+
+    def _get_coalesce_key(self, event):
+        # Only the most recent progress is of interest to slow clients
+        if event.signal.name == 'workflow:progressed':
+            return (event.signal.name, getattr(event.sender, 'id', None),
+                    event.data.get('plugin_name'))
+
+    def _broadcast(self, data, coalesce_key):
+        for sock in tuple(SocketHandler.clients):
+            sock.send(data, coalesce_key)
+
+    def _flush_pending(self):
+        for sock in tuple(SocketHandler.clients):
+            if sock.pending:
+                sock.flush()
@@ -1,29 +1,58 @@
-import mock
+import shutil
 
+import mock
+import pytest
+from spreads.util import get_exif_orientation, set_exif_orientation
 from spreads.vendor.pathlib import Path
 
 import spreadsplug.autorotate as autorotate
 
 
-def test_process():
+@pytest.fixture
+def project(tmpdir):
+    raw_dir = tmpdir.join('raw')
+    raw_dir.mkdir()
+    for idx in xrange(4):
+        img = raw_dir.join('{0:03}.jpg'.format(idx))
+        shutil.copyfile('./tests/data/even.jpg', unicode(img))
+        if idx % 2:
+            set_exif_orientation(unicode(img), 6)
+    raw_dir.join('foo.txt').write('')
+    return Path(unicode(tmpdir))
+
+
+def test_process(project):
     # No need for confit.Configuration, since the plugin doesn't have any
     # configuration
     config = {'autorotate': None}
-    path = mock.MagicMock(wraps=Path('/tmp/foobar'))
-    files = [Path('001.jpg'), Path('002.jpg'), Path('003.jpg'),
-             Path('004.jpg'), Path('foo.txt')]
-    (path/'raw').iterdir.return_value = files
-
-    with mock.patch('concurrent.futures.ProcessPoolExecutor') as mockctx:
-        plugin = autorotate.AutoRotatePlugin(config)
-        pool = mockctx.return_value.__enter__.return_value
-        plugin.process(path)
-        # The text file should not have been passed
-        assert pool.submit.call_count == 4
-        # We only want the second parameter to submit, the first is the
-        # function to call
-        assert sorted([unicode(x) for x in files[:-1]]) == (
-            sorted(x[0][1] for x in pool.submit.call_args_list))
+    plugin = autorotate.AutoRotatePlugin(config)
+    progress = []
+    plugin.on_progressed.connect(
+        lambda sender, **kwargs: progress.append(kwargs['progress']),
+        sender=plugin, weak=False)
+    with mock.patch('spreadsplug.autorotate.autorotate_image',
+                    wraps=autorotate.autorotate_image) as rotate:
+        plugin.process(project)
+        # Only the images that are not upright should have been passed
+        assert (sorted(x[0][0] for x in rotate.call_args_list) ==
+                [unicode(project/'raw'/'001.jpg'),
+                 unicode(project/'raw'/'003.jpg')])
+        assert sorted(progress) == [0.5, 1.0]
+        for img in (project/'raw').glob('*.jpg'):
+            assert get_exif_orientation(unicode(img)) in (1, None)
+
+        # Nothing has to be done for a second run
+        rotate.reset_mock()
+        with mock.patch('spreadsplug.autorotate.get_exif_orientation') as get:
+            plugin.process(project)
+            assert get.call_count == 0
+        assert rotate.call_count == 0
+
+        # A retaken image is checked again
+        set_exif_orientation(unicode(project/'raw'/'002.jpg'), 8)
+        plugin.process(project)
+        assert ([x[0][0] for x in rotate.call_args_list] ==
+                [unicode(project/'raw'/'002.jpg')])
 
 
 def test_autorotate_image():
@@ -1,3 +1,5 @@
+import sys
+import time
 from contextlib import nested
 
 import mock
@@ -6,6 +8,7 @@ import spreads.vendor.confit as confit
 
 import spreads.util as util
 import spreadsplug.dev.chdkcamera as chdkcamera
+from spreads.vendor.pathlib import Path
 
 
 @pytest.fixture
@@ -34,6 +37,35 @@ def camera_nomock(usb, gtp, lua, config):
     return chdkcamera.CHDKCameraDevice(config, usbdev)
 
 
+@pytest.fixture
+def fake_chdkptp(tmpdir):
+    """ Minimal stand-in for the interactive chdkptp command line. """
+    script = tmpdir.join('chdkptp')
+    script.write("""#!{0}
+import re, sys, time
+while True:
+    sys.stdout.write("con> ")
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line or line.strip() == "quit":
+        break
+    line = line.strip()
+    if line.startswith("!print("):
+        print(line[8:-2])
+    elif line.startswith("luar "):
+        print("{{0}}:return:{{0}}".format(
+            re.findall(r"return (\\d+)", line)[-1]))
+    elif line == "crash":
+        sys.exit(1)
+    elif line == "hang":
+        time.sleep(60)
+    else:
+        print("ERROR: unknown command")
+""".format(sys.executable))
+    script.chmod(0o755)
+    return Path(unicode(tmpdir))
+
+
 @pytest.yield_fixture
 def camera(camera_nomock):
     with nested(
@@ -77,14 +109,70 @@ def test_yield_devices(usb, lua, config):
     mock_devs[-2].bus, mock_devs[-2].address = 2, 1
     usb.core.find.return_value = mock_devs
     lua.return_value = {'build_revision': 3000}
-    usb.util.get_string.side_effect = (b'12345678\x00\x00\x00',
-                                       b'87654321\x00\x00\x00')
+    serials = {1: b'87654321\x00\x00\x00', 2: b'12345678\x00\x00\x00'}
+    usb.util.get_string.side_effect = lambda dev, *args: serials[dev.bus]
     devs = list(chdkcamera.CHDKCameraDevice.yield_devices(config))
     assert len(devs) == 2
     assert devs[0]._serial_number == '12345678'
     assert devs[1]._serial_number == '87654321'
 
 
+def _mock_ptp_devices(num):
+    cfg = mock.Mock(bInterfaceClass=0x6, bInterfaceSubClass=0x1)
+    devs = [mock.Mock(bus=idx, address=1) for idx in xrange(1, num+1)]
+    for dev in devs:
+        dev.get_active_configuration.return_value = {(0, 0): cfg}
+    return devs
+
+
+@mock.patch('spreadsplug.dev.chdkcamera.CHDKCameraDevice.__init__')
+@mock.patch('spreadsplug.dev.chdkcamera.usb')
+def test_yield_devices_partial_failure(usb, init, config):
+    usb.core.find.return_value = _mock_ptp_devices(3)
+
+    def fake_init(config, dev):
+        if dev.bus == 2:
+            raise chdkcamera.CHDKPTPException("foo")
+    init.side_effect = fake_init
+    devs = list(chdkcamera.CHDKCameraDevice.yield_devices(config))
+    assert len(devs) == 2
+
+
+@mock.patch('spreadsplug.dev.chdkcamera.CHDKCameraDevice.__init__')
+@mock.patch('spreadsplug.dev.chdkcamera.usb')
+def test_yield_devices_concurrent(usb, init, config):
+    usb.core.find.return_value = _mock_ptp_devices(3)
+    init.side_effect = lambda config, dev: time.sleep(0.3)
+    start = time.time()
+    devs = list(chdkcamera.CHDKCameraDevice.yield_devices(config))
+    assert len(devs) == 3
+    assert time.time() - start < 0.8
+
+
+@mock.patch('spreadsplug.dev.chdkcamera.CHDKCameraDevice.__init__')
+@mock.patch('spreadsplug.dev.chdkcamera.usb')
+def test_yield_devices_timeout(usb, init, config):
+    config['init_timeout'] = 0.1
+    usb.core.find.return_value = _mock_ptp_devices(2)
+
+    def fake_init(config, dev):
+        if dev.bus == 1:
+            time.sleep(0.5)
+    init.side_effect = fake_init
+    with mock.patch.object(chdkcamera.CHDKCameraDevice, '_close_session'):
+        devs = list(chdkcamera.CHDKCameraDevice.yield_devices(config))
+    assert len(devs) == 1
+
+
+@mock.patch('spreadsplug.dev.chdkcamera.CHDKCameraDevice.__init__')
+@mock.patch('spreadsplug.dev.chdkcamera.usb')
+def test_yield_devices_all_failed(usb, init, config):
+    usb.core.find.return_value = _mock_ptp_devices(2)
+    init.side_effect = chdkcamera.CHDKPTPException("foo")
+    with pytest.raises(util.DeviceException):
+        list(chdkcamera.CHDKCameraDevice.yield_devices(config))
+
+
 @mock.patch('spreadsplug.dev.chdkcamera.CHDKCameraDevice._execute_lua')
 @mock.patch('spreadsplug.dev.chdkcamera.usb')
 def test_init_noremote(usb, lua, config):
@@ -103,11 +191,22 @@ def test_connected(usb, camera):
 
 
 @mock.patch('spreadsplug.dev.chdkcamera.usb')
-def test_reconnected(usb, camera):
+def test_reconnected(usb, camera_nomock):
+    camera = camera_nomock
+    camera._persistent_session = True
+    session = camera._session = mock.Mock()
     newdev = mock.Mock(bus=3, address=1)
     usb.core.find.side_effect = [None, newdev]
     assert camera.connected()
+    # The port is only switched before the next command is run
+    assert camera._usbport != (3, 1)
+    assert not session.close.called
+    with mock.patch.object(chdkcamera, 'CHDKPTPSession') as new_session:
+        new_session.return_value.execute.return_value = []
+        camera._run('rec')
+    assert session.close.called
     assert camera._usbport == (3, 1)
+    assert "-c-d=001 -b=003" in new_session.call_args[0][0]
 
 
 @mock.patch('spreadsplug.dev.chdkcamera.usb')
@@ -148,15 +247,29 @@ def test_get_preview_image(mock_open, camera):
     assert camera.get_preview_image() == 'foobar'
 
 
+@mock.patch('spreadsplug.dev.chdkcamera.set_exif_orientation')
 @mock.patch('spreadsplug.dev.chdkcamera.JPEGImage')
-def test_capture(jpeg, camera):
+def test_capture(jpeg, set_orientation, camera):
     jpeg.return_value = mock.Mock()
+    set_orientation.return_value = True
     camera.capture('/tmp/000')
     assert camera._run.call_count == 1
     assert camera._run.call_args_list[0][0][0].startswith('remoteshoot')
-    assert jpeg.called_once_with('/tmp/000.jpg')
+    camera.complete_capture('/tmp/000')
+    set_orientation.assert_called_once_with('/tmp/000.jpg', 6)
+    assert jpeg.call_count == 0
+
+
+@mock.patch('spreadsplug.dev.chdkcamera.JPEGImage')
+def test_complete_capture_no_orientation(jpeg, camera, tmpdir):
+    # Image without any EXIF data has to be re-saved
+    img_path = tmpdir.join('000.jpg')
+    img_path.write_binary(b'\xff\xd8\xff\xda\x00\x02')
+    jpeg.return_value = mock.Mock()
+    camera.complete_capture(unicode(tmpdir.join('000')))
+    jpeg.assert_called_once_with(unicode(img_path))
     assert jpeg.return_value.exif_orientation == 6
-    assert jpeg.return_value.save.called_once_with('/tmp/000.jpg')
+    jpeg.return_value.save.assert_called_once_with(unicode(img_path))
 
 
 @mock.patch('spreadsplug.dev.chdkcamera.JPEGImage')
@@ -197,6 +310,7 @@ def test_capture_error(camera):
 
 @mock.patch('spreadsplug.dev.chdkcamera.subprocess')
 def test_run(sp, camera_nomock):
+    camera_nomock._persistent_session = False
     sp.check_output.return_value = (
         "connected: foo bar \n"
         "asdf")
@@ -210,6 +324,7 @@ def test_run(sp, camera_nomock):
 
 @mock.patch('spreadsplug.dev.chdkcamera.subprocess')
 def test_run_with_error(sp, camera_nomock):
+    camera_nomock._persistent_session = False
     sp.check_output.return_value = (
         "connected: foo bar \n"
         "ERROR: foobar")
@@ -218,18 +333,92 @@ def test_run_with_error(sp, camera_nomock):
         assert 'ERROR: foobar' in exc.message
 
 
+def test_run_session(fake_chdkptp, camera_nomock):
+    camera_nomock._chdkptp_path = fake_chdkptp
+    output = camera_nomock._run('luar return 1', 'luar return 2')
+    assert output == ["1:return:1", "2:return:2"]
+    session = camera_nomock._session
+    assert camera_nomock._run('luar return 3') == ["3:return:3"]
+    assert camera_nomock._session is session
+    camera_nomock._close_session()
+
+
+def test_run_session_with_error(fake_chdkptp, camera_nomock):
+    camera_nomock._chdkptp_path = fake_chdkptp
+    with pytest.raises(chdkcamera.CHDKPTPException):
+        camera_nomock._run('foobar')
+    # Session is still usable after an error
+    assert camera_nomock._run('luar return 1') == ["1:return:1"]
+    camera_nomock._close_session()
+
+
+def test_session_restart(fake_chdkptp):
+    session = chdkcamera.CHDKPTPSession(
+        [unicode(fake_chdkptp / "chdkptp")])
+    assert session.execute('luar return 1') == ["1:return:1"]
+    with pytest.raises(chdkcamera.CHDKPTPException):
+        session.execute('crash')
+    assert not session.running
+    assert session.execute('luar return 2') == ["2:return:2"]
+    session.close()
+
+
+def test_session_timeout(fake_chdkptp):
+    session = chdkcamera.CHDKPTPSession(
+        [unicode(fake_chdkptp / "chdkptp")])
+    with pytest.raises(chdkcamera.CHDKPTPException):
+        session.execute('hang', timeout=0.5)
+    assert not session.running
+    assert session.execute('luar return 1') == ["1:return:1"]
+    session.close()
+
+
+def test_session_multiline(fake_chdkptp):
+    session = chdkcamera.CHDKPTPSession(
+        [unicode(fake_chdkptp / "chdkptp")])
+    assert session.execute('luar a = 1\nreturn 4') == ["4:return:4"]
+    session.close()
+
+
+def test_session_multiline_comments(fake_chdkptp):
+    session = chdkcamera.CHDKPTPSession(
+        [unicode(fake_chdkptp / "chdkptp")])
+    assert session.execute('luar a = 1 -- return 3\nreturn 4') == [
+        "4:return:4"]
+    session.close()
+
+
+def test_flatten_lua():
+    script = ('a = "--foo" -- comment\n'
+              'b = \'\\\'--\' --[[ block\ncomment ]]c = 1\n'
+              'return a')
+    assert chdkcamera.flatten_lua(script) == (
+        'a = "--foo"  b = \'\\\'--\'  c = 1 return a')
+
+
+def test_run_session_timeout(camera_nomock):
+    camera_nomock._persistent_session = True
+    camera_nomock._session = mock.Mock()
+    camera_nomock._session.execute.return_value = []
+    camera_nomock.capture('/tmp/000')
+    camera_nomock._session.execute.assert_called_with(
+        mock.ANY, timeout=chdkcamera.LONG_COMMAND_TIMEOUT)
+
+
 def test_execute_lua(camera_nomock):
     camera = camera_nomock
     with mock.patch.object(camera, '_run') as run:
         camera._execute_lua("foobar")
-        run.assert_called_with("luar foobar")
+        run.assert_called_with("luar foobar",
+                               timeout=chdkcamera.LONG_COMMAND_TIMEOUT)
 
 
 def test_execute_lua_nowait(camera_nomock):
     camera = camera_nomock
     with mock.patch.object(camera, '_run') as run:
         camera._execute_lua("foobar", wait=False)
-        run.assert_called_with("lua foobar")
+        run.assert_called_with("lua foobar",
+                               timeout=chdkcamera.LONG_COMMAND_TIMEOUT)
 
 
 def test_execute_lua_with_get_result(camera_nomock):
@@ -244,14 +433,15 @@ def test_execute_lua_with_get_result_hasreturn(camera_nomock):
     with mock.patch.object(camera, '_run') as run:
         camera._run.return_value = ["10:return:5"]
         out = camera._execute_lua("return moo", get_result=True)
-        run.assert_called_with("luar return moo")
+        run.assert_called_with("luar return moo",
+                               timeout=chdkcamera.LONG_COMMAND_TIMEOUT)
         assert out == 5
 
 
 def test_parse_luatable(camera):
-    data = "table:foo=\"bar\",bar=123"
+    data = "table:foo=\"bar\",bar=123,baz=-1"
     parsed = camera._parse_table(data)
-    assert parsed == {'foo': 'bar', 'bar': 123}
+    assert parsed == {'foo': 'bar', 'bar': 123, 'baz': -1}
 
 
 @mock.patch('__builtin__.open')
@@ -276,22 +466,51 @@ def test_set_zoom(camera):
     camera._execute_lua.assert_called_once_with("set_zoom(7)", wait=True)
 
 
-@mock.patch('spreadsplug.dev.chdkcamera.time.sleep')
-def test_acquire_focus(sleep, camera):
+def test_acquire_focus(camera):
     camera._run.side_effect = chdkcamera.CHDKPTPException()
-    camera._execute_lua.side_effect = (None, None, None, None, None, 300)
+    camera._execute_lua.side_effect = (None, {'focus': 300})
     assert camera._acquire_focus() == 300
     assert camera._run.call_count == 1
+    assert camera._execute_lua.call_count == 2
+    script = camera._execute_lua.call_args[0][0]
+    assert "sleep(800)" in script
+    assert "_r.focus = _v(get_focus())" in script
 
 
-@mock.patch('spreadsplug.dev.chdkcamera.time.sleep')
-def test_set_focus(sleep, camera):
+def test_set_focus(camera):
     camera._focus_distance = 0
     camera._set_focus()
     assert camera._execute_lua.call_count == 1
+    assert "set_focus" not in camera._execute_lua.call_args[0][0]
     camera._focus_distance = 300
     camera._set_focus()
-    assert camera._execute_lua.call_count > 1
+    assert camera._execute_lua.call_count == 2
+    assert "set_focus(300)" in camera._execute_lua.call_args[0][0]
+
+
+def test_prepare_capture_monochrome(camera):
+    camera._shoot_monochrome = True
+    camera._execute_lua.side_effect = (None, {'monochrome': 1})
+    camera.prepare_capture('/tmp/foo')
+    assert camera._execute_lua.call_count == 2
+    script = camera._execute_lua.call_args[0][0]
+    assert 'set_nd_filter(2)' in script
+    assert '_r.monochrome = _v(capmode.set("SCN_MONOCHROME"))' in script
+
+
+def test_lua_batch():
+    batch = (chdkcamera.LuaBatch()
+             .add("set_aflock(0)\nset_nd_filter(2)")
+             .sleep(0.25)
+             .call("get_focus()", 'focus'))
+    assert len(batch) == 3
+    assert batch.has_results
+    script = batch.compile()
+    assert "\n" not in script
+    assert "set_aflock(0) set_nd_filter(2); sleep(250); " in script
+    assert script.endswith("_r.focus = _v(get_focus()); return _r")
+    with pytest.raises(ValueError):
+        batch.call("get_zoom()", 'focus')
 
 
 @mock.patch('spreadsplug.dev.chdkcamera.CanonA2200CameraDevice._execute_lua')
@@ -314,8 +533,8 @@ def test_a2200_yield_devices(usb, lua, config):
         dev.get_active_configuration.return_value = {(0, 0): match_cfg}
     usb.core.find.return_value = mock_devs
     lua.return_value = {'build_revision': 3000}
-    usb.util.get_string.side_effect = (b'12345678\x00\x00\x00',
-                                       b'87654321\x00\x00\x00')
+    serials = {1: b'87654321\x00\x00\x00', 2: b'12345678\x00\x00\x00'}
+    usb.util.get_string.side_effect = lambda dev, *args: serials[dev.bus]
     devs = list(chdkcamera.CHDKCameraDevice.yield_devices(config))
     assert not any(not isinstance(dev, chdkcamera.CanonA2200CameraDevice)
                    for dev in devs)
@@ -335,8 +554,9 @@ def test_a2200_set_zoom(a2200):
     with pytest.raises(ValueError):
         a2200._set_zoom(10)
     with mock.patch.object(a2200, '_execute_lua') as lua:
-        lua.return_value = 1
-        a2200._set_zoom(7)
-        lua.return_value = 8
         a2200._set_zoom(7)
-        assert lua.call_count == 4
+        assert lua.call_count == 1
+        script = lua.call_args[0][0]
+        assert "set_zoom" not in script
+        assert 'while(get_zoom()<8) do click("zoom_in") end' in script
+        assert 'while(get_zoom()>8) do click("zoom_out") end' in script
@@ -175,10 +175,10 @@ def test_output(config, mock_plugin_mgr, tmpdir):
 @patch('spreads.cli.capture')
 @patch('spreads.cli.postprocess')
 @patch('spreads.cli.output')
-def test_wizard(capture, postprocess, output, config):
+def test_wizard(output, postprocess, capture, config):
     cli.wizard(config)
     capture.assert_called_with(config)
-    postprocess.assert_called_with(config)
+    postprocess.assert_called_with(config, capture.return_value)
     output.assert_called_with(config)
 
 
@@ -74,6 +74,24 @@ class TestPluginOutput(spreads.plugin.HookPlugin,
         (path/'output.txt').touch()
 
 
+class TestPluginPage(spreads.plugin.HookPlugin,
+                     spreads.plugin.PageProcessHookMixin):
+    __name__ = 'test_page'
+
+    def __init__(self, config, log, fail_on=None):
+        super(TestPluginPage, self).__init__(config)
+        self.log = log
+        self.fail_on = fail_on
+
+    def process(self, path):
+        pass
+
+    def process_page(self, path, raw_image):
+        if raw_image == self.fail_on:
+            raise ValueError("Failed on {0}".format(raw_image))
+        self.log.append((self, raw_image))
+
+
 class TestDriver(spreads.plugin.DevicePlugin):
     __name__ = 'testdriver'
 
@@ -81,6 +99,7 @@ class TestDriver(spreads.plugin.DevicePlugin):
     num_devices = 2
     target_pages = True
     delay = 0
+    completion_delay = 0
 
     @classmethod
     def yield_devices(cls, config):
@@ -111,6 +130,10 @@ class TestDriver(spreads.plugin.DevicePlugin):
         )
         shutil.copyfile(srcpath, unicode(path)+'.jpg')
 
+    def complete_capture(self, path):
+        if self.completion_delay:
+            time.sleep(self.completion_delay)
+
     def finish_capture(self):
         pass
 
@@ -161,6 +184,11 @@ def mock_driver_mgr():
         dm.__iter__.return_value = [ext]
         get_driver.return_value = dm
         yield get_driver
+    # Stop the monitor for the devices that were created with the driver
+    if spreads.plugin.device_monitor is not None:
+        spreads.plugin.device_monitor.stop()
+        spreads.plugin.device_monitor = None
+    spreads.plugin.devices = None
 
 
 @pytest.yield_fixture(scope='module')
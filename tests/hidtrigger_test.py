@@ -1,30 +1,89 @@
+import os
 import time
-from itertools import chain, repeat
 
 import mock
 import pytest
 
-with mock.patch('cffi.FFI'):
-    import spreadsplug.hidtrigger as hidtrigger
+import spreadsplug.hidtrigger as hidtrigger
+from spreads.util import DeviceException
 
 
 @pytest.fixture
-def plugin():
-    return hidtrigger.HidTrigger(config=None)
-
-
-@mock.patch('spreadsplug.hidtrigger.hidapi.enumerate')
-@mock.patch('spreadsplug.hidtrigger.hidapi.Device')
-def test_trigger_loop(devicecls, hid_enumerate, plugin):
-    mock_dev = mock.Mock()
-    mock_dev.read.side_effect = chain(
-        list(chain(repeat(None, 10), ('foo',), repeat(None, 10), ('bar',)))*6,
-        repeat(None))
-    hid_enumerate.return_value = [mock.Mock(), mock.Mock()]
-    devicecls.return_value = mock_dev
+def plugin(config):
+    config['hidtrigger']['devices'] = u""
+    config['hidtrigger']['debounce_time'] = 0.05
+    return hidtrigger.HidTrigger(config)
+
+
+@pytest.yield_fixture
+def pipes():
+    pipes = [os.pipe() for _ in xrange(2)]
+    yield pipes
+    for _, write_fd in pipes:
+        os.close(write_fd)
+
+
+def test_trigger_loop(plugin, pipes):
+    devs = [("/dev/hidraw{0}".format(idx), read_fd)
+            for idx, (read_fd, _) in enumerate(pipes)]
     mock_cb = mock.Mock()
-    plugin.start_trigger_loop(mock_cb)
-    time.sleep(1.3)
+    with mock.patch.object(plugin, '_find_devices', return_value=devs):
+        plugin.start_trigger_loop(mock_cb)
+    for _ in xrange(3):
+        for _, write_fd in pipes:
+            os.write(write_fd, b'\x00\x05\x00\x00')
+            time.sleep(0.01)
+            os.write(write_fd, b'\x00\x00\x00\x00')
+            time.sleep(0.1)
     plugin.stop_trigger_loop()
     assert not plugin._loop_thread.is_alive()
     assert mock_cb.call_count == 6
+
+
+def test_trigger_loop_nodevices(plugin):
+    with mock.patch.object(plugin, '_find_devices', return_value=[]):
+        plugin.start_trigger_loop(mock.Mock())
+    plugin.stop_trigger_loop()
+    assert plugin._loop_thread is None
+
+
+def test_trigger_loop_open_error(plugin, pipes):
+    read_fd = pipes[0][0]
+
+    def find_devices():
+        yield "/dev/hidraw0", read_fd
+        raise DeviceException("Could not open HID device")
+    with mock.patch.object(plugin, '_find_devices', side_effect=find_devices):
+        with pytest.raises(DeviceException):
+            plugin.start_trigger_loop(mock.Mock())
+    assert not plugin._hid_devs
+    # Descriptor of the first device was closed
+    with pytest.raises(OSError):
+        os.fstat(read_fd)
+
+
+def test_button_debounce():
+    state = hidtrigger._ButtonState(0.05)
+    assert not state.feed(b'\x01', 0.0)
+    assert state.feed(b'\x00', 0.01)
+    # Bouncing contact right after the release
+    assert not state.feed(b'\x01', 0.02)
+    assert not state.feed(b'\x00', 0.03)
+    assert not state.feed(b'\x01', 0.1)
+    assert not state.feed(b'\x01', 0.11)
+    assert state.feed(b'\x00', 0.12)
+
+
+def test_find_devices(plugin, tmpdir):
+    plugin.config['devices'] = u"05f3:00ff"
+    for name, hid_id in (('hidraw0', '0003:0000046D:0000C52B'),
+                         ('hidraw1', '0003:000005F3:000000FF')):
+        tmpdir.join(name, 'device', 'uevent').write(
+            "DRIVER=hid-generic\nHID_ID={0}\n".format(hid_id), ensure=True)
+    sys_paths = sorted(unicode(x) for x in tmpdir.listdir())
+    with mock.patch('spreadsplug.hidtrigger.glob', return_value=sys_paths):
+        with mock.patch('spreadsplug.hidtrigger.os.open',
+                        return_value=3) as os_open:
+            devs = list(plugin._find_devices())
+    assert devs == [('/dev/hidraw1', 3)]
+    assert os_open.call_count == 1
@@ -8,13 +8,61 @@ import spreadsplug.intervaltrigger as intervaltrigger
 
 @pytest.fixture
 def plugin(config):
-    config['intervaltrigger']['interval'] = 0.1
+    # NOTE: On Python 2.7, `Event.wait` polls in steps of up to 50ms, so the
+    #       tests keep half an interval of distance to every tick.
+    config['intervaltrigger']['interval'] = 0.2
+    config['intervaltrigger']['missed_ticks'] = 'skip'
     return intervaltrigger.IntervalTrigger(config)
 
 
 def test_trigger_loop(plugin):
     cbmock = mock.Mock()
     plugin.start_trigger_loop(cbmock)
-    time.sleep(0.6)
+    time.sleep(1.1)
     plugin.stop_trigger_loop()
     assert cbmock.call_count == 5
+
+
+def test_trigger_loop_restart(plugin):
+    cbmock = mock.Mock()
+    plugin.start_trigger_loop(cbmock)
+    # Stopping before the first tick must not fail on the missing rate
+    plugin.stop_trigger_loop()
+    assert cbmock.call_count == 0
+    assert plugin.pages_per_hour == 0.
+
+    plugin.start_trigger_loop(cbmock)
+    time.sleep(0.3)
+    plugin.stop_trigger_loop()
+    plugin.start_trigger_loop(cbmock)
+    # Captures from the previous loop are not counted
+    assert plugin._num_captures == 0
+    plugin.stop_trigger_loop()
+
+
+def test_trigger_loop_compensates_capture_time(plugin):
+    cbmock = mock.Mock(side_effect=lambda: time.sleep(0.1))
+    plugin.start_trigger_loop(cbmock)
+    time.sleep(1.1)
+    plugin.stop_trigger_loop()
+    assert cbmock.call_count == 5
+    assert 5000 < plugin.pages_per_hour < 36000
+
+
+def test_trigger_loop_skip_missed(plugin):
+    cbmock = mock.Mock(side_effect=lambda: time.sleep(0.3))
+    plugin.start_trigger_loop(cbmock)
+    time.sleep(1.1)
+    plugin.stop_trigger_loop()
+    # Ticks at 0.2, 0.6 and 1.0, the ones at 0.4 and 0.8 are skipped
+    assert cbmock.call_count == 3
+
+
+def test_trigger_loop_queue_missed(plugin):
+    plugin.config['missed_ticks'] = 'queue'
+    cbmock = mock.Mock(side_effect=lambda: time.sleep(0.3))
+    plugin.start_trigger_loop(cbmock)
+    time.sleep(1.25)
+    plugin.stop_trigger_loop()
+    # Every capture is started right after the previous one
+    assert cbmock.call_count == 4
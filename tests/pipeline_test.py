@@ -0,0 +1,152 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import pytest
+from spreads.vendor.pathlib import Path
+
+import tests.conftest as conftest
+from spreads.pipeline import PagePipeline
+from spreads.util import ResourceScheduler
+
+
+def test_pipeline(config):
+    log = []
+    first = conftest.TestPluginPage(config, log)
+    second = conftest.TestPluginPage(config, log)
+    progress = []
+    pipeline = PagePipeline(
+        Path('/tmp'), [first, second], num_workers=2,
+        on_progress=lambda plug, img: progress.append((plug, img)))
+    pages = [Path("{0:03}.jpg".format(idx)) for idx in xrange(10)]
+    pipeline.run(pages)
+    assert sorted(img for plug, img in log if plug is first) == pages
+    assert sorted(img for plug, img in log if plug is second) == pages
+    # Every page has to pass the first plugin before the second one
+    for page in pages:
+        assert log.index((first, page)) < log.index((second, page))
+    assert sorted(progress) == sorted(log)
+    # Pages submitted after closing would never be processed
+    with pytest.raises(ValueError):
+        pipeline.put(pages[0])
+
+
+def test_pipeline_overlap(config):
+    # The second plugin has to get the first page while the first plugin
+    # is still blocked on the rest
+    log = []
+    release = threading.Event()
+    first = conftest.TestPluginPage(config, log)
+    second = conftest.TestPluginPage(config, log)
+    pages = [Path("{0:03}.jpg".format(idx)) for idx in xrange(4)]
+
+    def process_page(path, raw_image):
+        if raw_image != pages[0]:
+            assert release.wait(5)
+        log.append((first, raw_image))
+
+    def process_second(path, raw_image):
+        log.append((second, raw_image))
+        release.set()
+
+    first.process_page = process_page
+    second.process_page = process_second
+    # Blocked pages occupy their slots, so there have to be enough for the
+    # second plugin to still get one
+    PagePipeline(Path('/tmp'), [first, second], num_workers=2,
+                 scheduler=ResourceScheduler(4)).run(pages)
+    assert log[:2] == [(first, pages[0]), (second, pages[0])]
+    assert len(log) == 8
+
+
+def test_pipeline_error(config):
+    log = []
+    first = conftest.TestPluginPage(config, log, fail_on=Path('003.jpg'))
+    second = conftest.TestPluginPage(config, log)
+    pages = [Path("{0:03}.jpg".format(idx)) for idx in xrange(10)]
+    pipeline = PagePipeline(Path('/tmp'), [first, second], num_workers=1,
+                            queue_size=1)
+    with pytest.raises(ValueError):
+        pipeline.run(pages)
+    assert (second, Path('003.jpg')) not in log
+
+
+def test_pipeline_resubmit(config):
+    log = []
+    release = threading.Event()
+    first = conftest.TestPluginPage(config, log)
+    second = conftest.TestPluginPage(config, log)
+    page = Path('000.jpg')
+
+    def process_page(path, raw_image):
+        assert release.wait(5)
+        log.append((first, raw_image))
+
+    first.process_page = process_page
+    pipeline = PagePipeline(Path('/tmp'), [first, second], num_workers=2)
+    pipeline.start()
+    pipeline.put(page)
+    pipeline.put(page)
+    release.set()
+    pipeline.close()
+    pipeline.join()
+    # The outdated version must not reach the second plugin
+    assert log.count((second, page)) == 1
+
+
+def test_pipeline_discard(config):
+    log = []
+    started = threading.Event()
+    release = threading.Event()
+    first = conftest.TestPluginPage(config, log)
+    second = conftest.TestPluginPage(config, log)
+    page = Path('000.jpg')
+
+    def process_page(path, raw_image):
+        started.set()
+        assert release.wait(5)
+        log.append((first, raw_image))
+
+    first.process_page = process_page
+    pipeline = PagePipeline(Path('/tmp'), [first, second], num_workers=1,
+                            scheduler=ResourceScheduler(2))
+    pipeline.start()
+    pipeline.put(page)
+    assert started.wait(5)
+    discarding = threading.Thread(target=pipeline.discard, args=(page,))
+    discarding.start()
+    # Has to wait for the plugin that is working on the page
+    time.sleep(0.1)
+    assert discarding.is_alive()
+    release.set()
+    discarding.join(5)
+    assert log == [(first, page)]
+    pipeline.close()
+    pipeline.join()
+    assert (second, page) not in log
+
+
+def test_pipeline_reserved_slots(config):
+    log = []
+    first = conftest.TestPluginPage(config, log)
+    second = conftest.TestPluginPage(config, log)
+    pages = [Path("{0:03}.jpg".format(idx)) for idx in xrange(10)]
+    lock = threading.Lock()
+    active = [0, 0]
+
+    def process_page(path, raw_image):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        log.append((first, raw_image))
+
+    first.process_page = process_page
+    PagePipeline(Path('/tmp'), [first, second], num_workers=3, queue_size=0,
+                 scheduler=ResourceScheduler(3)).run(pages)
+    # One of the slots is always left for the second plugin
+    assert active[1] == 2
+    assert log.index((second, pages[0])) < log.index((first, pages[-1]))
@@ -1,3 +1,6 @@
+import time
+
+import mock
 import pytest
 
 import spreads.plugin as plugin
@@ -35,3 +38,39 @@ def test_bad_driver():
 
     with pytest.raises(TypeError):
         BadDriver(None, None)
+
+
+def test_get_devices_monitor(config, mock_driver_mgr):
+    devices = plugin.get_devices(config, force_reload=True)
+    monitor = plugin.device_monitor
+    assert monitor.devices is devices
+    assert monitor.connected
+    plugin.get_devices(config, force_reload=True)
+    assert plugin.device_monitor is not monitor
+    assert monitor._stopped.is_set()
+
+
+def test_device_monitor_refresh():
+    devs = [mock.Mock(), mock.Mock()]
+    for dev in devs:
+        dev.connected.return_value = True
+    monitor = plugin.DeviceMonitor(devs)
+    assert monitor.refresh()
+    devs[1].connected.return_value = False
+    assert not monitor.refresh()
+    assert not monitor.connected
+
+
+def test_device_monitor_polling():
+    dev = mock.Mock()
+    dev.connected.return_value = True
+    with mock.patch('spreads.plugin.pyudev', None):
+        monitor = plugin.DeviceMonitor([dev], poll_interval=0.05)
+        monitor.start()
+    try:
+        assert monitor.connected
+        dev.connected.return_value = False
+        time.sleep(0.2)
+        assert not monitor.connected
+    finally:
+        monitor.stop()
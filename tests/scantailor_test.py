@@ -1,9 +1,11 @@
+import subprocess
 from itertools import chain, repeat
 import xml.etree.cElementTree as ET
 
 import mock
 import pytest
 import spreads.vendor.confit as confit
+from spreads.util import ResourceScheduler
 from spreads.vendor.pathlib import Path
 
 
@@ -35,10 +37,8 @@ def plugin(pluginclass, config):
         return pluginclass(config)
 
 
-@mock.patch('spreadsplug.scantailor.psutil.Process')
 @mock.patch('spreadsplug.scantailor.subprocess.Popen')
-def test_generate_configuration(popen, proc, plugin):
-    proc.return_value.is_running.return_value = False
+def test_generate_configuration(popen, plugin):
     # TODO: Setup up some config variables
     imgdir = mock.MagicMock(wraps=Path('/tmp/raw'))
     imgs = [imgdir/"foo.jpg", imgdir/"bar.jpg"]
@@ -49,10 +49,8 @@ def test_generate_configuration(popen, proc, plugin):
     # TODO: Check the sp.call for the correct parameters
 
 
-@mock.patch('spreadsplug.scantailor.psutil.Process')
 @mock.patch('spreadsplug.scantailor.subprocess.Popen')
-def test_generate_configuration_noenhanced(popen, proc, config, pluginclass):
-    proc.return_value.is_running.return_value = False
+def test_generate_configuration_noenhanced(popen, config, pluginclass):
     # TODO: Setup up some config variables
     with mock.patch('subprocess.check_output') as mock_co:
         mock_co.return_value = "".join(chain(
@@ -70,8 +68,8 @@ def test_generate_configuration_noenhanced(popen, proc, config, pluginclass):
 
 
 def test_split_configuration(plugin, tmpdir):
-    with mock.patch('spreadsplug.scantailor.multiprocessing.cpu_count') as cnt:
-        cnt.return_value = 4
+    with mock.patch('spreadsplug.scantailor.scheduler',
+                    ResourceScheduler(4)):
         splitfiles = plugin._split_configuration(
             Path('./tests/data/test.scanTailor'), Path(unicode(tmpdir)))
     assert len(splitfiles) == 4
@@ -80,11 +78,170 @@ def test_split_configuration(plugin, tmpdir):
         assert len(tree.find('./{0}'.format(elem))) == 7
 
 
+def test_split_configuration_weighted(plugin, tmpdir):
+    tree = ET.parse('./tests/data/test.scanTailor')
+    # Make the first four files (and their split pages) much more expensive
+    for image in tree.findall('./images/image')[:4]:
+        image.set('subPages', '2')
+    pages = tree.find('./pages')
+    for page in list(pages)[:4]:
+        pages.append(ET.Element('page', imageId=page.get('imageId'),
+                                subPage='right', id='1{0}'.format(
+                                    page.get('id'))))
+    for page in tree.findall('./filters/output/page'):
+        if page.get('id') in ('4', '7', '10', '13'):
+            page.find('./params').set('dewarpingMode', 'auto')
+    projectfile = tmpdir.join('weighted.ScanTailor')
+    tree.write(unicode(projectfile))
+    splitfiles = plugin._split_configuration(
+        Path(unicode(projectfile)), Path(unicode(tmpdir)), num_pieces=4)
+    file_names = []
+    for splitfile in splitfiles:
+        split_tree = ET.parse(unicode(splitfile))
+        file_ids = set(x.get('id') for x in split_tree.findall('./files/file'))
+        image_ids = set(x.get('id')
+                        for x in split_tree.findall('./images/image')
+                        if x.get('fileId') in file_ids)
+        assert len(image_ids) == len(file_ids)
+        assert all(x.get('imageId') in image_ids
+                   for x in split_tree.findall('./pages/page'))
+        file_names.append(
+            [x.get('name') for x in split_tree.findall('./files/file')])
+    # The expensive files are spread over fewer pieces
+    assert len(next(x for x in file_names if '000.jpg' in x)) < 7
+    assert sorted(sum(file_names, [])) == ['{0:03}.jpg'.format(i)
+                                           for i in xrange(28)]
+
+
+@pytest.fixture
+def project(tmpdir):
+    """ Copy of the test project with actual input images. """
+    raw_dir = tmpdir.join('raw')
+    raw_dir.mkdir()
+    tree = ET.parse('./tests/data/test.scanTailor')
+    tree.find('./directories/directory').set('path', unicode(raw_dir))
+    for fname in tree.findall('./files/file'):
+        raw_dir.join(fname.get('name')).write(fname.get('name'))
+    tree.write(unicode(tmpdir.join('test.ScanTailor')))
+    return Path(unicode(tmpdir.join('test.ScanTailor')))
+
+
+def fake_scantailor(out_dir, fail_on=None):
+    def dummy_popen(args):
+        tree = ET.parse(args[2])
+        names = [x.get('name') for x in tree.findall('./files/file')]
+        if fail_on in names:
+            return mock.Mock(**{'wait.return_value': 1})
+        for name in names:
+            out_dir.join(name.replace('.jpg', '.tif')).write('')
+        return mock.Mock(**{'wait.return_value': 0})
+    return dummy_popen
+
+
+def get_processed(popen):
+    return sorted(fname.get('name') for args in popen.call_args_list
+                  for fname in ET.parse(args[0][0][2]).findall('./files/file'))
+
+
+@mock.patch('spreadsplug.scantailor.scheduler', ResourceScheduler(2))
+@mock.patch('spreadsplug.scantailor.shutil.rmtree', mock.Mock())
+@mock.patch('spreadsplug.scantailor.subprocess.Popen')
+def test_generate_output(popen, plugin, project, tmpdir):
+    out_dir = tmpdir.join('done')
+    popen.side_effect = fake_scantailor(out_dir)
+    progress = []
+    plugin.on_progressed.connect(
+        lambda sender, **kwargs: progress.append(kwargs['progress']),
+        sender=plugin, weak=False)
+    plugin._generate_output(project, Path(unicode(out_dir)))
+    assert popen.call_count == 6
+    assert len(out_dir.listdir()) == 28
+    assert progress[-1] == 1.0
+
+
+@mock.patch('spreadsplug.scantailor.scheduler', ResourceScheduler(2))
+@mock.patch('spreadsplug.scantailor.shutil.rmtree', mock.Mock())
 @mock.patch('spreadsplug.scantailor.subprocess.Popen')
-def test_generate_output(popen, plugin):
-        plugin._split_configuration = mock.Mock(
-            return_value=['foo.st', 'bar.st'])
-        plugin._generate_output('/tmp/foo.st', Path('/tmp'), 8)
+def test_generate_output_incremental(popen, plugin, project, tmpdir):
+    out_dir = tmpdir.join('done')
+    popen.side_effect = fake_scantailor(out_dir)
+    plugin._generate_output(project, Path(unicode(out_dir)))
+    assert len(get_processed(popen)) == 28
+
+    popen.reset_mock()
+    plugin._generate_output(project, Path(unicode(out_dir)))
+    assert popen.call_count == 0
+
+    # Retake of a page
+    tmpdir.join('raw', '003.jpg').write('retake')
+    plugin._generate_output(project, Path(unicode(out_dir)))
+    assert get_processed(popen) == ['003.jpg']
+
+    # Changed settings for a page and a missing output file
+    popen.reset_mock()
+    tree = ET.parse(unicode(project))
+    tree.find('./filters/output/page[@id="7"]/params').set(
+        'despeckleLevel', 'aggressive')
+    tree.write(unicode(project))
+    out_dir.join('010.tif').remove()
+    plugin._generate_output(project, Path(unicode(out_dir)))
+    assert get_processed(popen) == ['001.jpg', '010.jpg']
+
+
+@mock.patch('spreadsplug.scantailor.scheduler', ResourceScheduler(2))
+@mock.patch('spreadsplug.scantailor.shutil.rmtree', mock.Mock())
+@mock.patch('spreadsplug.scantailor.subprocess.Popen')
+def test_generate_output_failed(popen, plugin, project, tmpdir):
+    out_dir = tmpdir.join('done')
+    popen.side_effect = fake_scantailor(out_dir)
+    plugin._generate_output(project, Path(unicode(out_dir)))
+
+    # The outdated output of a retaken page must not be marked as up to date
+    # when scantailor-cli failed on it
+    tmpdir.join('raw', '003.jpg').write('retake')
+    popen.side_effect = fake_scantailor(out_dir, fail_on='003.jpg')
+    with pytest.raises(subprocess.CalledProcessError):
+        plugin._generate_output(project, Path(unicode(out_dir)))
+    popen.reset_mock()
+    popen.side_effect = fake_scantailor(out_dir)
+    plugin._generate_output(project, Path(unicode(out_dir)))
+    assert get_processed(popen) == ['003.jpg']
+
+
+@mock.patch('spreadsplug.scantailor.subprocess.Popen')
+def test_process_pages(popen, plugin, project, tmpdir):
+    out_dir = tmpdir.join('done')
+    popen.side_effect = fake_scantailor(out_dir)
+    plugin._prepare_project = mock.Mock(
+        return_value=(project, Path(unicode(out_dir))))
+    path = Path(unicode(tmpdir))
+    plugin.prepare_process(path)
+    plugin.process_page(path, path/'raw'/'003.jpg')
+    assert get_processed(popen) == ['003.jpg']
+    for idx in xrange(28):
+        plugin.process_page(path, path/'raw'/'{0:03}.jpg'.format(idx))
+    plugin.finish_process(path)
+    assert len(out_dir.listdir()) == 28
+    assert tmpdir.join('.cache', 'scantailor.json').exists()
+
+    popen.reset_mock()
+    plugin.prepare_process(path)
+    plugin.process_page(path, path/'raw'/'003.jpg')
+    plugin.finish_process(path)
+    assert popen.call_count == 0
+
+    tmpdir.join('raw', '003.jpg').write('retake')
+    popen.side_effect = fake_scantailor(out_dir, fail_on='003.jpg')
+    plugin.prepare_process(path)
+    with pytest.raises(subprocess.CalledProcessError):
+        plugin.process_page(path, path/'raw'/'003.jpg')
+    plugin.finish_process(path)
+    popen.reset_mock()
+    popen.side_effect = fake_scantailor(out_dir)
+    plugin.prepare_process(path)
+    plugin.process_page(path, path/'raw'/'003.jpg')
+    assert get_processed(popen) == ['003.jpg']
+    plugin.finish_process(path)
 
 
 @mock.patch('spreadsplug.scantailor.subprocess.call')
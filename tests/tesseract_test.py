@@ -1,6 +1,6 @@
 import re
 import shutil
-import time
+import sys
 import xml.etree.cElementTree as ET
 
 import mock
@@ -34,15 +34,17 @@ def plugin(pluginclass, config):
     return pluginclass(config)
 
 
-def test_perform_ocr(plugin, tmpdir):
-    def dummy_poll():
-        time.sleep(0.5)
-        return True
+def _mock_proc(returncode=0):
+    proc = mock.Mock(returncode=returncode)
+    proc.communicate.return_value = (None, b'')
+    return proc
+
 
+def test_perform_ocr(plugin, tmpdir):
     def dummy_popen(args, stderr, stdout):
         if int(Path(args[2]).stem) % 2:
             shutil.copyfile('./tests/data/001.hocr', args[2]+'.html')
-        return mock.Mock(side_effect=dummy_poll)
+        return _mock_proc()
     imgdir = tmpdir.join('/done')
     imgdir.mkdir()
     for i in xrange(10):
@@ -54,6 +56,79 @@ def test_perform_ocr(plugin, tmpdir):
         assert imgdir.join(img.purebasename + 'html').exists()
 
 
+def test_perform_ocr_cached(plugin, tmpdir):
+    def dummy_popen(args, stderr, stdout):
+        shutil.copyfile('./tests/data/001.hocr', args[2]+'.html')
+        return _mock_proc()
+    imgdir = tmpdir.join('done')
+    imgdir.mkdir()
+    for i in xrange(5):
+        imgdir.join('{0:03}.tif'.format(i)).write('image{0}'.format(i))
+    progress = []
+    plugin.on_progressed.connect(
+        lambda sender, **kwargs: progress.append(kwargs['progress']),
+        sender=plugin, weak=False)
+    with mock.patch('spreadsplug.tesseract.subprocess.Popen') as popen:
+        popen.side_effect = dummy_popen
+        plugin._perform_ocr(Path(unicode(imgdir)), 'eng')
+        assert popen.call_count == 5
+        assert sorted(progress)[-1] == 1.0
+        assert len(tmpdir.join('.cache', 'tesseract').listdir('*.html')) == 5
+
+        imgdir.join('003.html').remove()
+        plugin._perform_ocr(Path(unicode(imgdir)), 'eng')
+        assert popen.call_count == 5
+        assert imgdir.join('003.html').exists()
+
+        imgdir.join('002.tif').write('changed')
+        plugin._perform_ocr(Path(unicode(imgdir)), 'eng')
+        assert popen.call_count == 6
+        plugin._perform_ocr(Path(unicode(imgdir)), 'fra')
+        assert popen.call_count == 11
+        # Results that no longer belong to any image are removed
+        assert len(tmpdir.join('.cache', 'tesseract').listdir('*.html')) == 5
+
+        imgdir.join('004.tif').remove()
+        plugin._perform_ocr(Path(unicode(imgdir)), 'fra')
+        assert popen.call_count == 11
+        assert len(tmpdir.join('.cache', 'tesseract').listdir('*.html')) == 4
+
+
+def test_perform_ocr_failed(plugin, tmpdir):
+    def dummy_popen(args, stderr, stdout):
+        # Partial output of a failed run
+        shutil.copyfile('./tests/data/001.hocr', args[2]+'.html')
+        return _mock_proc(returncode=1)
+    imgdir = tmpdir.join('done')
+    imgdir.mkdir()
+    imgdir.join('000.tif').write('image')
+    with mock.patch('spreadsplug.tesseract.subprocess.Popen') as popen:
+        popen.side_effect = dummy_popen
+        plugin._perform_ocr(Path(unicode(imgdir)), 'eng')
+    assert not imgdir.join('000.html').exists()
+    assert tmpdir.join('.cache', 'tesseract').listdir() == [
+        tmpdir.join('.cache', 'tesseract', 'index.json')]
+
+
+def test_process_page(plugin, tmpdir):
+    def dummy_popen(args, stderr, stdout):
+        shutil.copyfile('./tests/data/001.hocr', args[2]+'.html')
+        return _mock_proc()
+    imgdir = tmpdir.join('done')
+    imgdir.mkdir()
+    for fname in ('001_1L.tif', '001_2R.tif', '0010.tif', '002.tif'):
+        imgdir.join(fname).write(fname)
+    with mock.patch('spreadsplug.tesseract.subprocess.Popen') as popen:
+        popen.side_effect = dummy_popen
+        plugin.process_page(Path(unicode(tmpdir)),
+                            Path(unicode(tmpdir.join('raw', '001.jpg'))))
+    assert sorted(x.basename for x in imgdir.listdir()
+                  if x.ext == '.html') == ['001_1L.html', '001_2R.html']
+    imgdir.join('001_2R.tif').remove()
+    plugin.finish_process(Path(unicode(tmpdir)))
+    assert len(tmpdir.join('.cache', 'tesseract').listdir('*.html')) == 1
+
+
 def test_fix_hocr(plugin, tmpdir):
     shutil.copyfile('./tests/data/000.hocr', unicode(tmpdir.join('test.html')))
     fpath = Path(unicode(tmpdir.join('test.html')))
@@ -82,3 +157,54 @@ def test_output(plugin, tmpdir):
     assert len(tree.findall('.//span[@class="ocr_line"]')) == 20*26
     assert len(tree.findall('.//p[@class="ocr_par"]')) == 20*4
     assert len(tree.findall('.//div[@class="ocr_page"]')) == 20
+
+
+def test_output_incremental(plugin, pluginclass, tmpdir):
+    assembler_cls = sys.modules[pluginclass.__module__].HocrAssembler
+    basedir = tmpdir.join('test')
+    basedir.join('out').ensure(dir=True)
+    done_path = basedir.join('done')
+    done_path.mkdir()
+    for idx in xrange(10):
+        shutil.copyfile('./tests/data/000.hocr',
+                        unicode(done_path.join('{0:03}.html'.format(idx))))
+    fpath = Path(unicode(basedir))
+    outpath = basedir.join('out', 'test.hocr')
+    plugin.output(fpath)
+    first_output = outpath.read()
+
+    orig_render = assembler_cls._render_page
+    with mock.patch.object(assembler_cls, '_render_page',
+                           autospec=True, side_effect=orig_render) as render:
+        plugin.output(fpath)
+        assert render.call_count == 0
+        assert outpath.read() == first_output
+
+        # Change a page in the second half and add a new one at the end
+        shutil.copyfile('./tests/data/001.hocr',
+                        unicode(done_path.join('007.html')))
+        shutil.copyfile('./tests/data/000.hocr',
+                        unicode(done_path.join('010.html')))
+        plugin.output(fpath)
+        assert render.call_count == 4
+    output = outpath.read()
+    unchanged_len = first_output.index("id=\"page_7\"")
+    assert output[:unchanged_len] == first_output[:unchanged_len]
+    tree = ET.parse(unicode(outpath))
+    pages = tree.findall('.//div[@class="ocr_page"]')
+    assert [p.get('id') for p in pages] == ['page_{0}'.format(idx)
+                                            for idx in xrange(11)]
+
+
+def test_output_empty_formatting(plugin, tmpdir):
+    basedir = tmpdir.join('test')
+    basedir.join('out').ensure(dir=True)
+    basedir.join('done', '000.html').write(
+        '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+        '<div class="ocr_page" id="page_1"><span class="ocrx_word">'
+        '<em></em>foo<strong></strong> bar</span></div></body></html>',
+        ensure=True)
+    plugin.output(Path(unicode(basedir)))
+    output = basedir.join('out', 'test.hocr').read()
+    assert ('<span class="ocrx_word">foo bar</span>' in output)
+    assert 'html:' not in output
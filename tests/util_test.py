@@ -0,0 +1,130 @@
+import shutil
+import threading
+import time
+
+import mock
+import pytest
+from jpegtran import JPEGImage
+from spreads.vendor.pathlib import Path
+
+import spreads.util as util
+
+
+@pytest.fixture(params=[True, False], ids=['inotify', 'polling'])
+def watcher(request, tmpdir):
+    if request.param and util._inotify is None:
+        pytest.skip("inotify is not available")
+    with mock.patch('spreads.util._inotify',
+                    util._inotify if request.param else None):
+        watcher = util.DirectoryWatcher(Path(unicode(tmpdir)),
+                                        poll_interval=0.05)
+    request.addfinalizer(watcher.close)
+    return watcher
+
+
+def test_monotonic():
+    first = util.monotonic()
+    assert util.monotonic() >= first
+
+
+def test_directory_watcher(watcher, tmpdir):
+    tmpdir.join('foo.tif').write('foo')
+    names = []
+    for _ in xrange(5):
+        names.extend(watcher.wait(timeout=0.5))
+        if names:
+            break
+    assert names == ['foo.tif']
+
+
+def test_directory_watcher_wake(watcher):
+    timer = threading.Timer(0.1, watcher.wake)
+    timer.start()
+    assert watcher.wait(timeout=5) == []
+    timer.join()
+
+
+def test_directory_watcher_opened(tmpdir):
+    if util._inotify is None:
+        pytest.skip("inotify is not available")
+    tmpdir.join('001.jpg').write('foo')
+    with util.DirectoryWatcher(Path(unicode(tmpdir)), opened=True) as watcher:
+        tmpdir.join('001.jpg').read()
+        assert watcher.wait(timeout=1) == ['001.jpg']
+
+
+def test_resource_scheduler():
+    scheduler = util.ResourceScheduler(2)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def job():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    # Two executors with more workers than slots have to share the budget
+    with scheduler.executor(4) as first, scheduler.executor(4) as second:
+        futures = ([first.submit(job) for _ in xrange(4)] +
+                   [second.submit(job) for _ in xrange(4)])
+    for future in futures:
+        future.result()
+    assert max_running[0] == 2
+    assert scheduler.in_use == 0
+
+
+def test_resource_scheduler_resize():
+    scheduler = util.ResourceScheduler(1)
+    scheduler.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        scheduler.acquire()
+        acquired.set()
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+    scheduler.resize(2)
+    assert acquired.wait(1)
+    thread.join()
+    assert scheduler.in_use == 2
+    with pytest.raises(ValueError):
+        scheduler.resize(0)
+
+
+def test_set_exif_orientation(tmpdir):
+    img_path = tmpdir.join('000.jpg')
+    shutil.copyfile('./tests/data/even.jpg', unicode(img_path))
+    original = img_path.read_binary()
+    assert util.set_exif_orientation(unicode(img_path), 6)
+    patched = img_path.read_binary()
+    assert JPEGImage(unicode(img_path)).exif_orientation == 6
+    # Only the orientation value may have changed
+    assert len(patched) == len(original)
+    assert sum(a != b for a, b in zip(original, patched)) == 1
+
+
+def test_set_exif_orientation_tiff(tmpdir):
+    # Minimal big-endian TIFF with an orientation entry
+    img_path = tmpdir.join('000.dng')
+    img_path.write_binary(
+        b'MM\x00\x2a\x00\x00\x00\x08' + b'\x00\x01' +
+        b'\x01\x12\x00\x03\x00\x00\x00\x01\x00\x01\x00\x00' +
+        b'\x00\x00\x00\x00')
+    assert util.set_exif_orientation(unicode(img_path), 8)
+    assert img_path.read_binary()[18:20] == b'\x00\x08'
+    assert util.get_exif_orientation(unicode(img_path)) == 8
+
+
+def test_set_exif_orientation_missing(tmpdir):
+    img_path = tmpdir.join('000.jpg')
+    img_path.write_binary(b'\xff\xd8\xff\xda\x00\x02')
+    assert not util.set_exif_orientation(unicode(img_path), 6)
+    assert util.get_exif_orientation(unicode(img_path)) is None
+    tmpdir.join('empty.jpg').write_binary(b'')
+    assert not util.set_exif_orientation(unicode(tmpdir.join('empty.jpg')),
+                                         6)
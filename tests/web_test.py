@@ -18,7 +18,7 @@ from spreads.workflow import Workflow
 def app(config, mock_driver_mgr, mock_plugin_mgr, tmpdir):
     import spreadsplug.web.persistence as persistence
     from spreadsplug.web import setup_app, setup_logging, setup_signals, app
-    from spreadsplug.web.web import event_queue
+    from spreadsplug.web import web
     from spreads.plugin import set_default_config
     set_default_config(config)
 
@@ -27,13 +27,16 @@ def app(config, mock_driver_mgr, mock_plugin_mgr, tmpdir):
     config['web']['project_dir'] = unicode(tmpdir)
     config['web']['debug'] = False
     config['web']['standalone_device'] = True
+    config['web']['image_cache_size'] = 10
+    config['web']['preview_width'] = 300
     setup_app(config)
     setup_logging(config)
     setup_signals()
     app.config['TESTING'] = True
-    event_queue.clear()
-    persistence.WorkflowCache = {}
+    web.event_broker.clear()
+    persistence.WorkflowCache.clear()
     yield app
+    web.derivative_generator.shutdown(wait=False)
 
 
 @pytest.yield_fixture
@@ -179,8 +182,10 @@ def test_poll(client):
     rv = asyn_result.get()
     assert rv.status_code == 200
     data = json.loads(rv.data)
-    assert data == [{'name': 'workflow:removed',
-                     'data': {'id': 1}}]
+    assert len(data) == 1
+    assert data[0]['name'] == 'workflow:removed'
+    assert data[0]['data'] == {'id': 1}
+    assert 'last_event={0}'.format(data[0]['seq']) in rv.headers['Set-Cookie']
 
 
 def test_download_workflow(client):
@@ -273,6 +278,10 @@ def test_get_workflow_image_scaled(client):
     img = jpegtran.JPEGImage(blob=client.get(
         '/workflow/{0}/image/0?width=300'.format(wfid)).data)
     assert img.width == 300
+    with mock.patch('spreadsplug.web.util.scale_image') as scale:
+        rv = client.get('/workflow/{0}/image/0?width=300'.format(wfid))
+        assert not scale.called
+    assert jpegtran.JPEGImage(blob=rv.data).width == 300
 
 
 def test_get_workflow_image_thumb(client):
@@ -281,6 +290,54 @@ def test_get_workflow_image_thumb(client):
     rv = client.get('/workflow/{0}/image/1/thumb'.format(wfid))
     assert rv.status_code == 200
     assert jpegtran.JPEGImage(blob=rv.data).width
+    etag = rv.headers['ETag']
+    rv = client.get('/workflow/{0}/image/1/thumb'.format(wfid),
+                    headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert not rv.data
+
+
+def test_capture_generates_derivatives(client):
+    from spreadsplug.web import web
+    wfid = create_workflow(client, num_captures=1)
+    # Wait for the background generation to finish
+    web.derivative_generator.shutdown(wait=True)
+    with mock.patch('spreadsplug.web.util.scale_image') as scale:
+        rv = client.get('/workflow/{0}/image/0/thumb'.format(wfid))
+        assert rv.status_code == 200
+        rv = client.get('/workflow/{0}/image/0?width=300'.format(wfid))
+        assert jpegtran.JPEGImage(blob=rv.data).width == 300
+        assert not scale.called
+
+
+def test_derivative_cache(tmpdir):
+    from spreads.vendor.pathlib import Path
+    from spreadsplug.web.util import DerivativeCache
+    images = []
+    for idx in xrange(3):
+        img = tmpdir.join('{0:03}.jpg'.format(idx))
+        img.write('')
+        images.append(Path(unicode(img)))
+    cache_dir = Path(unicode(tmpdir.join('cache')))
+    cache = DerivativeCache(cache_dir, max_size=20)
+    generate = mock.Mock(side_effect=lambda x: b'x'*8)
+    cache.get(images[0], 'thumb', generate)
+    cache.get(images[1], 'thumb', generate)
+    # Mark the first one as recently used
+    assert cache.get(images[0], 'thumb', generate)[1] == b'x'*8
+    assert generate.call_count == 2
+    cache.get(images[2], 'thumb', generate)
+    # The second image was evicted
+    assert cache.total_size == 16
+    assert len(list(cache_dir.glob('*.jpg'))) == 2
+    cache.get(images[1], 'thumb', generate)
+    assert generate.call_count == 4
+
+    # The cache is persistent
+    cache = DerivativeCache(cache_dir, max_size=20)
+    assert cache.total_size == 16
+    cache.get(images[1], 'thumb', generate)
+    assert generate.call_count == 4
 
 
 def test_prepare_capture(client):
@@ -328,6 +385,9 @@ def test_shutdown(client):
 
 
 def test_get_logs(client):
+    from spreadsplug.web import web
+    # Disable background generation of thumbnails, which logs as well
+    web.derivative_generator.shutdown(wait=False)
     create_workflow(client, num_captures=1)
     records = json.loads(client.get('/log',
                                     query_string={'start': 2, 'count': 5,
@@ -335,3 +395,188 @@ def test_get_logs(client):
     assert len(records['messages']) == 5
     assert (records['messages'][0]['message']
             == u'Sending finish_capture command to devices')
+
+
+def test_get_events_since(client):
+    Workflow.on_removed.send(None, id=1)
+    Workflow.on_removed.send(None, id=2)
+    events = json.loads(client.get('/events').data)
+    since = events[-2]['seq']
+    data = json.loads(client.get('/events?since={0}'.format(since)).data)
+    assert [x['data'] for x in data] == [{'id': 2}]
+
+
+def test_event_broker():
+    from spreadsplug.web.util import Event, EventBroker
+    broker = EventBroker(maxlen=3)
+    assert broker.wait(0, timeout=0.05) == ()
+    for idx in xrange(5):
+        broker.publish(Event(None, None, {'idx': idx}))
+    assert [x.seq for x in broker.get_latest()] == [3, 4, 5]
+    assert [x.seq for x in broker.get_since(3)] == [4, 5]
+    # Events that are no longer available are skipped
+    assert [x.seq for x in broker.get_since(0)] == [3, 4, 5]
+    assert broker.get_since(5) == ()
+
+    pool = ThreadPool(processes=1)
+    result = pool.apply_async(broker.wait, (5, 5))
+    time.sleep(0.05)
+    broker.publish(Event(None, None, {'idx': 5}))
+    assert [x.seq for x in result.get()] == [6]
+
+
+def test_event_broker_timeout():
+    from spreadsplug.web.util import EventBroker
+    broker = EventBroker()
+    broker.timer_resolution = 0.05
+    start = time.time()
+
+    def timed_wait(timeout):
+        return broker.wait(0, timeout), time.time() - start
+
+    pool = ThreadPool(processes=3)
+    timeouts = (0.6, 0.2, 0.4)
+    results = [pool.apply_async(timed_wait, (timeout, ))
+               for timeout in timeouts]
+    # Every client is woken up after its own timeout
+    for timeout, result in zip(timeouts, results):
+        events, duration = result.get(5)
+        assert events == ()
+        assert timeout <= duration < timeout + 0.3
+    assert not broker._deadlines
+    time.sleep(0.1)
+    # The timer is stopped once no more clients are waiting
+    assert broker._timer is None
+
+
+def test_websocket_slow_client():
+    from spreadsplug.web.websockets import SocketHandler
+    sock = SocketHandler.__new__(SocketHandler)
+    sock.stream = mock.Mock()
+    sock.stream.writing.return_value = True
+    sock.write_message = mock.Mock()
+    sock.open()
+    try:
+        sock.max_pending = 3
+        progress_key = ('workflow:progressed', 1, 'tesseract')
+        sock.send('a')
+        sock.send('progress 1', progress_key)
+        sock.send('b')
+        sock.send('progress 2', progress_key)
+        # Progress messages are coalesced
+        assert sock.pending.values() == ['a', 'b', 'progress 2']
+        sock.send('c')
+        # Oldest message is dropped
+        assert sock.pending.values() == ['b', 'progress 2', 'c']
+        assert not sock.write_message.called
+
+        sock.stream.writing.return_value = False
+        sock.flush()
+        assert ([x[0][0] for x in sock.write_message.call_args_list]
+                == ['b', 'progress 2', 'c'])
+        assert not sock.pending
+    finally:
+        sock.on_close()
+
+
+def test_event_coalescer():
+    from spreadsplug.web.util import Event, EventCoalescer
+    from spreads.util import EventHandler
+    delivered = []
+    coalescer = EventCoalescer(delivered.append, interval=10)
+    workflow = mock.Mock(id=1)
+
+    def progress(plugin, value):
+        return Event(Workflow.on_step_progressed, workflow,
+                     {'plugin_name': plugin, 'progress': value})
+
+    for value in (0.1, 0.2, 0.3):
+        coalescer.push(progress('scantailor', value))
+    coalescer.push(progress('tesseract', 0.5))
+    assert delivered == []
+    # Other events are delivered after the pending progress events
+    log_event = Event(EventHandler.on_log_emit, None, {'record': None})
+    coalescer.push(log_event)
+    assert [(x.data.get('plugin_name'), x.data.get('progress'))
+            for x in delivered] == [('scantailor', 0.3), ('tesseract', 0.5),
+                                    (None, None)]
+    assert delivered[-1] is log_event
+
+    # Progress from different steps is kept apart
+    del delivered[:]
+    workflow.step = 'process'
+    coalescer.push(progress('tesseract', 1.0))
+    workflow.step = 'output'
+    coalescer.push(progress('tesseract', 0.1))
+    coalescer.flush()
+    assert [x.data['progress'] for x in delivered] == [1.0, 0.1]
+
+    del delivered[:]
+    coalescer.interval = 0.01
+    coalescer.push(progress('scantailor', 0.4))
+    coalescer.push(progress('scantailor', 0.6))
+    time.sleep(0.1)
+    assert [x.data['progress'] for x in delivered] == [0.6]
+
+
+def test_persistence_connections(app):
+    import spreadsplug.web.persistence as persistence
+    con = persistence.open_connection()
+    assert persistence.open_connection() is con
+    assert (con.execute("PRAGMA journal_mode").fetchone()[0].lower()
+            == 'wal')
+    pool = ThreadPool(processes=1)
+    other = pool.apply(lambda: id(persistence.open_connection()))
+    assert other != id(con)
+    # Initializing an existing database keeps its data
+    workflow_id = persistence.save_workflow(
+        Workflow(config=app.config['default_config'],
+                 path=os.path.join(app.config['base_path'], 'foo')))
+    persistence.initialize_database()
+    assert (con.execute("SELECT name FROM workflow WHERE id=?",
+                        (workflow_id,)).fetchone()[0] == 'foo')
+
+
+def test_workflow_cache(app):
+    import spreadsplug.web.persistence as persistence
+    ids = [persistence.save_workflow(
+        Workflow(config=app.config['default_config'],
+                 path=os.path.join(app.config['base_path'], name)))
+        for name in ('foo', 'bar', 'baz')]
+    persistence.WorkflowCache.clear()
+    # Workflows that were not loaded before must not be missing, but are not
+    # added to the cache by a listing
+    cached = persistence.get_workflow(ids[0])
+    listing = persistence.get_all_workflows()
+    assert sorted(listing) == ids
+    assert listing[ids[0]] is cached
+    assert len(persistence.WorkflowCache) == 1
+
+    cache = persistence.LRUWorkflowCache(max_size=1)
+    workflows = [persistence.get_workflow(wfid) for wfid in ids]
+    workflows[0].active = True
+    for workflow in workflows:
+        cache.add(workflow)
+    # Active workflows are not evicted and do not count towards the limit
+    assert ids[0] in cache and ids[2] in cache and ids[1] not in cache
+    cache.max_size = 3
+    cache.add(workflows[1])
+    assert len(cache) == 3
+    assert cache.add(Workflow(config=app.config['default_config'],
+                              path=workflows[2].path,
+                              id=ids[2])) is workflows[2]
+    cache.invalidate(ids[2])
+    assert ids[2] not in cache
+
+    # Workflows that are still processing or completing captures in the
+    # background are not evicted either
+    workflows[0].active = False
+    workflows[0]._live_pipeline = mock.Mock()
+    workflows[2]._pending_captures.append(mock.Mock())
+    cache.max_size = 0
+    cache.add(workflows[2])
+    assert ids[0] in cache and ids[2] in cache and ids[1] not in cache
+
+    persistence.delete_workflow(ids[1])
+    assert persistence.get_workflow(ids[1]) is None
+    assert sorted(persistence.get_all_workflows()) == [ids[0], ids[2]]
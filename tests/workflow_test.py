@@ -1,11 +1,17 @@
 from __future__ import division, unicode_literals
 
+import os
 import shutil
+import time
 
+import mock
 import pytest
 
+import spreads.plugin as plugin
 import spreads.util as util
 import spreads.workflow
+import tests.conftest as conftest
+from spreads.vendor.pathlib import Path
 
 
 @pytest.fixture
@@ -52,6 +58,92 @@ def test_get_next_filename(workflow):
     assert unicode(fname) == unicode(root_path/"002")
 
 
+def test_get_next_filename_no_target(workflow):
+    root_path = workflow.path/'raw'
+    fname = workflow._get_next_filename()
+    assert unicode(fname) == unicode(root_path/"000")
+    shutil.copyfile('./tests/data/even.jpg', unicode(root_path/'000.jpg'))
+    # Captures whose images have not been stored yet are counted as well
+    workflow._pending_captures.append(root_path/'001')
+    fname = workflow._get_next_filename()
+    assert unicode(fname) == unicode(root_path/"002")
+
+
+def test_images_external_change(workflow):
+    raw_path = workflow.path/'raw'
+    raw_path.mkdir()
+    assert workflow.images == []
+    shutil.copyfile('./tests/data/even.jpg', unicode(raw_path/'000.jpg'))
+    assert workflow.images == [raw_path/'000.jpg']
+    (raw_path/'000.jpg').unlink()
+    assert workflow.images == []
+
+
+def test_image_index_own_changes(tmpdir):
+    raw_path = Path(unicode(tmpdir.join('raw')))
+    raw_path.mkdir()
+    past = time.time() - 10
+    os.utime(unicode(raw_path), (past, past))
+    index = spreads.workflow.ImageIndex(raw_path)
+    iterdir = Path.iterdir
+    with mock.patch.object(Path, 'iterdir', autospec=True,
+                           side_effect=iterdir) as mock_iterdir:
+        assert index.images == []
+        for num in xrange(3):
+            img = raw_path/'{0:03}.jpg'.format(num)
+            before = index.mtime
+            shutil.copyfile('./tests/data/even.jpg', unicode(img))
+            index.add(img, change=(before, index.mtime))
+            assert index.images[-1] == img
+        index.remove(raw_path/'002.jpg')
+        assert index.last() == [raw_path/'001.jpg']
+        # Only the initial scan was needed
+        assert mock_iterdir.call_count == 1
+
+
+def test_image_index_external_changes(tmpdir):
+    raw_path = Path(unicode(tmpdir.join('raw')))
+    raw_path.mkdir()
+    past = time.time() - 10
+    os.utime(unicode(raw_path), (past, past))
+    index = spreads.workflow.ImageIndex(raw_path)
+    assert index.images == []
+    # Changes from somebody else before our own must not be hidden by them
+    tmpdir.join('raw', '000.jpg').write('')
+    before = index.mtime
+    tmpdir.join('raw', '001.jpg').write('')
+    index.add(raw_path/'001.jpg', change=(before, index.mtime))
+    assert index.images == [raw_path/'000.jpg', raw_path/'001.jpg']
+
+    tmpdir.join('raw', '002.jpg').write('')
+    index.remove(raw_path/'000.jpg')
+    assert index.images == [raw_path/'001.jpg', raw_path/'002.jpg']
+
+    # Without knowing the state before, added images are not trusted
+    tmpdir.join('raw', '003.jpg').write('')
+    tmpdir.join('raw', '004.jpg').write('')
+    index.add(raw_path/'004.jpg')
+    assert index.last(2) == [raw_path/'003.jpg', raw_path/'004.jpg']
+
+
+def test_get_image(workflow):
+    workflow.capture()
+    assert workflow.get_image(0) == workflow.images[0]
+    assert workflow.get_image(1) == workflow.images[1]
+    assert workflow.get_image(2) is None
+
+
+def test_capture_retake(workflow):
+    workflow.capture()
+    workflow.capture()
+    old_mtime = workflow.images[-1].stat().st_mtime
+    time.sleep(0.01)
+    workflow.capture(retake=True)
+    assert workflow.pages_shot == 4
+    assert [x.stem for x in workflow.images] == ['000', '001', '002', '003']
+    assert workflow.images[-1].stat().st_mtime > old_mtime
+
+
 def test_prepare_capture(workflow):
     workflow.prepare_capture()
     assert workflow.prepared
@@ -81,6 +173,34 @@ def test_capture_noparallel(workflow):
                  workflow.images[0].stat().st_ctime, 2) >= 0.25
 
 
+def test_capture_pipelined(workflow):
+    workflow.config['device']['parallel_capture'] = True
+    workflow.config['device']['pipelined_capture'] = True
+    workflow.config['device']['max_pending_captures'] = 2
+    for dev in workflow.devices:
+        dev.completion_delay = 0.25
+    start = time.time()
+    workflow.capture()
+    workflow.capture()
+    assert time.time() - start < 0.25
+    workflow.capture()
+    workflow.finish_capture()
+    assert workflow.pages_shot == 6
+    assert ([x.stem for x in workflow.images] ==
+            ['000', '001', '002', '003', '004', '005'])
+
+
+def test_capture_pipelined_retake(workflow):
+    workflow.config['device']['pipelined_capture'] = True
+    for dev in workflow.devices:
+        dev.completion_delay = 0.1
+    workflow.capture()
+    workflow.capture(retake=True)
+    workflow.finish_capture()
+    assert workflow.pages_shot == 2
+    assert [x.stem for x in workflow.images] == ['000', '001']
+
+
 def test_capture_flip_target_pages(workflow):
     workflow.config['device']['parallel_capture'] = False
     workflow.config['device']['flip_target_pages'] = True
@@ -101,3 +221,103 @@ def test_process(workflow):
 def test_output(workflow):
     workflow.output()
     # TODO: Verify
+
+
+def test_get_devices_cached_connection(workflow):
+    devices = workflow.devices
+    with mock.patch.object(devices[0], 'connected') as connected:
+        assert workflow.devices is devices
+        assert not connected.called
+        connected.return_value = False
+        plugin.device_monitor.refresh()
+    with pytest.raises(util.DeviceException):
+        workflow.devices
+
+
+def test_process_pipeline(workflow, config):
+    log = []
+    page_a = conftest.TestPluginPage(config, log)
+    page_b = conftest.TestPluginPage(config, log)
+    barrier = conftest.TestPluginPage(config, log)
+    barrier.page_barrier = True
+    whole = workflow.plugins[1]
+    workflow._pluginmanager = [mock.Mock(obj=x) for x in
+                               (page_a, page_b, whole, barrier)]
+    assert workflow._get_process_segments() == [
+        (True, [page_a, page_b]), (False, [whole]), (True, [barrier])]
+
+    (workflow.path / 'raw').mkdir()
+    for fname in ('000.jpg', '001.jpg'):
+        (workflow.path / 'raw' / fname).touch()
+    workflow.config['postprocess']['pipeline'] = True
+    progress = []
+    workflow.on_step_progressed.connect(
+        lambda sender, **kwargs: progress.append(kwargs['progress']),
+        sender=workflow, weak=False)
+    workflow.process()
+    assert len(log) == 6
+    assert (workflow.path / 'processed_a.txt').exists()
+    assert progress[-1] == 1.0
+
+
+def test_process_live(workflow, config):
+    log = []
+    page_plugin = conftest.TestPluginPage(config, log)
+    whole = workflow.plugins[1]
+    workflow._pluginmanager = [mock.Mock(obj=x)
+                               for x in (page_plugin, whole)]
+    workflow.config['postprocess']['live'] = True
+    workflow.config['device']['parallel_capture'] = True
+    workflow.prepare_capture()
+    workflow.capture()
+    with mock.patch.object(workflow._live_pipeline, 'discard') as discard:
+        workflow.capture(retake=True)
+    # Work on the old images is stopped before they are removed
+    assert (sorted(x[0][0].stem for x in discard.call_args_list) ==
+            ['000', '001'])
+    workflow.capture()
+    workflow.finish_capture()
+    # All pages are processed once the capture is finished
+    assert workflow._live_pipeline is None
+    assert (sorted(set(img.stem for _, img in log)) ==
+            ['000', '001', '002', '003'])
+    with mock.patch.object(page_plugin, 'process') as process:
+        workflow.process()
+        assert not process.called
+    assert (workflow.path / 'processed_a.txt').exists()
+
+
+def test_process_live_sessions(workflow, config):
+    log = []
+    page_plugin = conftest.TestPluginPage(config, log)
+    whole = workflow.plugins[1]
+    workflow._pluginmanager = [mock.Mock(obj=x)
+                               for x in (page_plugin, whole)]
+    workflow.config['postprocess']['live'] = True
+    workflow.config['device']['parallel_capture'] = True
+    for _ in xrange(2):
+        workflow.prepare_capture()
+        workflow.capture()
+        workflow.finish_capture()
+    with mock.patch.object(page_plugin, 'process') as process:
+        workflow.process()
+        assert not process.called
+    # Pages of the second session were processed as well
+    assert (sorted(set(img.stem for _, img in log)) ==
+            ['000', '001', '002', '003'])
+
+    # Without live processing, the new pages are processed with the rest
+    workflow.config['postprocess']['live'] = False
+    workflow.prepare_capture()
+    workflow.capture()
+    workflow.finish_capture()
+    with mock.patch.object(page_plugin, 'process') as process:
+        workflow.process()
+        assert process.called
+
+
+def test_process_jobs(workflow):
+    workflow.config['jobs'] = 3
+    with mock.patch('spreads.workflow.scheduler') as scheduler:
+        workflow.process()
+    scheduler.resize.assert_called_with(3)